@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Compare matching events against the JSON config entries as it was done
+# per line (interpreted) with the compiled handlers, on the shipped config.
+#
+#   $ python bench/bench_handlers.py -n 1000000
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'traceworks'))
+
+from utils import parseline
+from handlers import Handler
+from gentrace import write_trace
+
+def report(flag, missing, parsed):
+    pass
+
+def execute_action(parsed, d, actions):
+    for action in actions:
+        if action['store_name'] not in d:
+            d[action['store_name']] = 0
+
+        if action['operation'] == 'store':
+            d[action['store_name']] = getattr(parsed, action['field'])
+        elif action['operation'] == 'difference':
+            if action['field'] in d:
+                d[action['store_name']] += (getattr(parsed, action['field']) - d[action['field']])
+        elif action['operation'] == "increment":
+            d[action['store_name']] += 1
+
+def match_store(cfg, parsed, data):
+    # the per line path before the config was compiled into handlers
+    if cfg['name'] in parsed.name:
+        if "hierarchy" in cfg:
+            d = data[cfg['table_name']]
+            for k in cfg["hierarchy"].split("->"):
+                k = getattr(parsed, k)
+                if k not in d:
+                    d[k] = {}
+                d = d[k]
+
+            if 'entry_pattern' in cfg:
+                if cfg['entry_pattern'] in parsed.buf:
+                    if 'entry_action' in cfg:
+                        if 'last_action' not in d or d['last_action'] == 'exit':
+                            execute_action(parsed, d, cfg['entry_action'])
+                            d['last_action'] = 'entry'
+                        else:
+                            report('entry', 'exit', parsed)
+                else:
+                    if 'exit_action' in cfg:
+                        if 'last_action' in d and d['last_action'] == 'entry':
+                            execute_action(parsed, d, cfg['exit_action'])
+                            d['last_action'] = 'exit'
+                        else:
+                            report('entry', 'entry', parsed)
+
+            if 'exit_pattern' in cfg:
+                if cfg['exit_pattern'] in parsed.buf:
+                    if "exit_action" in cfg:
+                        if 'last_action_s' in d and d['last_action_s'] == 'entry':
+                            execute_action(parsed, d, cfg['exit_action'])
+                            d['last_action_s'] = 'exit'
+                        else:
+                            report('exit', 'entry', parsed)
+                else:
+                    if "entry_action" in cfg:
+                        if 'last_action_s' not in d or d['last_action_s'] == 'exit':
+                            execute_action(parsed, d, cfg['entry_action'])
+                            d['last_action_s'] = 'entry'
+                        else:
+                            report('exit', 'exit', parsed)
+
+def leaf_rows(cfg, d, depth, keys=()):
+    # the complete leaves of the nested dicts as table rows
+    if depth == 0:
+        if all(f in keys or f in d for f in cfg['fields']):
+            yield [keys[f] if f in keys else d[f] for f in cfg['fields']]
+        return
+    name = cfg['hierarchy'].split('->')[-depth]
+    for k, v in d.items():
+        keys = dict(keys)
+        keys[name] = k
+        for row in leaf_rows(cfg, v, depth - 1, keys):
+            yield row
+
+def interpreted(config, events):
+    data = dict((c['table_name'], {}) for c in config)
+    start = time.time()
+    for parsed in events:
+        for c in config:
+            match_store(c, parsed, data)
+    elapsed = time.time() - start
+    return [sorted(leaf_rows(c, data[c['table_name']], len(c['hierarchy'].split('->'))))
+            for c in config], elapsed
+
+def compiled(config, events):
+    handlers = [Handler(c, report) for c in config]
+    start = time.time()
+    # same name test as above, so that only the handlers are compared
+    for parsed in events:
+        for h in handlers:
+            if h.name in parsed.name:
+                h.feed(parsed)
+    elapsed = time.time() - start
+    return [sorted(h.rows()) for h in handlers], elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='config handler benchmark')
+    parser.add_argument('--lines', '-n', type=int, default=1000000,
+                        help='number of synthetic trace lines')
+    parser.add_argument('--config', '-c', type=str,
+                        default=os.path.join(here, '..', 'traceworks', 'traceconfig.json'),
+                        help='JSON config file')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)['traceworks']['ftrace'][0]['config']
+
+    f = io.StringIO()
+    write_trace(f, args.lines)
+    lines = f.getvalue().splitlines(True)
+    events = [e for e in map(parseline, lines) if e is not None]
+
+    results = []
+    for name, fn in (('interpreted', interpreted), ('compiled', compiled)):
+        data, elapsed = fn(config, events)
+        results.append(data)
+        print('{:12s} {:10d} events {:8.2f}s {:12.0f} events/sec'.format(
+            name, len(events), elapsed, len(events) / elapsed))
+
+    if results[0] != results[1]:
+        print('results differ')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
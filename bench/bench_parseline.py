@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Compare the throughput of the old dict based parseline against the
+# precompiled one on a synthetic ftrace file.
+#
+#   $ python bench/bench_parseline.py -n 10000000
+
+import argparse
+import datetime
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'traceworks'))
+
+from utils import parseline
+from gentrace import write_trace
+
+def legacy_parseline(line):
+    # parseline as it was before the compiled pattern, kept for comparison
+    m = re.search(r'[ ]*(.*?)-(\d*?)\s*?\[(\d*)\]\s?(.*?)(\d{1,}.\d{6}):\s?(.*)', line)
+    if m is not None:
+        l = re.split(r'\W', m.group(6))
+        g = m.group
+        d = {}
+        d['process_name'] = g(1)
+        d['pid'] = int(g(2))
+        d['cpu'] = int(g(3))
+        d['flags'] = g(4)
+        d['timestamp'] = datetime.datetime.fromtimestamp(float(g(5)))
+        d['name'] = l[0]
+        d['buf'] = m.group(6)
+        return d
+
+    return None
+
+def run(fn, path):
+    n = 0
+    start = time.time()
+    with open(path) as f:
+        for l in f:
+            if fn(l) is not None:
+                n += 1
+    return n, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='parseline benchmark')
+    parser.add_argument('--lines', '-n', type=int, default=10000000,
+                        help='number of synthetic trace lines')
+    parser.add_argument('--trace', type=str,
+                        help='use this trace file instead of a synthetic one')
+    args = parser.parse_args()
+
+    path = args.trace
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.trace')
+        with os.fdopen(fd, 'w') as f:
+            write_trace(f, args.lines)
+
+    try:
+        for name, fn in (('before', legacy_parseline), ('after', parseline)):
+            n, elapsed = run(fn, path)
+            print('{:8s} {:10d} lines {:8.2f}s {:12.0f} lines/sec'.format(
+                name, n, elapsed, n / elapsed))
+    finally:
+        if not args.trace:
+            os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Compare reading the trace as decoded text lines against the mmap based
+# bytes reader, for the event names of the shipped config.
+#
+#   $ python bench/bench_reader.py -n 10000000
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'traceworks'))
+
+from utils import parseline, EventDispatch
+from handlers import Handler
+from reader import TraceReader
+from gentrace import write_trace
+
+def report(flag, missing, parsed):
+    pass
+
+def text_lines(dispatch, path):
+    n = 0
+    with open(path) as f:
+        for l in f:
+            if not dispatch.wanted(l):
+                continue
+            if parseline(l) is not None:
+                n += 1
+    return n
+
+def mapped(dispatch, path):
+    n = 0
+    with TraceReader(path) as r:
+        for offset, parsed in r.events(dispatch.pattern):
+            n += 1
+    return n
+
+def main():
+    parser = argparse.ArgumentParser(description='trace reader benchmark')
+    parser.add_argument('--lines', '-n', type=int, default=10000000,
+                        help='number of synthetic trace lines')
+    parser.add_argument('--trace', type=str,
+                        help='use this trace file instead of a synthetic one')
+    parser.add_argument('--config', '-c', type=str,
+                        default=os.path.join(here, '..', 'traceworks', 'traceconfig.json'),
+                        help='JSON config file')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)['traceworks']['ftrace'][0]['config']
+    dispatch = EventDispatch([Handler(c, report) for c in config if 'hierarchy' in c])
+
+    path = args.trace
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.trace')
+        with os.fdopen(fd, 'w') as f:
+            write_trace(f, args.lines)
+
+    try:
+        for name, fn in (('text', text_lines), ('mmap', mapped)):
+            start = time.time()
+            n = fn(dispatch, path)
+            elapsed = time.time() - start
+            print('{:8s} {:10d} events {:8.2f}s {:12.0f} events/sec'.format(
+                name, n, elapsed, n / elapsed))
+    finally:
+        if not args.trace:
+            os.remove(path)
+
+if __name__ == '__main__':
+    main()
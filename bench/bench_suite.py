@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Ingestion and query benchmark on synthetic traces of traceworks/gentrace.py.
+# For each size the trace is ingested with traceworks -g -I --stats
+# --stats-format json, which gives the time of each stage, the throughput
+# and the peak RSS, then every query of the config is timed on the
+# database. The results go to a
+# JSON file, which a later run can be compared with:
+#
+#   $ python bench/bench_suite.py --sizes 1M,10M,100M -o before.json
+#   ... change something ...
+#   $ python bench/bench_suite.py --sizes 1M,10M,100M -o after.json --compare before.json
+#
+# Traces are generated once into --workdir and reused by later runs with
+# the same parameters. Regressions beyond --threshold percent make the
+# comparison exit with 1.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'traceworks'))
+
+from tabulate import tabulate
+import columnar
+from gentrace import write_trace, write_dat, parse_mix, default_mix
+
+traceworks = os.path.join(here, '..', 'traceworks', 'traceworks.py')
+
+def parse_size(s):
+    s = s.strip().upper()
+    scale = {'K': 1000, 'M': 1000000, 'G': 1000000000}.get(s[-1:])
+    if scale:
+        return int(float(s[:-1]) * scale)
+    return int(s)
+
+def size_name(n):
+    for suffix, scale in (('G', 1000000000), ('M', 1000000), ('K', 1000)):
+        if n >= scale and n % scale == 0:
+            return '{}{}'.format(n // scale, suffix)
+    return str(n)
+
+def trace_path(args, lines):
+    # the parameters are in the name, so that a cached trace is only
+    # reused for the same ones
+    name = 'trace-{}-c{}-p{}-m{}-x{}-s{}.{}'.format(
+        size_name(lines), args.cpus, args.pids,
+        args.mix.replace('=', '').replace(',', '_'), args.missing, args.seed,
+        'dat' if args.dat else 'txt')
+    return os.path.join(args.workdir, name)
+
+def generate(args, lines):
+    path = trace_path(args, lines)
+    if not os.path.exists(path):
+        print('generating {} lines into {}'.format(lines, path))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb' if args.dat else 'w') as f:
+            write = write_dat if args.dat else write_trace
+            write(f, lines, args.cpus, args.pids, args.mix, args.missing, args.seed)
+        os.rename(tmp, path)
+    return path
+
+def ingest(args, trace, db):
+    # one traceworks -g run, its --stats json report and wall time
+    if os.path.exists(db):
+        os.remove(db)
+    cmd = [sys.executable, traceworks, '-g', '-I', '-j', str(args.jobs), '-c', args.config,
+           trace, db, '--stats', '--stats-format', 'json']
+    with open(os.devnull, 'w') as null:
+        start = time.time()
+        p = subprocess.Popen(cmd, stdout=null, stderr=subprocess.PIPE)
+        err = p.communicate()[1].decode('utf-8', 'replace')
+        wall = time.time() - start
+    if p.returncode:
+        print(err)
+        print('{} failed'.format(' '.join(cmd)))
+        exit(1)
+
+    report = None
+    for l in err.splitlines():
+        if l.startswith('{'):
+            report = json.loads(l)
+    if report is None:
+        print('no --stats report from {}'.format(' '.join(cmd)))
+        exit(1)
+
+    return {'wall': wall,
+            'stages': dict((s['name'], s['wall']) for s in report['stages']),
+            'lines': report['lines'], 'bytes': report['bytes'], 'events': report['events'],
+            'lines_per_sec': report['lines_per_sec'],
+            'bytes_per_sec': report['bytes_per_sec'],
+            'peak_rss': max(report['peak_rss'], report['workers_peak_rss']),
+            'db_size': os.path.getsize(db)}
+
+def query_args(cursor, query):
+    # Arguments for a query, picked from the database by their name. None
+    # if the query takes one this does not know about.
+    span = cursor.execute('SELECT MIN(start_ts), MAX(end_ts) FROM sched_intervals').fetchone()
+    lo, hi = span if span[0] is not None else (0, 0)
+    mid = (lo + hi) // 2
+    window = max((hi - lo) // 100, 1)
+    values = {'number': '10', 'cpu': '0', 'timestamp': str(mid),
+              'from': str(mid), 'to': str(mid + window), 'bucket': str(max(window // 100, 1))}
+
+    qargs = []
+    for name in query.get('args', []):
+        if name == 'pid':
+            r = cursor.execute('SELECT pid FROM process GROUP BY pid '
+                               'ORDER BY SUM(duration) DESC LIMIT 1').fetchone()
+            qargs.append(str(r[0]) if r else '0')
+        elif name == 'syscall':
+            r = cursor.execute('SELECT name FROM process GROUP BY name '
+                               'ORDER BY COUNT(*) DESC LIMIT 1').fetchone()
+            qargs.append(r[0] if r else 'sys_read')
+        elif name in values:
+            qargs.append(values[name])
+        else:
+            return None
+    return qargs
+
+def run_queries(args, queries, db):
+    # best time of --repeat runs of each query, in seconds
+    conn = sqlite3.connect(db)
+    cursor = conn.cursor()
+    columnar_ok = columnar.missing_module() is None
+    times = {}
+    for q in queries:
+        kind = q.get('kind', 'sql')
+        if kind == 'sql' and 'query' not in q:
+            continue
+        if kind != 'sql' and not columnar_ok:
+            print('skipping "{}", it needs {}'.format(q['name'], columnar.missing_module()))
+            continue
+        qargs = query_args(cursor, q)
+        if qargs is None:
+            print('skipping "{}", no value for its arguments'.format(q['name']))
+            continue
+
+        best = None
+        for i in range(args.repeat):
+            start = time.time()
+            if kind == 'sql':
+                cursor.execute(q['query'].format(*qargs)).fetchall()
+            else:
+                columnar.run_query(cursor, db, q, qargs)
+            t = time.time() - start
+            best = t if best is None else min(best, t)
+        times[q['name']] = best
+    conn.close()
+    return times
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as null:
+            out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here, stderr=null)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def metrics(results):
+    # the numbers to compare, all of which are better lower, as
+    # (value in ms or MB, unit)
+    m = {}
+    for size, r in results['sizes'].items():
+        i = r['ingest']
+        m[(size, 'ingest', 'total')] = (i['wall'] * 1000, 'ms')
+        for stage, t in i['stages'].items():
+            m[(size, 'stage', stage)] = (t * 1000, 'ms')
+        m[(size, 'memory', 'peak_rss')] = (i['peak_rss'] / float(1 << 20), 'MB')
+        for name, t in r['queries'].items():
+            m[(size, 'query', name)] = (t * 1000, 'ms')
+    return m
+
+def compare(old, new, threshold, noise):
+    # A table of what changed, and how many got worse by more than
+    # 'threshold' percent. Changes of less than 'noise' ms or MB do not
+    # count, timings that short are mostly jitter.
+    o = metrics(old)
+    n = metrics(new)
+    rows = []
+    regressions = 0
+    for key in sorted(set(o) & set(n), key=lambda k: (parse_size(k[0]), k[1], k[2])):
+        (ov, unit), (nv, unit) = o[key], n[key]
+        if not ov:
+            continue
+        change = (nv - ov) * 100.0 / ov
+        flag = ''
+        if abs(nv - ov) >= noise:
+            if change > threshold:
+                flag = 'REGRESSION'
+                regressions += 1
+            elif change < -threshold:
+                flag = 'faster' if unit == 'ms' else 'smaller'
+        rows.append(list(key) + [unit, ov, nv, '{:+.1f}%'.format(change), flag])
+    print(tabulate(rows, headers=['size', 'what', 'name', 'unit', 'old', 'new', 'change', ''],
+                   floatfmt='.3f'))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='traceworks ingestion and query benchmark')
+    parser.add_argument('--sizes', type=str, default='1M',
+                        help='comma separated trace sizes in lines, with K, M or G, '
+                        'e.g. 1M,10M,100M')
+    parser.add_argument('--cpus', type=int, default=8, help='number of CPUs')
+    parser.add_argument('--pids', type=int, default=64, help='number of tasks')
+    parser.add_argument('--mix', type=str, default=default_mix,
+                        help='relative weights of syscall, sched_switch, cpu_idle and irq events')
+    parser.add_argument('--missing', type=float, default=0.01,
+                        help='share of the events to leave out')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--dat', action='store_true',
+                        help='ingest the traces as trace-cmd trace.dat files instead of text')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of processes to ingest with')
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+                        help='runs of each ingestion and query, the best one counts')
+    parser.add_argument('--config', '-c', type=str,
+                        default=os.path.join(here, '..', 'traceworks', 'traceconfig.json'),
+                        help='JSON config file')
+    parser.add_argument('--workdir', '-w', type=str, default='bench-data',
+                        help='where the traces and databases are kept')
+    parser.add_argument('--output', '-o', type=str, default='bench-results.json',
+                        help='results file')
+    parser.add_argument('--compare', type=str,
+                        help='results file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percentage by which a time or memory use may grow')
+    parser.add_argument('--noise', type=float, default=1.0,
+                        help='smallest change in ms or MB which may count as a regression')
+    args = parser.parse_args()
+
+    try:
+        sizes = [parse_size(s) for s in args.sizes.split(',')]
+        parse_mix(args.mix)
+    except ValueError as e:
+        print('Invalid argument: {}'.format(e))
+        exit(1)
+
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+
+    with open(args.config) as f:
+        queries = json.load(f)['traceworks']['ftrace'][0].get('queries', [])
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+
+    results = {'meta': {'date': datetime.datetime.now().isoformat(),
+                        'commit': git_commit(),
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'sqlite': sqlite3.sqlite_version,
+                        'params': {'cpus': args.cpus, 'pids': args.pids, 'mix': args.mix,
+                                   'missing': args.missing, 'seed': args.seed,
+                                   'jobs': args.jobs, 'repeat': args.repeat,
+                                   'dat': args.dat}},
+               'sizes': {}}
+
+    for lines in sizes:
+        trace = generate(args, lines)
+        db = os.path.join(args.workdir, 'bench.db')
+        best = None
+        for i in range(args.repeat):
+            r = ingest(args, trace, db)
+            if best is None or r['wall'] < best['wall']:
+                best = r
+        times = run_queries(args, queries, db)
+        results['sizes'][size_name(lines)] = {'ingest': best, 'queries': times}
+
+        print('{}: {:.2f} s, {:.0f} lines/sec, peak RSS {:.1f} MB'.format(
+            size_name(lines), best['wall'], best['lines_per_sec'] or 0,
+            best['peak_rss'] / float(1 << 20)))
+        print(tabulate(sorted(best['stages'].items()), headers=['stage', 'wall (s)'],
+                       floatfmt='.3f'))
+        print(tabulate(sorted(times.items()), headers=['query', 'best (s)'], floatfmt='.4f'))
+        print('')
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+    if old is not None:
+        regressions = compare(old, results, args.threshold, args.noise)
+        if regressions:
+            print('{} regression(s) beyond {}%'.format(regressions, args.threshold))
+            exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -21,5 +21,10 @@ setup(name='traceworks',
       install_requires=[
           'tabulate', 'argparse'
       ],
+      extras_require={
+          'zstd': ['zstandard'],
+          'numpy': ['numpy'],
+          'parquet': ['numpy', 'pyarrow'],
+      },
       include_package_data=True,
       zip_safe=False)
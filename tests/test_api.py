@@ -0,0 +1,317 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import gzip
+import io
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import traceworks
+from traceworks import api
+from traceworks.api import Trace, TraceError
+from traceworks.gentrace import write_trace
+from traceworks.queries import QueryError
+from traceworks.utils import EventFilter
+
+# Trace against traceworks itself: ingest() against the tables of -g, from
+# paths, compressed traces and file objects, in threads and in the workers
+# of a pool, iter_events() against the parsed lines, and query() against
+# the SQL of its queries. And the errors each of them raises.
+here = os.path.dirname(os.path.abspath(__file__))
+command = os.path.join(os.path.dirname(here), 'traceworks', 'traceworks.py')
+
+def setUpModule():
+    global workdir, text, compressed, other, reference
+    logging.disable(logging.WARNING)
+    workdir = tempfile.mkdtemp()
+    text = os.path.join(workdir, 'trace.txt')
+    with open(text, 'w') as f:
+        write_trace(f, 40000, missing=0.01)
+    with open(text, 'rb') as f:
+        data = f.read()
+    compressed = os.path.join(workdir, 'trace.txt.gz')
+    g = gzip.open(compressed, 'wb')
+    g.write(data)
+    g.close()
+    other = os.path.join(workdir, 'other.txt')
+    with open(other, 'w') as f:
+        write_trace(f, 30000, seed=1)
+    reference = {}
+    for path in (text, other):
+        db = os.path.join(workdir, os.path.basename(path) + '.reference.db')
+        subprocess.check_call([sys.executable, command, path, db, '-g', '-e', '-I'],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        reference[path] = tables(db)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    shutil.rmtree(workdir)
+
+def tables(db):
+    # the rows of the tables of the trace, not those of the bookkeeping
+    conn = sqlite3.connect(db)
+    try:
+        names = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+                 if not r[0].startswith(('ingest_', 'query_cache', 'sched_intervals_rtree',
+                                         'sqlite_'))]
+        result = dict((t, sorted(conn.execute('SELECT * FROM ' + t).fetchall())) for t in names)
+        # the ids of the R*Tree are the rowids of the runs, which depend on
+        # the order the workers of -j store them in
+        if 'sched_intervals' in result:
+            result['sched_intervals_rtree'] = sorted(conn.execute(
+                'SELECT s.cpu, s.pid, s.start_ts, r.start_ts, r.end_ts, r.cpu_lo, r.cpu_hi '
+                'FROM sched_intervals s JOIN sched_intervals_rtree r ON r.id = s.rowid'
+            ).fetchall())
+        return result
+    finally:
+        conn.close()
+
+def ingested(job):
+    # the tables of an ingestion in a pool worker
+    return tables(api.ingest(job).db)
+
+class IngestTest(unittest.TestCase):
+    def setUp(self):
+        self.n = 0
+
+    def db(self):
+        self.n += 1
+        return os.path.join(workdir, '{}-{}.db'.format(self.id().rsplit('.', 1)[1], self.n))
+
+    def ingest(self, source, **options):
+        options = dict({'events': True, 'intervals': True}, **options)
+        t = Trace(source).ingest(self.db(), **options)
+        self.assertTrue(os.path.isfile(t.db))
+        return tables(t.db)
+
+    def test_reference(self):
+        self.assertEqual(sorted(reference[text]),
+                         ['cpu', 'event_names', 'events', 'process', 'sched_intervals',
+                          'sched_intervals_rtree', 'syscall_totals'])
+        for t, rows in reference[text].items():
+            self.assertTrue(rows, t)
+
+    def test_paths(self):
+        for path in (text, compressed):
+            for jobs in (1, 3):
+                self.assertEqual(self.ingest(path, jobs=jobs), reference[text], (path, jobs))
+
+    def test_file_objects(self):
+        # read line by line, in text or binary mode
+        for mode in ('r', 'rb'):
+            with open(text, mode) as f:
+                self.assertEqual(self.ingest(f), reference[text], mode)
+        with gzip.open(compressed, 'rb') as f:
+            self.assertEqual(self.ingest(f), reference[text])
+
+    def test_append(self):
+        with open(text, 'rb') as f:
+            data = f.read()
+        growing = os.path.join(workdir, 'growing.txt')
+        with open(growing, 'wb') as f:
+            f.write(data[:data.index(b'\n', len(data) // 3) + 1])
+        t = Trace(growing)
+        db = self.db()
+        t.ingest(db, append=True)
+        with open(growing, 'wb') as f:
+            f.write(data)
+        t.ingest(db, append=True)
+        expected = dict((k, v) for k, v in reference[text].items()
+                        if k in ('process', 'cpu', 'syscall_totals'))
+        self.assertEqual(dict((k, v) for k, v in tables(db).items() if k in expected), expected)
+
+    def test_stats(self):
+        t = Trace(text)
+        self.assertIsNone(t.stats)
+        t.ingest(self.db(), stats=True)
+        self.assertTrue(t.stats)
+        self.assertTrue(t.incomplete)
+        # a trace whose syscalls all have their exit
+        complete = os.path.join(workdir, 'complete.txt')
+        with open(complete, 'w') as f:
+            f.write('            bash-1003  [002] ..... 1000000.000603: sys_read(fd: 0xa, '
+                    'buf: 0x7ffd1234, count: 0x1000)\n'
+                    '            bash-1003  [002] ..... 1000000.001038: sys_read -> 0x682\n')
+        self.assertFalse(Trace(complete).ingest(self.db()).incomplete)
+        self.assertFalse(Trace(db=os.path.join(workdir, 'nosuch.db')).incomplete)
+
+    def test_threads(self):
+        # ingestions side by side keep their state apart
+        results = {}
+
+        def run(path, i):
+            results[i] = tables(Trace(path).ingest(os.path.join(workdir, 'thread-{}.db'.format(i)),
+                                                   events=True, intervals=True).db)
+
+        threads = [threading.Thread(target=run, args=(p, i))
+                   for i, p in enumerate([text, other, text, other])]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([results[i] for i in range(4)],
+                         [reference[text], reference[other]] * 2)
+
+    def test_pool(self):
+        # traceworks.ingest of (trace, db) and (trace, db, options), in the
+        # workers of a pool, which ingest with a single job each
+        options = {'events': True, 'intervals': True}
+        jobs = [(Trace(text), self.db(), options), (Trace(other), self.db(), options),
+                (Trace(compressed), self.db(), dict(options, jobs=4))]
+        pool = multiprocessing.Pool(2)
+        try:
+            results = pool.map(ingested, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(results, [reference[text], reference[other], reference[text]])
+
+        t = traceworks.ingest((Trace(other), self.db()))
+        self.assertTrue(t.queries)
+        self.assertEqual(pickle.loads(pickle.dumps(Trace(text, pids=[1003]))).filters,
+                         {'pids': [1003]})
+
+    def test_errors(self):
+        with self.assertRaises(TraceError):
+            Trace(os.path.join(workdir, 'nosuch.txt')).ingest(self.db())
+        with self.assertRaises(TraceError):
+            Trace().ingest(self.db())
+        with self.assertRaises(TraceError):
+            with open(text) as f:
+                Trace(f).ingest(self.db(), append=True)
+        with self.assertRaises(TraceError):
+            Trace(text, config=os.path.join(workdir, 'nosuch.json'))
+        with self.assertRaises(TraceError):
+            Trace(text, kind='nosuch')
+
+class EventsTest(unittest.TestCase):
+    def events(self, source, **filters):
+        return list(Trace(source, **filters).iter_events())
+
+    def test_sources(self):
+        events = self.events(text)
+        with open(text, 'rb') as f:
+            self.assertEqual(len(events), len([l for l in f if not l.startswith(b'#')]))
+        self.assertEqual(self.events(compressed), events)
+        for mode in ('r', 'rb'):
+            with open(text, mode) as f:
+                self.assertEqual(self.events(f), events, mode)
+        with open(text) as f:
+            self.assertEqual(self.events(io.StringIO(f.read()) if bytes is not str
+                                         else io.BytesIO(f.read())), events)
+
+    def test_filters(self):
+        # the events the filters let through are those of the parsed events
+        events = self.events(text)
+        for filters in ({'pids': [1003, 1028]}, {'cpus': [2], 'comms': ['bash', 'sshd']},
+                        {'start': 1000000100000, 'end': 1000000200000},
+                        {'allow': ['sys_read', 'sched_*']}, {'deny': ['sys_*']}):
+            keep = EventFilter(**filters)
+            expected = [e for e in events if keep.task(e.pid, e.cpu, e.process_name)
+                        and keep.window(e) and keep.allows(e.name)]
+            self.assertTrue(expected, filters)
+            for source in (text, compressed):
+                self.assertEqual(self.events(source, **filters), expected, (source, filters))
+
+    def test_tracedat(self):
+        # the events of a trace.dat are those of its text
+        dat = self.events(os.path.join(here, 'data', 'trace-v6.dat'))
+        kernel = self.events(os.path.join(here, 'data', 'trace.txt'))
+        self.assertEqual([(e.timestamp, e.cpu, e.name) for e in dat],
+                         [(e.timestamp, e.cpu, e.name) for e in kernel])
+
+    def test_errors(self):
+        with self.assertRaises(TraceError):
+            self.events(os.path.join(workdir, 'nosuch.txt'))
+        with self.assertRaises(TraceError):
+            self.events(workdir)
+
+class QueryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.trace = Trace(text).ingest(os.path.join(workdir, 'query.db'), intervals=True)
+
+    def sql(self, sql, *args):
+        conn = sqlite3.connect(self.trace.db)
+        try:
+            return conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+    def rows(self, *args, **options):
+        # the rows of a cache hit are lists
+        col_names, rows = self.trace.query(*args, **options)
+        return col_names, [tuple(r) for r in rows]
+
+    def test_names(self):
+        # by name and number, with arguments of any type, and the same
+        # from the cache
+        expected = self.sql('SELECT pid, name, SUM(duration) FROM process WHERE pid = ? '
+                            'GROUP BY name', 1003)
+        self.assertTrue(expected)
+        for q in ('syscall duration for a pid', 3, '3'):
+            for pid in (1003, '1003'):
+                col_names, rows = self.rows(q, pid)
+                self.assertEqual(col_names, ['pid', 'name', 'SUM(duration)'])
+                self.assertEqual(sorted(rows), sorted(expected), (q, pid))
+
+    def test_intervals(self):
+        start, end = self.sql('SELECT MIN(start_ts), MAX(end_ts) FROM sched_intervals')[0]
+        mid = (start + end) // 2
+        expected = self.sql('SELECT cpu, pid, comm, start_ts, end_ts FROM sched_intervals '
+                            'WHERE cpu = 3 AND start_ts <= ? AND end_ts > ?', mid, mid)
+        self.assertEqual(len(expected), 1)
+        self.assertEqual(self.rows('running at', 3, mid)[1], expected)
+
+    def test_db(self):
+        # a database without its trace, and the config of the Trace
+        t = Trace(db=self.trace.db)
+        col_names, rows = t.query('Top n syscalls', 4)
+        self.assertEqual((col_names, [tuple(r) for r in rows]), self.rows('Top n syscalls', 4))
+        self.assertEqual(t.query('process names')[0], ['pid', 'process_name'])
+
+    def test_errors(self):
+        with self.assertRaises(QueryError):
+            self.trace.query('nosuch')
+        with self.assertRaises(QueryError):
+            self.trace.query(len(self.trace.queries) + 1)
+        with self.assertRaises(QueryError):
+            self.trace.query('syscall duration for a pid')
+        with self.assertRaises(QueryError):
+            # a -T database it is not
+            self.trace.query('syscall duration', trace_id='web1')
+        with self.assertRaises(QueryError):
+            self.trace.query('Top n syscalls', 'x')
+        with self.assertRaises(TypeError):
+            self.trace.query('syscall duration', host='web1')
+        with self.assertRaises(TraceError):
+            Trace(text).query('syscall duration')
+        with self.assertRaises(TraceError):
+            Trace(db=os.path.join(workdir, 'nosuch.db')).query('syscall duration')
+        empty = os.path.join(workdir, 'empty.db')
+        sqlite3.connect(empty).close()
+        with self.assertRaises(TraceError):
+            Trace(db=empty).query('syscall duration')
+
+class PackageTest(unittest.TestCase):
+    def test_exports(self):
+        self.assertIs(traceworks.Trace, Trace)
+        self.assertIs(traceworks.TraceError, TraceError)
+        self.assertIs(traceworks.QueryError, QueryError)
+        self.assertIs(traceworks.ingest, api.ingest)
+        self.assertEqual(sorted(traceworks.__all__),
+                         ['QueryError', 'Trace', 'TraceError', 'TraceEvent', 'TraceUtil',
+                          'ingest'])
+        with self.assertRaises(AttributeError):
+            traceworks.nosuch
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from traceworks import queries
+from traceworks.api import Trace
+from traceworks.gentrace import write_trace
+
+here = os.path.dirname(os.path.abspath(__file__))
+traceworks = os.path.join(os.path.dirname(here), 'traceworks', 'traceworks.py')
+
+def run(*args):
+    # the output of a -q run, and what it says of the cache
+    p = subprocess.Popen([sys.executable, traceworks] + list(args),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode:
+        raise AssertionError('{} failed: {}'.format(args, err.decode('utf-8', 'replace')))
+    cache = [l.split(': cache ')[1].split(',')[0]
+             for l in err.decode('utf-8').splitlines() if ': cache ' in l]
+    return out.decode('utf-8'), cache
+
+def cached(db):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM query_cache').fetchone()[0]
+    finally:
+        conn.close()
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'trace.db')
+        self.text = os.path.join(self.dir, 'trace.txt')
+        with open(self.text, 'w') as f:
+            write_trace(f, 20000, missing=0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def query(self, *args):
+        return run(self.text, self.db, '-o', 'csv', '-q', *args)
+
+    def test_hit(self):
+        run(self.text, self.db, '-g')
+        out, cache = self.query('4', '6', '-a', '3')
+        self.assertEqual(cache, ['miss', 'miss'])
+        self.assertEqual(self.query('4', '6', '-a', '3'), (out, ['hit', 'hit']))
+
+        # other arguments are other results
+        self.assertEqual(self.query('6', '-a', '5')[1], ['miss'])
+        self.assertEqual(self.query('6', '-a', '5')[1], ['hit'])
+        self.assertEqual(cached(self.db), 3)
+
+        # --no-cache runs the query and says nothing of a cache
+        self.assertEqual(self.query('4', '6', '-a', '3', '--no-cache'), (out, []))
+
+    def test_served_from_cache(self):
+        # a hit comes out of query_cache, not the tables
+        run(self.text, self.db, '-g')
+        self.query('4')
+        conn = sqlite3.connect(self.db)
+        conn.execute("UPDATE query_cache SET rows = '[[\"sys_cached\", 1]]'")
+        conn.commit()
+        conn.close()
+        out, cache = self.query('4')
+        self.assertEqual(cache, ['hit'])
+        self.assertIn('sys_cached', out)
+
+    def test_generate(self):
+        # a -g run drops what was cached of the tables before it
+        run(self.text, self.db, '-g')
+        out, cache = self.query('4')
+        other = os.path.join(self.dir, 'other.txt')
+        with open(other, 'w') as f:
+            write_trace(f, 20000, seed=1)
+        run(other, self.db, '-g')
+        self.assertEqual(cached(self.db), 0)
+        changed, cache = run(other, self.db, '-o', 'csv', '-q', '4')
+        self.assertEqual(cache, ['miss'])
+        self.assertNotEqual(changed, out)
+
+    def test_append(self):
+        # and so does each -A run
+        with open(self.text, 'rb') as f:
+            data = f.read()
+        path = os.path.join(self.dir, 'growing.txt')
+        with open(path, 'wb') as f:
+            f.write(data[:data.index(b'\n', len(data) // 2) + 1])
+        run(path, self.db, '-g', '-A')
+        half, cache = run(path, self.db, '-o', 'csv', '-q', '4')
+        with open(path, 'wb') as f:
+            f.write(data)
+        run(path, self.db, '-g', '-A')
+        whole, cache = run(path, self.db, '-o', 'csv', '-q', '4')
+        self.assertEqual(cache, ['miss'])
+        self.assertNotEqual(whole, half)
+
+        reference = os.path.join(self.dir, 'reference.db')
+        run(self.text, reference, '-g')
+        self.assertEqual(whole, run(self.text, reference, '-o', 'csv', '-q', '4')[0])
+
+class GenerationTest(unittest.TestCase):
+    # what queries.run_query() does with the generation of the tables
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'trace.db')
+        trace = Trace(os.path.join(here, 'data', 'trace.txt')).ingest(self.db)
+        self.query = queries.find_query(trace.queries, 'syscall duration')
+        self.conn = sqlite3.connect(self.db)
+        self.conn.isolation_level = None
+        self.cursor = self.conn.cursor()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def run_query(self, generation, **options):
+        return queries.run_query(self.cursor, self.db, self.query, [], None, (), generation,
+                                 **options)
+
+    def test_ingesting(self):
+        # nothing is cached or served while the tables are being generated
+        self.cursor.execute('BEGIN')
+        queries.new_generation(self.cursor, True)
+        self.cursor.execute('COMMIT')
+        generation = queries.generation(self.cursor)
+        self.assertIsNone(generation)
+        self.assertEqual(self.run_query(generation)[2], None)
+        self.assertEqual(cached(self.db), 0)
+
+    def test_store(self):
+        generation = queries.generation(self.cursor)
+        col_names, rows, cache = self.run_query(generation, store=False)
+        self.assertEqual(cache, 'miss')
+        self.assertEqual(cached(self.db), 0)
+        self.assertEqual(self.run_query(generation), (col_names, rows, 'miss'))
+        self.assertEqual(self.run_query(generation), (col_names, [list(r) for r in rows],
+                                                      'hit'))
+
+    def test_too_many_rows(self):
+        generation = queries.generation(self.cursor)
+        limit = queries.cached_rows
+        queries.cached_rows = 1
+        try:
+            self.assertEqual(self.run_query(generation)[2], 'miss')
+            self.assertEqual(self.run_query(generation)[2], 'miss')
+        finally:
+            queries.cached_rows = limit
+        self.assertEqual(cached(self.db), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from traceworks import columnar
+
+# The percentile, histogram and top queries against what the same query
+# comes to in SQL, on a table whose columns are grouped on as they are, and
+# on copies of them shifted far apart. Those are too wide to be packed into
+# one key and go through the stacked keys of _groups() instead.
+wide = 1 << 40
+names = ['sys_read', 'sys_write', 'sys_openat', 'sys_close', 'sys_futex', 'sys_mmap']
+
+def setUpModule():
+    global workdir, db
+    workdir = tempfile.mkdtemp()
+    db = os.path.join(workdir, 'columns.db')
+    rnd = random.Random(0)
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE t (pid INTEGER, name TEXT, cpu INTEGER, duration INTEGER, '
+                 'ratio REAL, pid_wide INTEGER, cpu_wide INTEGER)')
+    rows = []
+    for i in range(5000):
+        pid = rnd.randrange(1000, 1030)
+        cpu = rnd.randrange(8)
+        # some of them 0, in the bucket below 1
+        duration = int(rnd.expovariate(1.0 / 2000)) if rnd.random() > 0.02 else 0
+        rows.append((pid, rnd.choice(names), cpu, duration, round(rnd.random(), 1),
+                     pid * wide, cpu * wide))
+    conn.executemany('INSERT INTO t VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+def tearDownModule():
+    shutil.rmtree(workdir)
+
+def condition(where, args):
+    if not where:
+        return '', []
+    return (' WHERE ' + ' AND '.join('{} = ?'.format(c) for c in sorted(where)),
+            [str(where[c]).format(*args) for c in sorted(where)])
+
+def log2_bucket(column):
+    # the power of two bucket of a value: 0 below 1, i for [2^(i-1), 2^i)
+    return '(' + ' + '.join('({} >= {})'.format(column, 1 << k) for k in range(63)) + ')'
+
+@unittest.skipIf(columnar.missing_module(), 'needs numpy')
+class ColumnarTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(db)
+        self.cursor = self.conn.cursor()
+
+    def tearDown(self):
+        self.conn.close()
+        columnar.remove(db)
+
+    def query(self, q, args=()):
+        return columnar.run_query(self.conn.cursor(), db, dict(q, table='t'), list(args))
+
+    def close(self, a, b, key):
+        self.assertAlmostEqual(a, b, delta=1e-6 * max(1, abs(b)), msg=key)
+
+    def sql_percentiles(self, by, where, args, percentiles):
+        cond, params = condition(where, args)
+        group = ', '.join(by) if by else "''"
+        result = {}
+        for r in self.cursor.execute('SELECT {}, COUNT(*) FROM t{} GROUP BY {}'.format(
+                group, cond, group), params).fetchall():
+            key, n = tuple(r[:-1]) if by else (), r[-1]
+            match = cond + (' AND ' if cond else ' WHERE ') + ' AND '.join(
+                '{} = ?'.format(b) for b in by) if by else cond
+            values = []
+            for p in percentiles:
+                # linear interpolation between the closest ranks
+                pos = (n - 1) * (p / 100.0)
+                lo = int(math.floor(pos))
+                v = [self.cursor.execute('SELECT duration FROM t{} ORDER BY duration '
+                                         'LIMIT 1 OFFSET ?'.format(match),
+                                         params + list(key) + [o]).fetchone()[0]
+                     for o in (lo, min(lo + 1, n - 1))]
+                values.append(v[0] + (v[1] - v[0]) * (pos - lo))
+            result[key] = (n, values)
+        return result
+
+    def check_percentile(self, by, where={}, args=(), percentiles=(50, 90, 99)):
+        q = {'kind': 'percentile', 'value': 'duration', 'by': by, 'where': where,
+             'percentiles': list(percentiles)}
+        names, rows = self.query(q, args)
+        self.assertEqual(names, by + ['count'] + ['p{}'.format(p) for p in percentiles])
+        expected = self.sql_percentiles(by, where, args, percentiles)
+        self.assertTrue(expected)
+        self.assertEqual(sorted(tuple(r[:len(by)]) for r in rows), sorted(expected))
+        for r in rows:
+            key = tuple(r[:len(by)])
+            n, values = expected[key]
+            self.assertEqual(r[len(by)], n, key)
+            for a, b in zip(r[len(by) + 1:], values):
+                self.close(a, b, key)
+
+    def test_percentile(self):
+        self.check_percentile(['name'])
+        self.check_percentile([])
+        self.check_percentile(['pid', 'name'], percentiles=(0, 25, 50, 75, 100))
+        self.check_percentile(['cpu'], {'name': '{0}'}, ['sys_read'])
+        self.check_percentile(['name'], {'pid': '{0}', 'cpu': '{1}'}, ['1003', '2'])
+
+    def test_percentile_stacked(self):
+        self.check_percentile(['pid_wide', 'cpu_wide'])
+        self.check_percentile(['pid_wide', 'name'])
+        self.check_percentile(['ratio', 'cpu'])
+
+    def check_histogram(self, by, bins=None, where={}, args=()):
+        q = {'kind': 'histogram', 'value': 'duration', 'by': by, 'where': where}
+        if bins:
+            q['bins'] = bins
+        names, rows = self.query(q, args)
+        self.assertEqual(names, by + ['low', 'high', 'count'])
+
+        cond, params = condition(where, args)
+        if bins:
+            lo, hi = self.cursor.execute('SELECT MIN(duration), MAX(duration) FROM t' + cond,
+                                         params).fetchone()
+            width = max((hi - lo) / float(bins), 1e-12)
+            bucket = 'MIN(CAST((duration - {}) / {!r} AS INTEGER), {})'.format(lo, width,
+                                                                              bins - 1)
+            edge = lambda b: (lo + b * width, lo + (b + 1) * width)
+        else:
+            bucket = log2_bucket('duration')
+            edge = lambda b: (0, 1) if b == 0 else (2 ** (b - 1), 2 ** b)
+        group = ', '.join(by + ['bucket'])
+        expected = [tuple(r[:-2]) + edge(r[-2]) + (r[-1],) for r in self.cursor.execute(
+            'SELECT {}, {} AS bucket, COUNT(*) FROM t{} GROUP BY {}'.format(
+                ', '.join(by) if by else '1', bucket, cond, group), params)]
+        if not by:
+            expected = [r[1:] for r in expected]
+        self.assertTrue(expected)
+        self.assertEqual(sorted(tuple(r) for r in rows), sorted(expected))
+
+    def test_histogram(self):
+        self.check_histogram([])
+        self.check_histogram(['name'])
+        self.check_histogram(['name', 'cpu'], bins=7)
+        self.check_histogram([], where={'name': '{0}'}, args=['sys_futex'])
+
+    def test_histogram_stacked(self):
+        self.check_histogram(['pid_wide', 'cpu_wide'])
+        self.check_histogram(['ratio'], bins=5)
+
+    def check_top(self, by, agg, n):
+        q = {'kind': 'top', 'value': 'duration', 'by': by, 'agg': agg, 'n': '{0}'}
+        names, rows = self.query(q, [str(n)])
+        self.assertEqual(names, by + ['{}(duration)'.format(agg)])
+        sql = {'sum': 'SUM(duration)', 'count': 'COUNT(*)', 'mean': 'AVG(duration)',
+               'min': 'MIN(duration)', 'max': 'MAX(duration)'}[agg]
+        # ties come in the order of the keys
+        expected = self.cursor.execute(
+            'SELECT {0}, {1} FROM t GROUP BY {0} ORDER BY {2} DESC, {0} LIMIT ?'.format(
+                ', '.join(by), sql, len(by) + 1), (n,)).fetchall()
+        self.assertEqual(len(rows), len(expected))
+        if agg == 'mean':
+            for r, e in zip(rows, expected):
+                self.assertEqual(r[:-1], e[:-1])
+                self.close(r[-1], e[-1], e)
+        else:
+            self.assertEqual([tuple(r) for r in rows], expected)
+
+    def test_top(self):
+        for agg in ('sum', 'count', 'mean', 'min', 'max'):
+            self.check_top(['pid'], agg, 10)
+            self.check_top(['pid', 'cpu'], agg, 1000)
+
+    def test_top_stacked(self):
+        for agg in ('sum', 'count', 'max'):
+            self.check_top(['pid_wide', 'cpu_wide'], agg, 25)
+
+    def test_groups(self):
+        # the stacked keys of the wide columns group and order the rows as
+        # the packed keys of the narrow ones do
+        import numpy as np
+        cols = columnar.Columns(self.cursor, db, 't')
+        mask = np.asarray(cols.column('duration')[0]) > 100
+        packed, keys = columnar._groups(np, cols, ['pid', 'cpu'], mask)
+        stacked, wide_keys = columnar._groups(np, cols, ['pid_wide', 'cpu_wide'], mask)
+        self.assertEqual(packed.tolist(), stacked.tolist())
+        self.assertEqual([(p * wide, c * wide) for p, c in keys], wide_keys)
+        self.assertEqual(keys, sorted(keys))
+
+    def test_export(self):
+        # the exported columns give what the table does
+        queries = [{'kind': 'percentile', 'value': 'duration', 'by': ['name', 'cpu']},
+                   {'kind': 'histogram', 'value': 'duration', 'by': ['pid_wide']},
+                   {'kind': 'top', 'value': 'duration', 'by': ['name'], 'n': 3}]
+        direct = [self.query(q) for q in queries]
+        formats = ['npy']
+        if not columnar.missing_module('parquet'):
+            formats.append('parquet')
+        for fmt in formats:
+            columnar.export(self.cursor, db, ['t'], fmt)
+            self.assertEqual([self.query(q) for q in queries], direct, fmt)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            self.query({'kind': 'median', 'value': 'duration'})
+        with self.assertRaises(ValueError):
+            self.query({'kind': 'top', 'value': 'duration', 'agg': 'mode'})
+        with self.assertRaises(KeyError):
+            self.query({'kind': 'top', 'value': 'nosuch'})
+
+if __name__ == '__main__':
+    unittest.main()
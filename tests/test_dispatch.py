@@ -0,0 +1,104 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import os
+import unittest
+from collections import namedtuple
+
+from traceworks.gentrace import write_trace
+from traceworks.reader import line_events
+from traceworks.utils import EventDispatch, EventFilter
+
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# all EventDispatch looks at of a config entry
+Entry = namedtuple('Entry', ['name'])
+
+def trace_lines():
+    # the lines of the kernel's text and of a synthetic trace, as bytes
+    with open(os.path.join(data, 'trace.txt'), 'rb') as f:
+        lines = f.read().splitlines()
+    f = io.StringIO() if bytes is not str else io.BytesIO()
+    write_trace(f, 20000, missing=0.01)
+    text = f.getvalue()
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return lines + text.splitlines()
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        self.entries = [Entry('sys_'), Entry('sys_read'), Entry('sched_switch')]
+
+    def test_substring(self):
+        # an entry applies to every event its name is a part of, in the
+        # order of the config
+        d = EventDispatch(self.entries)
+        sys_, read, switch = self.entries
+        self.assertEqual(d.lookup('sys_read'), (sys_, read))
+        self.assertEqual(d.lookup('sys_write'), (sys_,))
+        self.assertEqual(d.lookup('sched_switch'), (switch,))
+        self.assertEqual(d.lookup('sched_switch_x'), (switch,))
+        self.assertEqual(d.lookup('irq_handler_entry'), ())
+        self.assertIs(d.lookup('sys_read'), d.lookup('sys_read'))
+
+    def test_every_event(self):
+        # an empty name applies to everything, nothing is left unparsed
+        everything = Entry('')
+        d = EventDispatch(self.entries + [everything])
+        self.assertIsNone(d.pattern)
+        self.assertIsNone(d.text_pattern)
+        self.assertEqual(d.lookup('irq_handler_entry'), (everything,))
+
+    def test_allow(self):
+        d = EventDispatch(self.entries, EventFilter(allow=['sys_read', 'irq_handler_entry']))
+        self.assertEqual(d.lookup('sys_write'), ())
+        self.assertEqual(d.lookup('sys_read'), tuple(self.entries[:2]))
+        # the pattern is of the allowed events an entry applies to
+        self.assertIsNotNone(d.pattern.search(b'sys_read(fd: 3)'))
+        self.assertIsNone(d.pattern.search(b'sys_write(fd: 3)'))
+        self.assertIsNone(d.pattern.search(b'irq_handler_entry: irq=16'))
+
+    def test_deny(self):
+        d = EventDispatch(self.entries, EventFilter(deny=['sys_w*']))
+        self.assertEqual(d.lookup('sys_write'), ())
+        self.assertEqual(d.lookup('sys_read'), tuple(self.entries[:2]))
+
+    def test_nothing_allowed(self):
+        d = EventDispatch(self.entries, EventFilter(allow=['irq_handler_entry']))
+        self.assertIsNone(d.pattern.search(b'sys_read(fd: 3)'))
+        self.assertIsNone(d.text_pattern.search('sched_switch: prev_comm=bash'))
+        self.assertEqual(d.lookup('sys_read'), ())
+
+class PrefilterTest(unittest.TestCase):
+    # The lines the pattern leaves unparsed are those of events no entry
+    # would have been fed anyway
+    def fed(self, d, lines, pattern, text=False):
+        return [(parsed, d.lookup(parsed.name))
+                for parsed in line_events(lines, pattern, text=text) if d.lookup(parsed.name)]
+
+    def check(self, d):
+        lines = trace_lines()
+        whole = self.fed(d, lines, None)
+        self.assertTrue(whole)
+        self.assertEqual(self.fed(d, lines, d.pattern), whole)
+        text = [l.decode('utf-8') for l in lines]
+        self.assertEqual(self.fed(d, text, d.text_pattern, True), whole)
+
+    def test_config(self):
+        self.check(EventDispatch([Entry('sys_'), Entry('sched_switch')]))
+
+    def test_allow(self):
+        self.check(EventDispatch([Entry('sys_'), Entry('sched_switch')],
+                                 EventFilter(allow=['sys_read', 'sys_openat', 'cpu_idle'])))
+
+    def test_deny(self):
+        self.check(EventDispatch([Entry('sys_'), Entry('sched_switch')],
+                                 EventFilter(deny=['sys_c*'])))
+
+    def test_names_in_names(self):
+        # a name within another one, and one found in the buffers of other
+        # events rather than as their name
+        self.check(EventDispatch([Entry('read'), Entry('sys_read'), Entry('swapper')]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from traceworks.api import Trace
+from traceworks.gentrace import write_trace
+
+# The events table of --events against the events the trace parses into:
+# each of them once, with its name interned, read in one go, by --jobs or
+# by -A runs, and found through the indexes of (event, ts), (pid, ts) and
+# (cpu, ts).
+here = os.path.dirname(os.path.abspath(__file__))
+traceworks = os.path.join(os.path.dirname(here), 'traceworks', 'traceworks.py')
+
+def setUpModule():
+    global workdir, text, other, expected
+    logging.disable(logging.WARNING)
+    workdir = tempfile.mkdtemp()
+    text = os.path.join(workdir, 'trace.txt')
+    with open(text, 'w') as f:
+        write_trace(f, 60000, missing=0.01)
+    other = os.path.join(workdir, 'other.txt')
+    with open(other, 'w') as f:
+        write_trace(f, 20000, seed=1)
+    expected = parsed(text)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    shutil.rmtree(workdir)
+
+def parsed(path):
+    # every event, whether the config has an entry for it or not
+    return sorted((e.timestamp, e.cpu, e.pid, e.name, e.process_name, e.buf)
+                  for e in Trace(path).iter_events())
+
+def select(db, sql, *args):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+
+def stored(db):
+    return sorted(select(db, 'SELECT e.ts, e.cpu, e.pid, n.name, e.comm, e.buf '
+                             'FROM events e JOIN event_names n ON n.id = e.event'))
+
+class EventsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = os.path.join(workdir, self.id().rsplit('.', 1)[1] + '.db')
+
+    def test_events(self):
+        for jobs in (1, 3):
+            db = Trace(text).ingest(self.db, events=True, jobs=jobs).db
+            self.assertEqual(stored(db), expected, jobs)
+            # each name once, and the events of the config in their tables
+            names = select(db, 'SELECT name FROM event_names')
+            self.assertEqual(sorted(n for n, in names), sorted(set(e[3] for e in expected)))
+            self.assertEqual(select(db, 'SELECT COUNT(*) FROM events')[0][0], len(expected))
+            self.assertTrue(select(db, 'SELECT COUNT(*) FROM process')[0][0])
+
+    def test_types(self):
+        db = Trace(text).ingest(self.db, events=True).db
+        self.assertEqual(select(db, 'SELECT DISTINCT typeof(ts), typeof(cpu), typeof(pid), '
+                                    'typeof(event) FROM events'),
+                         [('integer',) * 4])
+
+    def test_indexes(self):
+        db = Trace(text).ingest(self.db, events=True).db
+        indexes = [n for n, in select(db, "SELECT name FROM sqlite_master WHERE type = 'index' "
+                                          "AND tbl_name = 'events'")]
+        self.assertEqual(sorted(indexes),
+                         ['events_cpu_ts_idx', 'events_event_ts_idx', 'events_pid_ts_idx'])
+        ts = expected[len(expected) // 2][0]
+        for column, index, value in (('pid', 'events_pid_ts_idx', 1003),
+                                     ('cpu', 'events_cpu_ts_idx', 2),
+                                     ('event', 'events_event_ts_idx', 1)):
+            sql = 'SELECT * FROM events WHERE {} = ? AND ts >= ?'.format(column)
+            plan = ' '.join(r[-1] for r in select(db, 'EXPLAIN QUERY PLAN ' + sql, value, ts))
+            self.assertIn(index, plan, column)
+            self.assertEqual(sorted(select(db, sql, value, ts)),
+                             sorted(select(db, 'SELECT * FROM events NOT INDEXED WHERE '
+                                               '{} = ? AND ts >= ?'.format(column), value, ts)))
+
+    def test_append(self):
+        # -A runs store the events they read on from, and no others twice
+        with open(text, 'rb') as f:
+            data = f.read()
+        growing = os.path.join(workdir, 'growing.txt')
+        t = Trace(growing)
+        for end in (len(data) // 3, len(data) * 2 // 3, len(data)):
+            with open(growing, 'wb') as f:
+                f.write(data[:data.index(b'\n', end - 1) + 1])
+            t.ingest(self.db, events=True, append=True)
+        self.assertEqual(stored(self.db), expected)
+        names = select(self.db, 'SELECT name FROM event_names')
+        self.assertEqual(len(names), len(set(names)))
+
+    def test_replaced(self):
+        # a run without -A leaves no events of the trace before it, nor
+        # any table of them without --events
+        Trace(other).ingest(self.db, events=True)
+        Trace(text).ingest(self.db, events=True)
+        self.assertEqual(stored(self.db), expected)
+        Trace(other).ingest(self.db)
+        self.assertEqual(select(self.db, "SELECT name FROM sqlite_master WHERE name IN "
+                                         "('events', 'event_names')"), [])
+
+    def test_sql(self):
+        # -s answers from the table, without the trace
+        Trace(text).ingest(self.db, events=True)
+        os.rename(text, text + '.moved')
+        try:
+            p = subprocess.Popen([sys.executable, traceworks, text, self.db, '-o', 'csv', '-s',
+                                  'SELECT pid, COUNT(*) FROM events GROUP BY pid'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        finally:
+            os.rename(text + '.moved', text)
+        self.assertEqual(p.returncode, 0, err)
+        counts = {}
+        for e in expected:
+            counts[e[2]] = counts.get(e[2], 0) + 1
+        lines = out.decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'pid,COUNT(*)')
+        self.assertEqual(dict((int(p), int(n)) for p, n in (l.split(',') for l in lines[1:])),
+                         counts)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import copy
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from traceworks import explain
+from traceworks.api import Trace, TraceError, default_config
+from traceworks.gentrace import write_trace
+
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+trace = os.path.join(data, 'trace.txt')
+traceworks = os.path.join(os.path.dirname(os.path.dirname(data)), 'traceworks', 'traceworks.py')
+
+def count(db, table):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+    finally:
+        conn.close()
+
+class CheckIndexesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'trace.db')
+        with open(default_config) as f:
+            self.config = json.load(f)
+        Trace(trace).ingest(self.db)
+        self.rows = count(self.db, 'process')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def entry(self, config):
+        return config['traceworks']['ftrace'][0]['config'][0]
+
+    def refused(self, config, message):
+        # the config is refused and the tables of the last run are kept
+        with self.assertRaises(TraceError) as e:
+            Trace(trace, config=config).ingest(self.db)
+        self.assertIn(message, str(e.exception))
+        self.assertEqual(count(self.db, 'process'), self.rows)
+
+    def test_column(self):
+        config = copy.deepcopy(self.config)
+        self.entry(config)['indexes'].append(['pid', 'nosuch'])
+        self.refused(config, 'which are not fields of it')
+
+    def test_where(self):
+        config = copy.deepcopy(self.config)
+        self.entry(config)['indexes'].append({'columns': ['pid'], 'where': 'nosuch > 1'})
+        self.refused(config, 'no such column: nosuch')
+
+    def test_aggregate(self):
+        config = copy.deepcopy(self.config)
+        self.entry(config)['summary_tables'][0]['columns'] = [['duration', 'SUMM(duration)']]
+        self.refused(config, 'no such function: SUMM')
+
+    def test_summary_index(self):
+        config = copy.deepcopy(self.config)
+        self.entry(config)['summary_tables'][0]['indexes'].append(['pid'])
+        self.refused(config, 'which are not columns of it')
+
+    def test_default_config(self):
+        # the shipped summary table is read off its index
+        conn = sqlite3.connect(self.db)
+        try:
+            queries = self.config['traceworks']['ftrace'][0]['queries']
+            rows = explain.explain(conn.cursor(), queries, ['3'])
+        finally:
+            conn.close()
+        totals = [r for r in rows if r[1] == 'Top n syscall totals'][0]
+        self.assertIn('COVERING INDEX', totals[2])
+        self.assertEqual(totals[3], '')
+
+class BuildTest(unittest.TestCase):
+    # the indexes and summary tables of the shipped config, however the
+    # trace is read, and what --explain says of its queries
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.WARNING)
+        cls.dir = tempfile.mkdtemp()
+        cls.text = os.path.join(cls.dir, 'trace.txt')
+        with open(cls.text, 'w') as f:
+            write_trace(f, 60000, missing=0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(cls.dir)
+
+    def select(self, db, sql):
+        conn = sqlite3.connect(db)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def totals(self, db):
+        # syscall_totals, and what its group-by of process comes to
+        return (sorted(self.select(db, 'SELECT name, duration FROM syscall_totals')),
+                sorted(self.select(db, 'SELECT name, SUM(duration) FROM process GROUP BY name')))
+
+    def test_indexes(self):
+        db = Trace(self.text).ingest(os.path.join(self.dir, 'indexes.db')).db
+        self.assertEqual(sorted(self.select(db, "SELECT tbl_name, sql FROM sqlite_master "
+                                                "WHERE type = 'index' AND sql IS NOT NULL")), [
+            ('process', 'CREATE INDEX process_name_duration_idx ON process (name,duration)'),
+            ('process', 'CREATE INDEX process_pid_name_duration_idx ON process '
+                        '(pid,name,duration)'),
+            ('process', "CREATE INDEX process_pid_process_name_partial_idx ON process "
+                        "(pid,process_name) WHERE process_name != '<...>'"),
+            ('syscall_totals', 'CREATE INDEX syscall_totals_duration_name_idx ON '
+                               'syscall_totals (duration,name)')])
+
+    def test_summary(self):
+        for name, options in (('serial', {}), ('jobs', {'jobs': 3}),
+                              ('memory', {'memory_limit': 1})):
+            db = Trace(self.text).ingest(os.path.join(self.dir, name + '.db'), **options).db
+            totals, expected = self.totals(db)
+            self.assertTrue(expected, name)
+            self.assertEqual(totals, expected, name)
+
+        # -A runs bring the totals up to date with the rows they add
+        with open(self.text, 'rb') as f:
+            content = f.read()
+        path = os.path.join(self.dir, 'growing.txt')
+        db = os.path.join(self.dir, 'append.db')
+        for end in (len(content) // 2, len(content)):
+            with open(path, 'wb') as f:
+                f.write(content[:content.index(b'\n', end - 1) + 1])
+            Trace(path).ingest(db, append=True)
+            totals, expected = self.totals(db)
+            self.assertEqual(totals, expected, end)
+
+    def test_command(self):
+        # a line of each query, the per-pid one read off its index, and no
+        # index made along the way
+        db = Trace(self.text).ingest(os.path.join(self.dir, 'explain.db')).db
+        schema = self.select(db, 'SELECT sql FROM sqlite_master')
+        p = subprocess.Popen([sys.executable, traceworks, self.text, db, '--explain', '-o', 'csv'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        out = out.decode('utf-8')
+        with open(default_config) as f:
+            queries = json.load(f)['traceworks']['ftrace'][0]['queries']
+        for q in queries:
+            self.assertIn(q['name'], out)
+        per_pid = [l for l in out.splitlines() if 'syscall duration for a pid' in l][0]
+        self.assertIn('SEARCH process USING COVERING INDEX process_pid_name_duration_idx',
+                      per_pid)
+        self.assertEqual(self.select(db, 'SELECT sql FROM sqlite_master'), schema)
+
+class AdviseTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.cursor = self.conn.cursor()
+        self.cursor.execute('CREATE TABLE process (pid INTEGER, name TEXT, duration INTEGER)')
+        self.columns = {'process': ['pid', 'name', 'duration']}
+
+    def tearDown(self):
+        self.conn.close()
+
+    def found(self, sql):
+        return explain.problems(explain.plan(self.cursor, sql), sql, ['process'])
+
+    def test_scan(self):
+        sql = 'SELECT name, SUM(duration) FROM process WHERE pid=3 GROUP BY name'
+        found = self.found(sql)
+        self.assertEqual(found, [('process', None), (None, 'GROUP BY')])
+        index = explain.advise(self.cursor, sql, found, self.columns)
+        self.assertEqual(index, ('process', ['pid', 'name', 'duration']))
+
+        # with the suggested index there is nothing left to flag
+        self.cursor.execute('CREATE INDEX i ON process (pid, name, duration)')
+        self.assertEqual(self.found(sql), [])
+
+    def test_order(self):
+        sql = 'SELECT name, duration FROM process ORDER BY duration DESC LIMIT 3'
+        index = explain.advise(self.cursor, sql, self.found(sql), self.columns)
+        self.assertEqual(index, ('process', ['duration', 'name']))
+
+    def test_nothing_better(self):
+        # a scan of every row is what this query is, no index helps
+        sql = 'SELECT * FROM process'
+        self.assertIsNone(explain.advise(self.cursor, sql, self.found(sql), self.columns))
+
+    def test_schema_untouched(self):
+        sql = 'SELECT name FROM process WHERE pid=3'
+        explain.advise(self.cursor, sql, self.found(sql), self.columns)
+        self.assertEqual(self.cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='index'").fetchone()[0], 0)
+
+if __name__ == '__main__':
+    unittest.main()
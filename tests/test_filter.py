@@ -0,0 +1,145 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from traceworks.api import Trace
+from traceworks.gentrace import write_trace
+from traceworks.utils import EventFilter, parsebytes
+
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+tables = ('process', 'cpu')
+
+# The filters of --pid, --cpu, --comm and --from/--to on a synthetic trace:
+# comms with a '-' in them, pids which are the start of others and CPUs
+# written with leading zeros.
+filters = [
+    {'pids': [1003, 1028]},
+    {'pids': [100, 1003]},
+    {'cpus': [1, 3]},
+    {'comms': ['gnome-shell', 'kworker/0:1']},
+    {'comms': ['<idle>']},
+    {'pids': [1003, 1005, 1028], 'cpus': [0, 2, 5], 'comms': ['sshd', 'systemd', 'bash']},
+    {'start': 1000000100000, 'end': 1000000300000},
+    {'pids': [1028], 'start': 1000000150000},
+]
+
+def setUpModule():
+    global workdir, text, lines
+    logging.disable(logging.WARNING)
+    workdir = tempfile.mkdtemp()
+    text = os.path.join(workdir, 'trace.txt')
+    with open(text, 'w') as f:
+        write_trace(f, 100000, missing=0.01)
+    with open(text, 'rb') as f:
+        lines = f.read().splitlines(True)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    shutil.rmtree(workdir)
+
+def rows(db):
+    conn = sqlite3.connect(db)
+    try:
+        return dict((t, sorted(conn.execute('SELECT * FROM ' + t).fetchall()))
+                    for t in tables)
+    finally:
+        conn.close()
+
+def kept(keep, lines):
+    # what filtering the parsed events gives: the lines of the events of
+    # the tasks, CPUs and time window, and the lines which do not parse
+    out = []
+    for l in lines:
+        parsed = parsebytes(l, 0, len(l))
+        if parsed is None or (keep.task(parsed.pid, parsed.cpu, parsed.process_name)
+                              and keep.window(parsed)):
+            out.append(l)
+    return out
+
+class RawLineTest(unittest.TestCase):
+    # the regex on the raw line picks the lines of the same tasks as the
+    # fields of the parsed event
+    def check(self, lines, **options):
+        keep = EventFilter(**options)
+        n = 0
+        for l in lines:
+            parsed = parsebytes(l, 0, len(l))
+            if parsed is None:
+                continue
+            task = keep.task(parsed.pid, parsed.cpu, parsed.process_name)
+            self.assertEqual(keep.raw(l), task, (options, l))
+            self.assertEqual(keep.raw_text(l.decode('utf-8')), task, (options, l))
+            n += task
+        self.assertTrue(n, options)
+
+    def test_synthetic(self):
+        for options in filters:
+            if 'start' not in options:
+                self.check(lines, **options)
+
+    def test_kernel(self):
+        # the tasks of the recording of a real kernel, comms with spaces
+        with open(os.path.join(data, 'trace.txt'), 'rb') as f:
+            kernel = f.read().splitlines()
+        self.check(kernel, pids=[0, 11069])
+        self.check(kernel, comms=['cat'])
+        self.check(kernel, comms=['Bun Pool 1', 'mi-scavenger'])
+        self.check(kernel, cpus=[0], comms=['<idle>', 'Bun Pool 0'])
+
+    def test_no_task_filter(self):
+        keep = EventFilter(start=1, end=2)
+        self.assertIsNone(keep.line)
+        self.assertTrue(keep.raw(lines[-1]))
+
+class IngestTest(unittest.TestCase):
+    # ingesting with a filter gives the tables of the trace filtered after
+    # the lines are parsed, serial and with --jobs
+    def ingest(self, path, name, **options):
+        return rows(Trace(path, **options).ingest(os.path.join(workdir, name)).db)
+
+    def write(self, name, content):
+        path = os.path.join(workdir, name)
+        with open(path, 'wb') as f:
+            f.write(b''.join(content))
+        return path
+
+    def test_filters(self):
+        for i, options in enumerate(filters):
+            keep = EventFilter(**options)
+            reference = self.ingest(self.write('kept-{}.txt'.format(i), kept(keep, lines)),
+                                    'kept-{}.db'.format(i))
+            self.assertTrue(reference['process'] or reference['cpu'], options)
+            for jobs in (1, 4):
+                db = 'filtered-{}-{}.db'.format(i, jobs)
+                self.assertEqual(self.ingest(text, db, **options), reference, (options, jobs))
+
+    def test_compressed(self):
+        path = os.path.join(workdir, 'trace.gz')
+        g = gzip.open(path, 'wb')
+        g.write(b''.join(lines))
+        g.close()
+        options = filters[5]
+        reference = self.ingest(self.write('kept.txt', kept(EventFilter(**options), lines)),
+                                'kept.db')
+        self.assertEqual(self.ingest(path, 'gz.db', **options), reference)
+
+    def test_tracedat(self):
+        # the events of a trace.dat are filtered by their fields
+        with open(os.path.join(data, 'trace.txt'), 'rb') as f:
+            kernel = f.read().splitlines(True)
+        for i, options in enumerate(({'comms': ['cat', 'Bun Pool 0']}, {'pids': [0, 18250]})):
+            keep = EventFilter(**options)
+            reference = self.ingest(self.write('kernel.txt', kept(keep, kernel)),
+                                    'kernel-{}.db'.format(i))
+            self.assertTrue(reference['process'] or reference['cpu'], options)
+            self.assertEqual(self.ingest(os.path.join(data, 'trace-v6.dat'), 'dat-{}.db'.format(i),
+                                         **options), reference, options)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unittest
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from traceworks.api import Trace
+from traceworks.gentrace import write_trace
+
+# The ways of reading a trace which must all come to the same tables as a
+# plain serial run: --jobs, the eviction of -m, compressed input and -A
+# runs carried on from where the last one stopped. The synthetic trace is
+# long enough for a few -m flushes and misses some events, so that the
+# entries without an exit are spread over the chunks as well.
+lines = 150000
+tables = ('process', 'cpu')
+
+def setUpModule():
+    global workdir, text, data, reference
+    # the first mismatch of every run would be logged
+    logging.disable(logging.WARNING)
+    workdir = tempfile.mkdtemp()
+    text = os.path.join(workdir, 'trace.txt')
+    with open(text, 'w') as f:
+        write_trace(f, lines, missing=0.01)
+    with open(text, 'rb') as f:
+        data = f.read()
+    reference = rows(Trace(text).ingest(os.path.join(workdir, 'reference.db')).db)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    shutil.rmtree(workdir)
+
+def rows(db):
+    conn = sqlite3.connect(db)
+    try:
+        return dict((t, sorted(conn.execute('SELECT * FROM ' + t).fetchall()))
+                    for t in tables)
+    finally:
+        conn.close()
+
+def intervals(db):
+    # the runs of sched_intervals, and whether the R*Tree has each of them
+    conn = sqlite3.connect(db)
+    try:
+        runs = sorted(conn.execute('SELECT cpu, pid, comm, start_ts, end_ts '
+                                   'FROM sched_intervals').fetchall())
+        indexed = conn.execute('SELECT COUNT(*) FROM sched_intervals s JOIN '
+                               'sched_intervals_rtree r ON r.id = s.rowid').fetchone()[0]
+        return runs, indexed == len(runs)
+    finally:
+        conn.close()
+
+def bgzf(data):
+    # what bgzip(1) writes: gzip members of at most 64k of input, the size
+    # of each in its 'BC' extra subfield, and the empty member at the end
+    out = []
+    for i in range(0, len(data) + 1, 0xff00):
+        block = data[i:i + 0xff00]
+        c = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = c.compress(block) + c.flush()
+        out.append(struct.pack('<BBBBIBBHBBHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                               ord('B'), ord('C'), 2, len(deflated) + 25))
+        out.append(deflated)
+        out.append(struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block)))
+    return b''.join(out)
+
+def zstd_frames(data):
+    c = zstandard.ZstdCompressor()
+    return b''.join(c.compress(data[i:i + (1 << 20)])
+                    for i in range(0, len(data), 1 << 20))
+
+class IngestTest(unittest.TestCase):
+    def setUp(self):
+        self.n = 0
+
+    def ingest(self, path, **options):
+        self.n += 1
+        db = os.path.join(workdir, '{}-{}.db'.format(self.id().rsplit('.', 1)[1], self.n))
+        return rows(Trace(path).ingest(db, **options).db)
+
+    def write(self, name, content):
+        path = os.path.join(workdir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def check(self, path, **options):
+        for jobs in (1, 4):
+            self.assertEqual(self.ingest(path, jobs=jobs, **options), reference,
+                             'jobs={}'.format(jobs))
+
+    def test_reference(self):
+        for t in tables:
+            self.assertTrue(reference[t], t)
+
+    def test_jobs(self):
+        for jobs in (2, 4, 7):
+            self.assertEqual(self.ingest(text, jobs=jobs), reference, 'jobs={}'.format(jobs))
+
+    def test_memory_limit(self):
+        # 1 MiB is always over, every check of it evicts
+        self.check(text, memory_limit=1)
+
+    def test_gzip(self):
+        with open(text, 'rb') as f:
+            g = gzip.open(os.path.join(workdir, 'trace.gz'), 'wb')
+            g.write(f.read())
+            g.close()
+        self.check(os.path.join(workdir, 'trace.gz'))
+
+    def test_bgzf(self):
+        self.check(self.write('trace.bgz', bgzf(data)))
+
+    @unittest.skipIf(lzma is None, 'needs lzma')
+    def test_xz(self):
+        self.check(self.write('trace.xz', lzma.compress(data)))
+
+    @unittest.skipIf(zstandard is None, 'needs zstandard')
+    def test_zstd(self):
+        self.check(self.write('trace.zst', zstd_frames(data)))
+
+    def test_append(self):
+        # The trace grows under -A runs, cut in the middle of lines where
+        # what was written of them would parse into something else: an
+        # exit cut in its '->' and a timestamp cut short
+        arrow = data.index(b' -> ', len(data) // 3) + 2
+        line = data.index(b'\n', len(data) // 2) + 1
+        stamp = data.index(b': ', line) - 2
+        cuts = [arrow, stamp, len(data)]
+        for jobs in (1, 4):
+            path = os.path.join(workdir, 'append-{}.txt'.format(jobs))
+            db = os.path.join(workdir, 'append-{}.db'.format(jobs))
+            for c in cuts:
+                self.write(path, data[:c])
+                Trace(path).ingest(db, jobs=jobs, append=True)
+            self.assertEqual(rows(db), reference, 'jobs={}'.format(jobs))
+
+    def test_append_intervals(self):
+        # the runs still going at the end of each -A run carry on into the
+        # next one, rather than being split where the runs stopped
+        whole = intervals(Trace(text).ingest(os.path.join(workdir, 'intervals.db'),
+                                             intervals=True).db)
+        cuts = [len(data) // 4, len(data) // 2, 3 * len(data) // 4, len(data)]
+        for jobs in (1, 4):
+            path = os.path.join(workdir, 'intervals-{}.txt'.format(jobs))
+            db = os.path.join(workdir, 'intervals-{}.db'.format(jobs))
+            for c in cuts:
+                self.write(path, data[:c])
+                Trace(path).ingest(db, jobs=jobs, append=True, intervals=True)
+            self.assertEqual(intervals(db), whole, 'jobs={}'.format(jobs))
+
+if __name__ == '__main__':
+    unittest.main()
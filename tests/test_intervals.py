@@ -0,0 +1,144 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from traceworks.api import Trace
+from traceworks.gentrace import write_trace
+
+# The runs of --intervals against the run time of each task worked out
+# from the sched_switch events themselves, and the queries on them against
+# the same questions asked of those runs.
+here = os.path.dirname(os.path.abspath(__file__))
+next_task = re.compile(r'next_comm=(\S*) next_pid=(\d+)')
+
+def setUpModule():
+    global workdir, text, events, expected
+    logging.disable(logging.WARNING)
+    workdir = tempfile.mkdtemp()
+    text = os.path.join(workdir, 'trace.txt')
+    with open(text, 'w') as f:
+        write_trace(f, 50000)
+    events = list(Trace(text).iter_events())
+    expected = runs(events)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    shutil.rmtree(workdir)
+
+def runs(events):
+    # each sched_switch ends the run on its CPU and starts that of the next
+    # task, the runs still going end with the last sched_switch
+    running = {}
+    rows = []
+    last = None
+    for e in events:
+        if e.name != 'sched_switch':
+            continue
+        if e.cpu in running:
+            rows.append((e.cpu,) + running[e.cpu] + (e.timestamp,))
+        comm, pid = next_task.search(e.buf).groups()
+        running[e.cpu] = (int(pid), comm, e.timestamp)
+        last = e.timestamp if last is None else max(last, e.timestamp)
+    for cpu, run in running.items():
+        if run[2] < last:
+            rows.append((cpu,) + run + (last,))
+    return sorted(rows)
+
+def select(db, sql, *args):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+
+class IntervalsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.trace = Trace(text).ingest(os.path.join(workdir, 'intervals.db'), intervals=True)
+        cls.db = cls.trace.db
+
+    def test_runs(self):
+        self.assertTrue(expected)
+        self.assertEqual(sorted(select(self.db, 'SELECT cpu, pid, comm, start_ts, end_ts '
+                                                'FROM sched_intervals')), expected)
+        # every run can be found through the R*Tree
+        self.assertEqual(select(self.db, 'SELECT COUNT(*) FROM sched_intervals s JOIN '
+                                         'sched_intervals_rtree r ON r.id = s.rowid')[0][0],
+                         len(expected))
+
+    def test_jobs(self):
+        for jobs in (2, 5):
+            db = Trace(text).ingest(os.path.join(workdir, 'jobs-{}.db'.format(jobs)),
+                                    intervals=True, jobs=jobs).db
+            self.assertEqual(sorted(select(db, 'SELECT cpu, pid, comm, start_ts, end_ts '
+                                               'FROM sched_intervals')), expected, jobs)
+
+    def test_run_time(self):
+        # the run time of each task
+        total = {}
+        for cpu, pid, comm, start, end in expected:
+            total[pid] = total.get(pid, 0) + end - start
+        self.assertEqual(dict(select(self.db, 'SELECT pid, SUM(end_ts - start_ts) '
+                                              'FROM sched_intervals GROUP BY pid')), total)
+
+    def test_idle_time(self):
+        # the idle runs up to the switch to a task are the idle_time of the
+        # cpu table: a switch from idle to idle keeps the entry it has, and
+        # the idle runs no task came after are not counted
+        for i, path in enumerate((text, os.path.join(here, 'data', 'trace.txt'))):
+            db = Trace(path).ingest(os.path.join(workdir, 'idle-{}.db'.format(i)),
+                                    intervals=True).db
+            idle = {}
+            streak = {}
+            for cpu, pid, start, end in select(db, 'SELECT cpu, pid, start_ts, end_ts FROM '
+                                                   'sched_intervals ORDER BY cpu, start_ts'):
+                if pid == 0:
+                    streak[cpu] = streak.get(cpu, 0) + end - start
+                elif cpu in streak:
+                    idle[cpu] = idle.get(cpu, 0) + streak.pop(cpu)
+            self.assertTrue(idle, path)
+            self.assertEqual(dict(select(db, 'SELECT cpu, idle_time FROM cpu')), idle, path)
+
+    def test_running_at(self):
+        rnd = random.Random(0)
+        for i in range(200):
+            cpu = rnd.randrange(8)
+            ts = rnd.randrange(expected[0][3] - 1000, expected[-1][4] + 1000)
+            at = [r for r in expected if r[0] == cpu and r[3] <= ts < r[4]]
+            cols, rows = self.trace.query('running at', cpu, ts)
+            self.assertEqual([tuple(r) for r in rows], at, (cpu, ts))
+
+    def test_running_in_window(self):
+        rnd = random.Random(1)
+        for i in range(50):
+            start = rnd.randrange(expected[0][3], expected[-1][4])
+            end = start + rnd.randrange(1, 20000)
+            window = [r for r in expected if r[3] < end and r[4] > start]
+            cols, rows = self.trace.query('running in window', start, end)
+            self.assertEqual(sorted(tuple(r) for r in rows), sorted(window), (start, end))
+
+    def test_occupancy(self):
+        start = expected[0][3] + 12345
+        end = start + 100000
+        step = 7000
+        busy = {}
+        for b in range(start, end, step):
+            e = min(b + step, end)
+            for cpu, pid, comm, s, t in expected:
+                if pid != 0 and s < e and t > b:
+                    busy[(cpu, b)] = busy.get((cpu, b), 0) + min(t, e) - max(s, b)
+        cols, rows = self.trace.query('cpu occupancy', start, end, step)
+        self.assertEqual(sorted((cpu, b) for cpu, b, p in rows), sorted(busy))
+        for cpu, b, p in rows:
+            e = min(b + step, end)
+            self.assertAlmostEqual(p, busy[(cpu, b)] * 100.0 / (e - b))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,260 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import csv
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from traceworks import output
+from traceworks.api import Trace
+from traceworks.gentrace import write_trace
+from traceworks.output import OutputError, ResultWriter
+
+# What each --output writes, read back against the rows of the result: on
+# rows of every type SQLite has, on more rows than are written at a time,
+# and through -q and -s. Those rows are written as they are fetched.
+here = os.path.dirname(os.path.abspath(__file__))
+traceworks = os.path.join(os.path.dirname(here), 'traceworks', 'traceworks.py')
+text_type = type(u'')
+n = output.batch_rows * 2 + 17
+
+def setUpModule():
+    global workdir, path, db, rows
+    logging.disable(logging.WARNING)
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'trace.txt')
+    with open(path, 'w') as f:
+        write_trace(f, 50000, missing=0.01)
+    db = Trace(path).ingest(os.path.join(workdir, 'trace.db')).db
+    # the values of a result: integers, floats, text with what csv quotes,
+    # NULLs, BLOBs and a column of several types, over a few batches
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE values_ (i INTEGER, f REAL, t TEXT, b BLOB, mixed, nulls)')
+    conn.executemany('INSERT INTO values_ VALUES (?, ?, ?, ?, ?, ?)', [
+        (i, i / 7.0, u'sys_read, "{}"\n\u00e9'.format(i) if i % 3 else u'',
+         sqlite3.Binary(bytearray([i % 256, 0, 255])) if i % 5 else None,
+         [i, i * 0.5, u'x{}'.format(i)][i % 3], None) for i in range(n)])
+    conn.commit()
+    conn.close()
+    rows = select('SELECT * FROM values_')
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    shutil.rmtree(workdir)
+
+def select(sql):
+    conn = sqlite3.connect(db)
+    try:
+        return [tuple(r) for r in conn.execute(sql)]
+    finally:
+        conn.close()
+
+def plain(v):
+    # a value as csv and jsonl write it
+    if isinstance(v, output.blobs):
+        return output._hex(v)
+    return v
+
+class Sink(object):
+    # a file which is written to, and what it holds along the way
+    def __init__(self):
+        self.parts = []
+
+    def write(self, s):
+        self.parts.append(s)
+
+    def flush(self):
+        pass
+
+    def value(self):
+        return ''.join(p.decode('utf-8') if isinstance(p, bytes) and bytes is not str else p
+                       for p in self.parts)
+
+def written(fmt, *results):
+    sink = Sink()
+    w = ResultWriter(fmt)
+    w.f = sink
+    for col_names, rows in results:
+        w.write(col_names, iter(rows))
+    return sink.value()
+
+def read_csv(text):
+    if bytes is str:
+        text = text.encode('utf-8') if isinstance(text, text_type) else text
+        return [[c.decode('utf-8') for c in r] for r in csv.reader(io.BytesIO(text))]
+    return list(csv.reader(io.StringIO(text)))
+
+def csv_text(v):
+    # what a value reads back as from csv
+    v = plain(v)
+    if v is None:
+        return u''
+    if isinstance(v, float):
+        return text_type(repr(v))
+    return text_type(v)
+
+columns = ['i', 'f', 't', 'b', 'mixed', 'nulls']
+
+class WriterTest(unittest.TestCase):
+    def test_csv(self):
+        lines = read_csv(written('csv', (columns, rows)))
+        self.assertEqual(lines[0], columns)
+        self.assertEqual(lines[1:], [[csv_text(v) for v in r] for r in rows])
+
+    def test_csv_results(self):
+        # several results follow each other, a blank line apart
+        text = written('csv', (['a'], [(1,), (2,)]), (['b', 'c'], []), (['d'], [(u'x',)]))
+        self.assertEqual(text, 'a\n1\n2\n\nb,c\n\nd\nx\n')
+
+    def test_jsonl(self):
+        lines = written('jsonl', (columns, rows)).splitlines()
+        self.assertEqual([json.loads(l) for l in lines],
+                         [dict(zip(columns, [plain(v) for v in r])) for r in rows])
+
+    def test_streamed(self):
+        # each batch is written before the next one is fetched
+        for fmt in ('csv', 'jsonl'):
+            sink = Sink()
+            w = ResultWriter(fmt)
+            w.f = sink
+
+            def fetched():
+                for i, r in enumerate(rows):
+                    if i and i % output.batch_rows == 0:
+                        text = sink.value()
+                        lines = len(read_csv(text)) - 1 if fmt == 'csv' else text.count('\n')
+                        self.assertEqual(lines, i, fmt)
+                    yield r
+
+            w.write(columns, fetched())
+
+    def test_notice(self):
+        # only the table of stdout has the notes with the rows
+        for fmt, target in (('table', None), ('csv', None), ('table', 'out.txt')):
+            p = subprocess.Popen([sys.executable, '-c', 'from traceworks.output import '
+                                  'ResultWriter; ResultWriter({!r}, {!r}).notice("note")'.format(
+                                      fmt, target and os.path.join(workdir, target))],
+                                 cwd=os.path.dirname(here), stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            out, err = p.communicate()
+            self.assertEqual((out.strip(), err.strip()),
+                             (b'note', b'') if target is None and fmt == 'table'
+                             else (b'', b'note'), fmt)
+
+@unittest.skipIf(output.missing_module('arrow'), 'needs pyarrow')
+class ArrowTest(unittest.TestCase):
+    def read(self, data):
+        import pyarrow as pa
+        return pa.ipc.open_stream(pa.BufferReader(data)).read_all()
+
+    def arrow(self, col_names, rows):
+        sink = io.BytesIO()
+        w = ResultWriter('arrow')
+        w.f = sink
+        w.write(col_names, iter(rows))
+        return sink.getvalue(), w
+
+    def test_types(self):
+        # the types of the values of the first batch; no values are strings
+        data, w = self.arrow(columns[:4] + ['nulls'], [r[:4] + r[5:] for r in rows])
+        table = self.read(data)
+        self.assertEqual([str(t) for t in table.schema.types],
+                         ['int64', 'double', 'string', 'binary', 'string'])
+        self.assertEqual([tuple(r.values()) for r in table.to_pylist()],
+                         [tuple(bytes(v) if isinstance(v, output.blobs) else v for v in r[:4])
+                          + (None,) for r in rows])
+        self.assertEqual(len(table.to_batches()), 3)
+
+        data, w = self.arrow(['x'], [(1,), (2.5,), (None,)])
+        self.assertEqual(self.read(data).column(0).to_pylist(), [1.0, 2.5, None])
+
+    def test_errors(self):
+        data, w = self.arrow(['x'], [(1,)])
+        with self.assertRaises(OutputError):
+            w.write(['x'], iter([(1,)]))
+        # a later batch whose values do not fit the types of the first
+        with self.assertRaises(OutputError):
+            self.arrow(['x'], [(i,) for i in range(output.batch_rows)] + [(u'x',)])
+
+    def test_empty(self):
+        data, w = self.arrow(['a', 'b'], [])
+        table = self.read(data)
+        self.assertEqual(table.column_names, ['a', 'b'])
+        self.assertEqual(table.num_rows, 0)
+
+class CommandTest(unittest.TestCase):
+    # -o of -q and -s
+    def run_traceworks(self, *args):
+        p = subprocess.Popen([sys.executable, traceworks, path, db] + list(args),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return p.returncode, out, err.decode('utf-8')
+
+    def written(self, *args):
+        code, out, err = self.run_traceworks(*args)
+        self.assertEqual(code, 0, err)
+        return out
+
+    def test_sql(self):
+        expected = select('SELECT * FROM values_')
+        out = self.written('-s', 'SELECT * FROM values_', '-o', 'csv').decode('utf-8')
+        self.assertEqual(read_csv(out)[1:], [[csv_text(v) for v in r] for r in expected])
+        out = self.written('-s', 'SELECT * FROM values_', '-o', 'jsonl').decode('utf-8')
+        self.assertEqual([json.loads(l) for l in out.splitlines()],
+                         [dict(zip(columns, [plain(v) for v in r])) for r in expected])
+
+    def test_query(self):
+        # the rows of the query, and its disclaimer on stderr
+        expected = select('SELECT pid, name, SUM(duration) FROM process GROUP BY pid, name')
+        code, out, err = self.run_traceworks('-q', '4', '-o', 'csv')
+        self.assertEqual(code, 0, err)
+        self.assertIn('Incomplete trace', err)
+        lines = read_csv(out.decode('utf-8'))
+        self.assertEqual(lines[0], ['pid', 'name', 'sum(duration)'])
+        self.assertEqual(sorted(lines[1:]), sorted([csv_text(v) for v in r] for r in expected))
+
+        # and the same in a file, with nothing on stdout
+        target = os.path.join(workdir, 'out.jsonl')
+        self.assertEqual(self.written('-q', '4', '-o', 'jsonl', '--output-file', target), b'')
+        with open(target) as f:
+            self.assertEqual(sorted(tuple(d[c] for c in lines[0])
+                                    for d in (json.loads(l) for l in f)), sorted(expected))
+
+    @unittest.skipIf(output.missing_module('arrow'), 'needs pyarrow')
+    def test_arrow_one_result(self):
+        code, out, err = self.run_traceworks('-q', '4', '6', '-a', '3', '-o', 'arrow')
+        self.assertNotEqual(code, 0)
+        self.assertIn('one query at a time', out.decode('utf-8') + err)
+
+    @unittest.skipIf(output.missing_module('arrow'), 'needs pyarrow')
+    def test_arrow(self):
+        import pyarrow as pa
+        target = os.path.join(workdir, 'out.arrow')
+        self.written('-s', 'SELECT pid, name, duration FROM process', '-o', 'arrow',
+                    '--output-file', target)
+        with open(target, 'rb') as f:
+            table = pa.ipc.open_stream(f).read_all()
+        self.assertEqual([tuple(r.values()) for r in table.to_pylist()],
+                         select('SELECT pid, name, duration FROM process'))
+
+    def test_closed_pipe(self):
+        # a reader which stops early is not an error
+        p = subprocess.Popen([sys.executable, traceworks, path, db, '-s',
+                              'SELECT * FROM values_', '-o', 'csv'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p.stdout.readline()
+        p.stdout.close()
+        err = p.stderr.read().decode('utf-8')
+        p.stderr.close()
+        self.assertEqual(p.wait(), 0, err)
+        self.assertNotIn('Traceback', err)
+
+if __name__ == '__main__':
+    unittest.main()
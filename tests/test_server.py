@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+try:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError
+
+from traceworks import columnar, queries
+from traceworks.api import Trace
+from traceworks.gentrace import write_trace
+from traceworks.server import QueryServer
+from traceworks.traceworks import config_tables
+
+# The answers of the query server against the queries run on the database
+# without any cache, through QueryServer.answer() and through --serve over
+# HTTP and a Unix socket.
+here = os.path.dirname(os.path.abspath(__file__))
+traceworks = os.path.join(os.path.dirname(here), 'traceworks', 'traceworks.py')
+
+def setUpModule():
+    global workdir, db, hosts, trace
+    logging.disable(logging.WARNING)
+    workdir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(workdir, 'traces'))
+    for host, seed in (('web1', 1), ('web2', 2)):
+        with open(os.path.join(workdir, 'traces', host + '.txt'), 'w') as f:
+            write_trace(f, 20000, missing=0.01, seed=seed)
+    trace = Trace(os.path.join(workdir, 'traces', 'web1.txt'))
+    db = trace.ingest(os.path.join(workdir, 'trace.db'), intervals=True).db
+    hosts = Trace(os.path.join(workdir, 'traces')).ingest(os.path.join(workdir, 'hosts.db')).db
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    shutil.rmtree(workdir)
+
+def requests(db):
+    # queries by number and by name, with their arguments
+    conn = sqlite3.connect(db)
+    try:
+        start = conn.execute('SELECT MIN(start_ts) FROM sched_intervals').fetchone()[0]
+    except sqlite3.Error:
+        start = None
+    finally:
+        conn.close()
+    r = [{'query': 4}, {'query': '6', 'args': ['5']}, {'query': 'Top n syscalls', 'args': 3},
+         {'query': 'syscall duration for a pid', 'args': ['1003']}]
+    if start is not None:
+        r.append({'query': 'running in window', 'args': [start, start + 5000]})
+    if not columnar.missing_module():
+        r += [{'query': 7}, {'query': 'syscall duration histogram', 'args': ['sys_read']}]
+    return r
+
+def uncached(db, request):
+    # the columns and rows of a request, not cached nor from the cache
+    query = queries.find_query(trace.queries, request['query'])
+    args = request.get('args', [])
+    args = [str(a) for a in (args if isinstance(args, list) else [args])]
+    conn = sqlite3.connect(db)
+    conn.isolation_level = None
+    try:
+        cursor = conn.cursor()
+        trace_id = None
+        if 'trace_id' in request:
+            trace_id = queries.find_trace(cursor, request['trace_id'])[0][0]
+        col_names, rows, cache = queries.run_query(cursor, db, query, args, trace_id,
+                                                   config_tables(trace.entries), None)
+        return col_names, [list(r) for r in rows]
+    finally:
+        conn.close()
+
+class AnswerTest(unittest.TestCase):
+    def server(self, path=None, connections=2):
+        return QueryServer(path or db, trace.queries, config_tables(trace.entries),
+                           connections)
+
+    def test_list(self):
+        status, a = self.server().answer({'list': True})
+        self.assertEqual(status, 200)
+        self.assertEqual([q['name'] for q in a['queries']], [q['name'] for q in trace.queries])
+        self.assertEqual([q['number'] for q in a['queries']],
+                         list(range(1, len(trace.queries) + 1)))
+
+    def test_results(self):
+        # the first answer is a miss, the next ones hits of the same rows
+        s = self.server()
+        for request in requests(db):
+            col_names, rows = uncached(db, request)
+            self.assertTrue(rows, request)
+            for cache in ('miss', 'hit', 'hit'):
+                status, a = s.answer(request)
+                self.assertEqual(status, 200, a)
+                self.assertEqual((a['columns'], a['rows'], a['cache']),
+                                 (col_names, rows, cache), request)
+
+    def test_trace_id(self):
+        s = self.server(hosts)
+        conn = sqlite3.connect(hosts)
+        ids = dict(conn.execute('SELECT host, trace_id FROM traces').fetchall())
+        conn.close()
+        for request in requests(hosts):
+            for t in ('web1', 'web2', ids['web2']):
+                r = dict(request, trace_id=t)
+                status, a = s.answer(r)
+                self.assertEqual(status, 200, a)
+                self.assertEqual((a['columns'], a['rows']), uncached(hosts, r), r)
+        # the traces differ
+        self.assertNotEqual(s.answer({'query': 4, 'trace_id': 'web1'})[1]['rows'],
+                            s.answer({'query': 4, 'trace_id': 'web2'})[1]['rows'])
+
+    def test_errors(self):
+        s = self.server()
+        self.assertEqual(s.answer(['query', 4])[0], 400)
+        self.assertEqual(s.answer({'query': 'nosuch'})[0], 404)
+        self.assertEqual(s.answer({'query': len(trace.queries) + 1})[0], 404)
+        status, a = s.answer({'query': 'running at', 'args': ['0']})
+        self.assertEqual(status, 400)
+        self.assertIn('requires 2 argument(s)', a['error'])
+        self.assertEqual(s.answer({'query': 4, 'trace_id': 'web1'})[0], 404)
+        self.assertEqual(self.server(hosts).answer({'query': 4, 'trace_id': 'nosuch'})[0],
+                         404)
+        # a query the database cannot run
+        self.assertEqual(s.answer({'query': 6, 'args': ['x']})[0], 400)
+
+    def test_generation(self):
+        # nothing is kept while the tables are being generated, and what
+        # was kept goes with the generation it is of
+        s = self.server()
+        request = {'query': 4}
+        self.assertEqual(s.answer(request)[1]['cache'], 'miss')
+        self.assertEqual(s.answer(request)[1]['cache'], 'hit')
+        conn = sqlite3.connect(db)
+        conn.isolation_level = None
+        try:
+            for ingesting, caches in ((True, [None, None]), (False, ['miss', 'hit'])):
+                conn.execute('BEGIN')
+                queries.new_generation(conn.cursor(), ingesting)
+                conn.execute('COMMIT')
+                self.assertEqual([s.answer(request)[1]['cache'] for c in caches], caches)
+        finally:
+            conn.close()
+
+    def test_concurrent(self):
+        # requests answered on many threads at once with fewer connections
+        # are answered as they are one at a time
+        s = self.server(connections=3)
+        todo = requests(db) * 5
+        expected = [uncached(db, r) for r in todo]
+        answers = [None] * len(todo)
+
+        def ask(i):
+            for j in range(i, len(todo), 8):
+                answers[j] = s.answer(todo[j])
+
+        threads = [threading.Thread(target=ask, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([(a[0], a[1]['columns'], a[1]['rows']) for a in answers],
+                         [(200,) + tuple(e) for e in expected])
+
+class ServeTest(unittest.TestCase):
+    # traceworks --serve, answering until it is killed
+    def serve(self, address, *args):
+        p = subprocess.Popen([sys.executable, traceworks, db, '--serve', address] + list(args),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        line = p.stdout.readline().decode('utf-8')
+        if not line.startswith('Serving'):
+            p.kill()
+            raise AssertionError('{}{}'.format(line, p.communicate()[1].decode('utf-8')))
+        self.addCleanup(self.stop, p)
+        return p, line.split(' on ')[1].split(' with ')[0]
+
+    def stop(self, p):
+        if p.poll() is None:
+            p.send_signal(signal.SIGTERM)
+            p.communicate()
+
+    def test_http(self):
+        p, url = self.serve('127.0.0.1:0', '-j', '2')
+
+        def get(path, body=None):
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            try:
+                r = urlopen(Request(url + path, data))
+                return r.getcode(), json.loads(r.read().decode('utf-8'))
+            except HTTPError as e:
+                return e.code, json.loads(e.read().decode('utf-8'))
+
+        status, a = get('queries')
+        self.assertEqual([q['name'] for q in a['queries']], [q['name'] for q in trace.queries])
+        expected = uncached(db, {'query': 6, 'args': ['5']})
+        for path in ('query/6?args=5', 'query/Top%20n%20syscalls?args=5'):
+            status, a = get(path)
+            self.assertEqual((status, a['columns'], a['rows']), (200,) + expected, path)
+        status, a = get('query', {'query': 6, 'args': ['5']})
+        self.assertEqual((status, a['columns'], a['rows'], a['cache']),
+                         (200,) + expected + ('hit',))
+        start = requests(db)[4]['args'][0]
+        status, a = get('query/running%20at?args=2&args={}'.format(start + 1000))
+        self.assertEqual((status, a['columns'], a['rows']),
+                         (200,) + uncached(db, {'query': 'running at',
+                                                'args': [2, start + 1000]}))
+
+        self.assertEqual(get('query/nosuch')[0], 404)
+        self.assertEqual(get('nosuch')[0], 404)
+        self.assertEqual(get('query/6')[0], 400)
+        status, a = get('query', 'not an object')
+        self.assertEqual(status, 400)
+
+    def test_unix(self):
+        path = os.path.join(workdir, 'traceworks.sock')
+        p, where = self.serve(path)
+        self.assertEqual(where, path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+        f = s.makefile('rwb')
+        for line in (b'{"query": 4}\n', b'\n', b'not json\n', b'{"query": "nosuch"}\n',
+                     b'{"query": 4}\n'):
+            f.write(line)
+        f.flush()
+        answers = [json.loads(f.readline().decode('utf-8')) for i in range(4)]
+        s.close()
+        expected = uncached(db, {'query': 4})
+        self.assertEqual((answers[0]['columns'], answers[0]['rows'], answers[0]['cache']),
+                         expected + ('miss',))
+        self.assertIn('not JSON', answers[1]['error'])
+        self.assertIn('no query nosuch', answers[2]['error'])
+        self.assertEqual(answers[3]['cache'], 'hit')
+
+        # a kill stops it, and the socket goes with it
+        p.send_signal(signal.SIGTERM)
+        p.communicate()
+        self.assertFalse(os.path.exists(path))
+
+    def test_options(self):
+        p = subprocess.Popen([sys.executable, traceworks, db, '--serve', '0', '-q', '4'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertNotEqual(p.returncode, 0)
+        self.assertIn('-q cannot go with it', (out + err).decode('utf-8'))
+
+if __name__ == '__main__':
+    unittest.main()
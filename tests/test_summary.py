@@ -0,0 +1,154 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from traceworks.api import Trace
+from traceworks.gentrace import write_trace
+from traceworks.summary import Histogram, Summary, bucket, bucket_range, precision
+
+here = os.path.dirname(os.path.abspath(__file__))
+traceworks = os.path.join(os.path.dirname(here), 'traceworks', 'traceworks.py')
+
+def histogram(values):
+    h = Histogram()
+    for v in values:
+        h.add(v)
+    return h
+
+def summarize(trace, events):
+    # the Summary of the config entries of a Trace over some of its events
+    s = Summary()
+    samplers = [(c['name'], s.sampler(c)) for c in trace.entries if 'hierarchy' in c]
+    for parsed in events:
+        for name, sample in samplers:
+            if name in parsed.name:
+                sample('duration', parsed, parsed.timestamp % 5000)
+                sample('calls', parsed, None)
+    return s
+
+def roundtrip(s):
+    return Summary.from_json(json.loads(json.dumps(s.to_json())))
+
+class HistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        # every value is in its bucket, which is never wider than 1/64th
+        # of the values in it
+        for v in list(range(1000)) + [random.Random(v).randrange(1 << 40) for v in range(2000)]:
+            low, width = bucket_range(bucket(v))
+            self.assertTrue(low <= v < low + width, v)
+            self.assertTrue(width == 1 or width * (1 << (precision - 1)) <= low, v)
+
+    def test_percentile(self):
+        rnd = random.Random(0)
+        values = sorted(int(rnd.expovariate(1.0 / 5000)) for i in range(10000))
+        h = histogram(values)
+        for p in (1, 50, 90, 99, 100):
+            exact = values[max(1, int(round(len(values) * p / 100.0))) - 1]
+            low, width = bucket_range(bucket(exact))
+            self.assertTrue(abs(h.percentile(p) - exact) <= width // 2, p)
+        self.assertEqual(h.percentile(100), values[-1])
+        self.assertIsNone(Histogram().percentile(50))
+
+    def test_merge(self):
+        rnd = random.Random(1)
+        a = [rnd.randrange(100000) for i in range(3000)]
+        b = [rnd.randrange(10, 1000) for i in range(500)] + [0]
+        merged = histogram(a)
+        merged.merge(histogram(b))
+        merged.merge(Histogram())
+        self.assertEqual(merged.to_json(), histogram(a + b).to_json())
+
+        empty = Histogram()
+        empty.merge(histogram(b))
+        self.assertEqual(empty.to_json(), histogram(b).to_json())
+
+    def test_json(self):
+        h = histogram([0, 1, 7, 300, 300, 123456789])
+        d = json.loads(json.dumps(h.to_json()))
+        self.assertEqual(Histogram.from_json(d).to_json(), h.to_json())
+        self.assertEqual(Histogram.from_json(d).percentile(50), h.percentile(50))
+
+class SummaryTest(unittest.TestCase):
+    def setUp(self):
+        self.trace = Trace(os.path.join(here, 'data', 'trace.txt'))
+        self.events = list(self.trace.iter_events())
+
+    def test_json(self):
+        s = summarize(self.trace, self.events)
+        s.incomplete = True
+        self.assertTrue(s.tables)
+        self.assertEqual(roundtrip(s).to_json(), s.to_json())
+        self.assertEqual(roundtrip(s).results(), s.results())
+
+    def test_precision(self):
+        d = summarize(self.trace, self.events).to_json()
+        d['precision'] = precision + 1
+        with self.assertRaises(ValueError):
+            Summary.from_json(d)
+
+    def test_merge(self):
+        # the summaries of the parts of a trace, loaded from JSON and merged
+        # in any order, are that of the whole trace
+        whole = summarize(self.trace, self.events).to_json()
+        parts = [roundtrip(summarize(self.trace, self.events[i::3])) for i in range(3)]
+        parts[1].incomplete = True
+        for order in ((0, 1, 2), (2, 0, 1)):
+            s = Summary()
+            for i in order:
+                s.merge(parts[i])
+            self.assertTrue(s.incomplete)
+            s.incomplete = False
+            self.assertEqual(s.to_json(), whole)
+
+class SummarizeTest(unittest.TestCase):
+    # -S of a trace is the same serial, with --jobs and made of the -S
+    # --summary-format json of its parts by --merge
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def summarize(self, *args):
+        p = subprocess.Popen([sys.executable, traceworks, '-S', '--summary-format', 'json']
+                             + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        return json.loads(out.decode('utf-8'))
+
+    def trace(self, name, seed):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            write_trace(f, 50000, missing=0.01, seed=seed)
+        return path
+
+    def test_jobs(self):
+        path = self.trace('trace.txt', 0)
+        serial = self.summarize(path)
+        self.assertTrue(serial['incomplete'])
+        self.assertEqual(self.summarize(path, '-j', '4'), serial)
+
+    def test_merge(self):
+        a = self.trace('a.txt', 1)
+        b = self.trace('b.txt', 2)
+        summaries = []
+        for path in (a, b):
+            summaries.append(path + '.json')
+            with open(summaries[-1], 'w') as f:
+                json.dump(self.summarize(path), f)
+
+        merged = self.summarize(a, '-M', summaries[1])
+        self.assertEqual(self.summarize(b, '-M', summaries[0]), merged)
+        s = Summary.from_json(self.summarize(a))
+        s.merge(Summary.from_json(self.summarize(b)))
+        self.assertEqual(json.loads(json.dumps(s.to_json())), merged)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import zlib
+
+from traceworks.api import Trace, TraceError
+from traceworks.gentrace import write_trace
+from traceworks.tracedat import TraceDat, TraceDatError
+
+# data/ holds a short recording of a real kernel (Linux 6.18, 1 CPU) by
+# trace-cmd 3.1.5: the syscalls read, write, openat and close, sched_switch
+# and sched_process_exec of a few runs of cat, with a path long enough for
+# records of more than 112 bytes, and a sleep for the time extends.
+#
+#   trace.txt      the kernel's own text of the ring buffer
+#   trace-v6.dat   trace-cmd extract, then convert --file-version 6
+#                  --compression none of the same buffer
+#   trace-v7.dat   as extracted, version 7 compressed with zstd
+#   trace-v7-none.dat  convert --file-version 7 --compression none
+#
+# /proc/kallsyms was hidden and only the formats of the recorded events
+# were kept, which keeps the files small.
+#
+#   trace-v7-chunks.dat  gentrace.py -n 6000 --cpus 1 --dat, converted to
+#                        version 7 with zstd: one CPU in 6 chunks
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+dats = ['trace-v6.dat', 'trace-v7-none.dat']
+if zstandard is not None:
+    dats.append('trace-v7.dat')
+
+def rows(db, table):
+    conn = sqlite3.connect(db)
+    try:
+        return sorted(conn.execute('SELECT * FROM ' + table).fetchall())
+    finally:
+        conn.close()
+
+class TraceDatTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_events(self):
+        text = list(Trace(os.path.join(data, 'trace.txt')).iter_events())
+        self.assertEqual(len(text), 663)
+        for name in dats:
+            dat = list(Trace(os.path.join(data, name)).iter_events())
+            self.assertEqual(dat, text, name)
+
+    def test_tables(self):
+        text = os.path.join(self.dir, 'text.db')
+        Trace(os.path.join(data, 'trace.txt')).ingest(text, events=True)
+        for name in dats:
+            dat = os.path.join(self.dir, name + '.db')
+            Trace(os.path.join(data, name)).ingest(dat, events=True)
+            for table in ('process', 'cpu', 'events'):
+                self.assertTrue(rows(text, table), table)
+                self.assertEqual(rows(dat, table), rows(text, table), (name, table))
+
+    def test_jobs(self):
+        # the time ranges of --jobs over the chunks of a compressed file
+        text = os.path.join(self.dir, 'text.db')
+        Trace(os.path.join(data, 'trace.txt')).ingest(text)
+        for name in dats:
+            dat = os.path.join(self.dir, name + '.db')
+            Trace(os.path.join(data, name)).ingest(dat, jobs=3)
+            for table in ('process', 'cpu'):
+                self.assertEqual(rows(dat, table), rows(text, table), (name, table))
+
+    @unittest.skipIf(zstandard is None, 'needs zstandard')
+    def test_chunks(self):
+        path = os.path.join(self.dir, 'trace.txt')
+        with open(path, 'w') as f:
+            write_trace(f, 6000, cpus=1)
+        dat = os.path.join(data, 'trace-v7-chunks.dat')
+        t = TraceDat(dat)
+        try:
+            self.assertEqual([len(c.chunks) for c in t.cpus], [6])
+        finally:
+            t.close()
+        self.assertEqual(list(Trace(dat).iter_events()), list(Trace(path).iter_events()))
+        text = os.path.join(self.dir, 'text.db')
+        Trace(path).ingest(text)
+        for jobs in (1, 4):
+            db = os.path.join(self.dir, 'chunks-{}.db'.format(jobs))
+            Trace(dat).ingest(db, jobs=jobs)
+            for table in ('process', 'cpu'):
+                self.assertEqual(rows(db, table), rows(text, table), (jobs, table))
+
+    def test_version(self):
+        with open(os.path.join(data, 'trace-v6.dat'), 'rb') as f:
+            content = f.read()
+        path = os.path.join(self.dir, 'v8.dat')
+        with open(path, 'wb') as f:
+            f.write(content.replace(b'tracing6', b'tracing8', 1))
+        with self.assertRaises(TraceError) as e:
+            Trace(path).ingest(os.path.join(self.dir, 'v8.db'))
+        self.assertIn('file version 8 is not supported', str(e.exception))
+
+    def test_zlib(self):
+        # what trace-cmd compresses with zlib, compress2() of zlib itself
+        t = TraceDat(os.path.join(data, 'trace-v6.dat'))
+        try:
+            decompress = t.decompressor('zlib')
+            self.assertEqual(decompress(zlib.compress(b'page' * 1024), 4096), b'page' * 1024)
+            with self.assertRaises(TraceDatError):
+                decompress(zlib.compress(b'page'), 4096)
+            with self.assertRaises(TraceDatError):
+                t.decompressor('lz4')
+        finally:
+            t.close()
+
+if __name__ == '__main__':
+    unittest.main()
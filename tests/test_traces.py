@@ -0,0 +1,223 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import gzip
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from traceworks import columnar
+from traceworks.api import Trace
+from traceworks.gentrace import write_trace
+from traceworks.queries import QueryError
+
+# The traces of a -T database against databases of each of them alone: the
+# rows stored under each trace_id, the queries of --trace-id and of
+# Trace.query(trace_id=), and the traces -A replaces.
+here = os.path.dirname(os.path.abspath(__file__))
+traceworks = os.path.join(os.path.dirname(here), 'traceworks', 'traceworks.py')
+tables = ('process', 'cpu', 'syscall_totals', 'sched_intervals')
+
+def setUpModule():
+    global workdir, tracedir, traces, alone
+    workdir = tempfile.mkdtemp()
+    tracedir = os.path.join(workdir, 'traces')
+    os.mkdir(tracedir)
+    traces = {}
+    for host, seed in (('web1', 1), ('web2', 2), ('db1', 3)):
+        traces[host] = write(host, seed)
+    alone = dict((host, single(path)) for host, path in traces.items())
+
+def tearDownModule():
+    shutil.rmtree(workdir)
+
+def write(host, seed, lines=30000):
+    # db1 is compressed
+    path = os.path.join(tracedir, host + ('.txt.gz' if host == 'db1' else '.txt'))
+    f = gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')
+    with f:
+        write_trace(f, lines, missing=0.01, seed=seed)
+    return path
+
+def single(path, name=None):
+    db = os.path.join(workdir, (name or os.path.basename(path)) + '.db')
+    if os.path.exists(db):
+        os.remove(db)
+    run('-g', '-I', path, db)
+    return db
+
+def run(*args):
+    p = subprocess.Popen([sys.executable, traceworks] + list(args),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode:
+        raise AssertionError('{} failed: {}'.format(args, err.decode('utf-8', 'replace')))
+    return out.decode('utf-8')
+
+def failed(*args):
+    # what a run which fails says
+    p = subprocess.Popen([sys.executable, traceworks] + list(args),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if not p.returncode:
+        raise AssertionError('{} did not fail'.format(args))
+    return (out + err).decode('utf-8')
+
+def table(out):
+    # the header and rows of csv output, in no order and with the last
+    # digits of the floats left out, which depend on the order of the rows
+    lines = out.splitlines()
+
+    def value(v):
+        try:
+            return '{:.9g}'.format(float(v)) if '.' in v else v
+        except ValueError:
+            return v
+    return lines[0], sorted([value(v) for v in l.split(',')] for l in lines[1:])
+
+def rows(db, trace_id=None):
+    # the rows of the tables, of one trace without its trace_id column
+    conn = sqlite3.connect(db)
+    try:
+        result = {}
+        for t in tables:
+            cursor = conn.execute('SELECT * FROM ' + t)
+            names = [d[0] for d in cursor.description]
+            if trace_id is None:
+                result[t] = sorted(cursor.fetchall())
+            else:
+                i = names.index('trace_id')
+                result[t] = sorted(r[:i] + r[i + 1:] for r in cursor if r[i] == trace_id)
+        return result
+    finally:
+        conn.close()
+
+def select(db, sql, *args):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+
+class TracesTest(unittest.TestCase):
+    def setUp(self):
+        self.db = os.path.join(workdir, 'hosts.db')
+        if os.path.exists(self.db):
+            os.remove(self.db)
+
+    def query(self, *args):
+        return run(tracedir, self.db, '-o', 'csv', *args)
+
+    def ids(self):
+        return dict((host, trace_id) for trace_id, host in
+                    select(self.db, 'SELECT trace_id, host FROM traces'))
+
+    def check(self, hosts):
+        # every trace of the database has the rows it has alone
+        ids = self.ids()
+        self.assertEqual(sorted(ids), sorted(hosts))
+        for host in hosts:
+            self.assertEqual(rows(self.db, ids[host]), rows(alone[host]), host)
+
+    def test_directory(self):
+        # the hosts are the file names up to the first dot, one worker each
+        for jobs in ('1', '3'):
+            self.setUp()
+            run('-g', '-I', '-j', jobs, self.db, '-T', tracedir)
+            self.check(['web1', 'web2', 'db1'])
+        for host, path, start, end, lines in select(self.db, 'SELECT host, file, start_ts, '
+                                                             'end_ts, lines FROM traces'):
+            self.assertEqual(path, traces[host])
+            # the time range is that of the events of the config
+            trace = Trace(path)
+            names = [c['name'] for c in trace.entries]
+            events = [e.timestamp for e in trace.iter_events()
+                      if any(n in e.name for n in names)]
+            self.assertEqual((start, end), (events[0], events[-1]), host)
+            f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+            with f:
+                self.assertEqual(lines, len(f.read().splitlines()), host)
+
+    def test_hosts(self):
+        run('-g', '-I', '-j', '2', self.db, '-T', 'front=' + traces['web1'],
+            'back=' + traces['db1'])
+        ids = self.ids()
+        self.assertEqual(sorted(ids), ['back', 'front'])
+        self.assertEqual(rows(self.db, ids['front']), rows(alone['web1']))
+        self.assertEqual(rows(self.db, ids['back']), rows(alone['db1']))
+
+    def test_append(self):
+        # -A adds the traces not read before and replaces the others, which
+        # keep their trace_id
+        run('-g', '-I', self.db, '-T', traces['web1'], traces['web2'])
+        ids = self.ids()
+        path = write('web2', 4, 20000)
+        try:
+            run('-g', '-I', '-A', self.db, '-T', traces['web2'], traces['db1'])
+            self.assertEqual(self.ids(), dict(ids, db1=3))
+            self.assertEqual(rows(self.db, ids['web2']), rows(single(path, 'web2-changed')))
+            self.assertEqual(rows(self.db, ids['web1']), rows(alone['web1']))
+            self.assertEqual(rows(self.db, 3), rows(alone['db1']))
+            # and the R*Tree has the runs of the table, no more
+            self.assertEqual(select(self.db, 'SELECT COUNT(*) FROM sched_intervals_rtree'),
+                             select(self.db, 'SELECT COUNT(*) FROM sched_intervals'))
+        finally:
+            write('web2', 2)
+
+    def test_queries(self):
+        run('-g', '-I', self.db, '-T', traces['web1'], traces['web2'])
+        ids = self.ids()
+        start = select(alone['web2'], 'SELECT MIN(start_ts) FROM sched_intervals')[0][0]
+        checked = [['4'], ['6', '-a', '5'], ['11', '-a', str(start), str(start + 20000)]]
+        if not columnar.missing_module():
+            checked += [['7'], ['8', '-a', 'sys_read']]
+        for q in checked:
+            for host in ('web1', 'web2'):
+                expected = table(run(traces[host], alone[host], '-o', 'csv', '--no-cache',
+                                     '-q', *q))
+                self.assertTrue(expected[1], q)
+                for t in (host, str(ids[host])):
+                    self.assertEqual(table(self.query('-q', *(q + ['--trace-id', t]))),
+                                     expected, (q, t))
+
+        # without --trace-id the queries cover all of the traces
+        counts = select(self.db, 'SELECT trace_id, COUNT(*) FROM process GROUP BY trace_id')
+        self.assertEqual(len(counts), 2)
+        out = self.query('-s', 'SELECT COUNT(*) FROM process')
+        self.assertEqual(int(out.splitlines()[-1]), sum(n for trace_id, n in counts))
+
+    def test_api(self):
+        Trace(tracedir).ingest(self.db, jobs=2)
+        ids = self.ids()
+        t = Trace(db=self.db)
+
+        def query(t, *args, **options):
+            # the rows of a cache hit are lists
+            col_names, rows = t.query(*args, **options)
+            return col_names, [tuple(r) for r in rows]
+
+        for host in ('web1', 'db1'):
+            expected = query(Trace(db=alone[host]), 'Top n syscalls', 5)
+            self.assertTrue(expected[1], host)
+            self.assertEqual(query(t, 'Top n syscalls', 5, trace_id=host), expected)
+            self.assertEqual(query(t, 6, 5, trace_id=ids[host]), expected)
+        with self.assertRaises(QueryError):
+            t.query('Top n syscalls', 5, trace_id='nosuch')
+
+    def test_errors(self):
+        self.assertIn('--trace-id needs a database built with -T',
+                      failed(traces['web1'], alone['web1'], '-q', '4', '--trace-id', 'web1'))
+        run('-g', self.db, '-T', traces['web1'], 'web1=' + traces['web2'])
+        self.assertIn('No trace nosuch', failed(tracedir, self.db, '-q', '4', '--trace-id',
+                                                'nosuch'))
+        # two traces of one host are picked by their trace_id
+        self.assertIn('pick one by its trace_id',
+                      failed(tracedir, self.db, '-q', '4', '--trace-id', 'web1'))
+        self.assertEqual(self.query('-q', '4', '--trace-id', '2'),
+                         run(traces['web2'], alone['web2'], '-o', 'csv', '-q', '4'))
+
+if __name__ == '__main__':
+    unittest.main()
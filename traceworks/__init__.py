@@ -1 +1,25 @@
-from .traceworks import TraceUtil
+import sys
+
+# Trace reads, ingests and queries traces for programs (see api.py),
+# TraceUtil is the command line. They are imported as they are first used,
+# so that importing the package costs next to nothing.
+_exports = {'Trace': 'api', 'TraceError': 'api', 'ingest': 'api',
+            'QueryError': 'queries', 'TraceEvent': 'utils',
+            'TraceUtil': 'traceworks'}
+
+__all__ = sorted(_exports)
+
+if sys.version_info >= (3, 7):
+    import importlib
+
+    def __getattr__(name):
+        module = _exports.get(name)
+        if module is None:
+            raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+        return getattr(importlib.import_module('.' + module, __name__), name)
+else:
+    # no module __getattr__ before 3.7
+    from .api import Trace, TraceError, ingest
+    from .queries import QueryError
+    from .utils import TraceEvent
+    from .traceworks import TraceUtil
@@ -0,0 +1,381 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import sqlite3
+
+try:
+    from .utils import EventDispatch, EventFilter
+    from .handlers import Handler, EventStore, SchedIntervals
+    from .handlers import events_schema, insert_batch, store_events
+    from .reader import TraceReader, events, line_events, decompressed_lines
+    from .reader import decompress_range
+    from .tracedat import TraceDat, names_wanted, time_range
+    from .summary import Summary
+    from .stats import Stats
+except (ImportError, ValueError):
+    from utils import EventDispatch, EventFilter
+    from handlers import Handler, EventStore, SchedIntervals
+    from handlers import events_schema, insert_batch, store_events
+    from reader import TraceReader, events, line_events, decompressed_lines
+    from reader import decompress_range
+    from tracedat import TraceDat, names_wanted, time_range
+    from summary import Summary
+    from stats import Stats
+
+# The aggregation of the --jobs workers, for process_trace_parallel() and
+# process_traces() of TraceUtil: process_chunk() aggregates a byte or time
+# range of a trace, process_file() a whole trace of a -T run. Both are
+# handed their arguments pickled and give back what the driver merges
+# into its own handlers and tables.
+
+class _NeedsGlobalState(Exception):
+    pass
+
+class _ChunkKey(object):
+    __slots__ = ('head', 'scratch', 'rec', 'stored', 'rec_offset', 'tail')
+
+    def __init__(self, h):
+        self.head = []
+        # one record per possible starting state, closed and open
+        opened = h.new_record()
+        if h.entry_pattern is not None:
+            opened[h.last_action] = 'entry'
+        if h.exit_pattern is not None:
+            opened[h.last_action_s] = 'entry'
+        self.scratch = [h.new_record(), opened]
+        self.rec = None
+        self.stored = None
+        self.rec_offset = None
+        self.tail = None
+
+class _ChunkHandler(Handler):
+    # A Handler whose actions check with the ChunkAggregator first: nothing
+    # runs while the entry/exit state is being settled, and an action that
+    # needs a value stored by an earlier chunk is refused.
+    def __init__(self, index, cfg, agg):
+        self.index = index
+        self.agg = agg
+        sample = agg.summary.sampler(cfg) if agg.summary else None
+        Handler.__init__(self, cfg, agg.report_mismatch, sample)
+
+    def compile_actions(self, actions):
+        run = Handler.compile_actions(self, actions)
+        if run is None:
+            return None
+
+        agg = self.agg
+        ops = [(a['operation'], self.slot[a['store_name']], self.slot.get(a.get('field')))
+               for a in actions]
+        def checked(parsed, rec):
+            if agg.stored is None:
+                return
+
+            stored = set(agg.stored)
+            for operation, store, field in ops:
+                if operation == 'store':
+                    stored.add(store)
+                elif operation == 'difference' and field not in stored:
+                    raise _NeedsGlobalState()
+
+            agg.stored.update(stored)
+            run(parsed, rec)
+        return checked
+
+class ChunkAggregator(object):
+    # Aggregates one byte range of the trace for process_trace_parallel().
+    #
+    # Which state (entry or exit) a key is in at the start of the chunk is
+    # only known once the previous chunks are merged. Until the key has
+    # settled to the closed state whatever it started from, its events are
+    # kept in 'head' and replayed at merge time. From there on the key is
+    # aggregated into an empty record, where stored fields are absolute and
+    # the rest are deltas. If an action needs a value the chunk did not
+    # store itself, the remaining events of the key go to 'tail' and are
+    # replayed as well.
+    def __init__(self, config, events_db=None, summarize=False, intervals=False, stats=False,
+                 filters=None):
+        # with --summarize the differences and increments the chunk made
+        # itself go into a Summary of its own, the replayed ones into the
+        # one of the driver
+        self.summary = Summary() if summarize else None
+        self.handlers = []
+        for c in config:
+            if "hierarchy" in c:
+                self.handlers.append(_ChunkHandler(len(self.handlers), c, self))
+
+        entries = self.handlers
+        self.events = None
+        self.events_db = events_db
+        if events_db is not None:
+            self.conn, self.events = open_events_db(events_db)
+            entries = entries + [self.events]
+        # the runs on each CPU, joined up with the neighbouring chunks by
+        # the driver
+        self.intervals = SchedIntervals() if intervals else None
+        if self.intervals is not None:
+            entries = entries + [self.intervals]
+        self.filter = EventFilter(**filters) if filters else None
+        self.dispatch = EventDispatch(entries, self.filter)
+        # what --stats needs from the chunk
+        self.stats = Stats(stats)
+        if stats:
+            self.stats.count_lookups(self.dispatch)
+        self.keys = {}
+        self.mismatches = {}
+        self.offset = 0
+        self.timestamp = None
+        self.lead = b''
+        self.trail = b''
+        self.index = None
+        self.stored = None
+
+    def report_mismatch(self, flag, missing, parsed):
+        if self.stored is None:
+            return
+        self.stats.mismatch(self.index, missing)
+        # the first one per flag in the chunk is the only candidate
+        if flag not in self.mismatches:
+            self.mismatches[flag] = (self.offset, self.index, flag, missing, parsed)
+
+    def settled(self, h, scratch):
+        # entries with both patterns drive two state machines off the same
+        # record, those are always replayed
+        if h.entry_pattern is not None and h.exit_pattern is not None:
+            return False
+
+        for rec in scratch:
+            if not h.closed(rec):
+                return False
+        return True
+
+    def match_chunk(self, h, parsed):
+        keys = h.keys(parsed)
+        k = self.keys.get((h.index, keys))
+        if k is None:
+            k = self.keys[(h.index, keys)] = _ChunkKey(h)
+
+        if k.tail is not None:
+            k.tail.append((self.offset, parsed))
+            return
+
+        if k.scratch is not None:
+            k.head.append((self.offset, parsed))
+            self.stored = None
+            for rec in k.scratch:
+                h.step(rec, parsed)
+            if self.settled(h, k.scratch):
+                k.scratch = None
+                k.rec = h.new_record()
+                k.stored = set()
+                k.rec_offset = self.offset + 0.5
+            return
+
+        self.stored = k.stored
+        self.index = h.index
+        try:
+            h.step(k.rec, parsed)
+        except _NeedsGlobalState:
+            k.tail = [(self.offset, parsed)]
+
+    def process(self, path, fmt, start, end):
+        if fmt is None:
+            with TraceReader(path) as r:
+                self.scan(r.events(self.dispatch.pattern, start, end, self.stats.reject,
+                                   self.filter))
+        elif fmt == 'tracedat':
+            self.scan(self.decoded(path, start, end))
+        else:
+            self.scan(self.decompressed(path, fmt, start, end))
+
+        if self.events is not None:
+            self.events.flush()
+            self.conn.close()
+
+    def decoded(self, path, start, end):
+        # A time range of a trace.dat, in nanoseconds. Every earlier event
+        # is in an earlier chunk, the events are ordered by their index in
+        # the range.
+        keep = self.filter
+        with TraceDat(path) as t:
+            wanted = names_wanted([h.name for h in self.dispatch.entries], keep)
+            for i, parsed in enumerate(t.events(wanted, keep, start, end)):
+                yield i, parsed
+            self.stats.lines += t.count
+            self.stats.rejected += t.unknown
+            if t.missed:
+                logging.warning('%s: events were lost on %d pages of the ring buffer',
+                                path, t.missed)
+
+    def decompressed(self, path, fmt, start, end):
+        # Compressed members end anywhere in a line. What comes before the
+        # first newline and after the last one is handed back as 'lead' and
+        # 'trail', to be put together with the neighbouring chunks.
+        data = decompress_range(path, fmt, start, end)
+        self.stats.lines += data.count(b'\n')
+        self.stats.bytes += len(data)
+        first = data.find(b'\n')
+        if first < 0:
+            self.lead = None
+            self.trail = data
+            return iter(())
+
+        last = data.rfind(b'\n')
+        self.lead = data[:first]
+        self.trail = data[last + 1:]
+        return events(data, self.dispatch.pattern, first + 1, last + 1, self.stats.reject,
+                      self.filter)
+
+    def scan(self, events):
+        dispatch = self.dispatch
+        parsed = None
+        for offset, parsed in events:
+            # events are ordered by the offset of their line
+            self.offset = offset
+            for h in dispatch.lookup(parsed.name):
+                if isinstance(h, _ChunkHandler):
+                    self.match_chunk(h, parsed)
+                else:
+                    h.feed(parsed)
+
+        if parsed is not None:
+            self.timestamp = parsed.timestamp
+
+    def result(self):
+        keys = []
+        for (i, kv), k in self.keys.items():
+            keys.append((i, kv, k.head, k.rec, k.stored, k.rec_offset, k.tail or []))
+
+        return {'keys': keys, 'mismatches': list(self.mismatches.values()),
+                'timestamp': self.timestamp, 'lead': self.lead, 'trail': self.trail,
+                'events': self.events_db,
+                'summary': self.summary.to_json() if self.summary else None,
+                'intervals': (self.intervals.first, self.intervals.rows, self.intervals.open,
+                              self.intervals.last) if self.intervals else None,
+                'stats': (self.stats.names, list(self.stats.mismatches.items()),
+                          self.stats.rejected, self.stats.lines,
+                          self.stats.bytes) if self.stats.enabled else None}
+
+class TraceAggregator(object):
+    # Aggregates a whole trace of a -T run for process_traces(), the way a
+    # serial run does. Mismatches are all counted, the first one of each
+    # kind is handed back for the driver to report.
+    def __init__(self, config, events_db=None, intervals=False, stats=False, filters=None):
+        self.stats = Stats(stats)
+        self.mismatches = {}
+        self.handlers = []
+        for c in config:
+            if "hierarchy" in c:
+                self.handlers.append(Handler(c, self.reporter(len(self.handlers))))
+
+        entries = self.handlers
+        self.events = None
+        self.events_db = events_db
+        if events_db is not None:
+            self.conn, self.events = open_events_db(events_db)
+            entries = entries + [self.events]
+        self.runs = []
+        self.intervals = SchedIntervals(self.runs.extend) if intervals else None
+        if self.intervals is not None:
+            entries = entries + [self.intervals]
+        self.filter = EventFilter(**filters) if filters else None
+        self.dispatch = EventDispatch(entries, self.filter)
+        if stats:
+            self.stats.count_lookups(self.dispatch)
+        self.first = None
+        self.last = None
+        self.lines = 0
+        self.bytes = 0
+
+    def reporter(self, i):
+        def report(flag, missing, parsed):
+            self.stats.mismatch(i, missing)
+            if flag not in self.mismatches:
+                self.mismatches[flag] = (flag, missing, parsed)
+        return report
+
+    def process(self, path, fmt):
+        if fmt is None:
+            with TraceReader(path) as r:
+                start, end = r.window(self.filter)
+                self.scan(r.events(self.dispatch.pattern, start, end, self.stats.reject,
+                                   self.filter))
+                self.lines = r.lines(start, end)
+                self.bytes = end - start
+        elif fmt == 'tracedat':
+            self.scan(self.decoded(path))
+        else:
+            self.scan(self.decompressed(path, fmt))
+
+        if self.events is not None:
+            self.events.flush()
+            self.conn.close()
+        if self.intervals is not None:
+            self.intervals.close()
+
+    def decoded(self, path):
+        keep = self.filter
+        start, end = time_range(keep)
+        with TraceDat(path) as t:
+            wanted = names_wanted([h.name for h in self.dispatch.entries], keep)
+            for parsed in t.events(wanted, keep, start, end):
+                yield None, parsed
+            self.lines = t.count
+            self.bytes = t.size
+            self.stats.rejected += t.unknown
+
+    def decompressed(self, path, fmt):
+        for parsed in line_events(self.counted(decompressed_lines(path, fmt)),
+                                  self.dispatch.pattern, self.stats.reject, self.filter):
+            yield None, parsed
+
+    def counted(self, lines):
+        for l in lines:
+            self.lines += 1
+            self.bytes += len(l) + 1
+            yield l
+
+    def scan(self, events):
+        lookup = self.dispatch.lookup
+        parsed = None
+        for o, parsed in events:
+            if self.first is None:
+                self.first = parsed.timestamp
+            for h in lookup(parsed.name):
+                h.feed(parsed)
+
+        if parsed is not None:
+            self.last = parsed.timestamp
+
+    def result(self):
+        return {'rows': [list(h.rows()) for h in self.handlers],
+                'mismatches': [self.mismatches[f] for f in sorted(self.mismatches)],
+                'count': sum(self.stats.mismatches.values()),
+                'range': (self.first, self.last), 'lines': self.lines,
+                'events': self.events_db,
+                'intervals': self.runs if self.intervals is not None else None,
+                'stats': (self.stats.names, list(self.stats.mismatches.items()),
+                          self.stats.rejected, self.lines,
+                          self.bytes) if self.stats.enabled else None}
+
+def open_events_db(path):
+    # the database a worker stores the events of --events in
+    conn = sqlite3.connect(path)
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA synchronous=OFF')
+    for statement in events_schema:
+        cursor.execute(statement)
+    return conn, EventStore(lambda names, rows: store_events(cursor, names, rows),
+                            insert_batch)
+
+def process_chunk(args):
+    config, path, fmt, start, end, options = args
+    a = ChunkAggregator(config, **options)
+    a.process(path, fmt, start, end)
+    return a.result()
+
+def process_file(args):
+    config, path, fmt, options = args
+    a = TraceAggregator(config, **options)
+    a.process(path, fmt)
+    return a.result()
@@ -0,0 +1,255 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import multiprocessing
+import os
+import sqlite3
+
+from .utils import EventFilter
+from .reader import TraceReader, compression, missing_module, decompressed_lines
+from .reader import line_events
+from .tracedat import TraceDat, TraceDatError, is_tracedat, names_wanted, time_range
+from . import queries
+from .queries import QueryError
+from .traceworks import TraceUtil, ConfigError, load_config, make_parser, default_config
+from .traceworks import config_tables
+
+# traceworks as a library, for programs which would otherwise run it once per
+# trace and query:
+#
+#   from traceworks import Trace
+#
+#   t = Trace('trace.txt.gz', pids=[1003])
+#   for e in t.iter_events():
+#       print(e.timestamp, e.name)
+#   t.ingest('trace.db', events=True)
+#   col_names, rows = t.query('syscall duration for a pid', 1003)
+#
+# A Trace is of a tracefile (text, compressed or trace.dat), of a directory
+# of them, or of a file object of text lines. Its config is a path or the
+# parsed JSON, traceconfig.json next to this file by default. The filters
+# are those of --pid, --cpu, --comm, --from/--to and --allow/deny-events:
+# pids, cpus, comms, start, end (in microseconds), allow and deny.
+#
+# Everything a run needs is held by the Trace and the database, so any
+# number of them can be ingested at once. One of a path is pickled for the
+# workers of a process pool as it is:
+#
+#   pool.map(traceworks.ingest, [(Trace(p), p + '.db') for p in paths])
+#
+# Errors are raised as TraceError, or QueryError for the queries. Nothing
+# is printed, warnings such as the first mismatch go through logging.
+
+class TraceError(Exception):
+    pass
+
+class Trace(object):
+    def __init__(self, source=None, config=None, kind='ftrace', db=None, **filters):
+        self.source = source
+        # a file object is read line by line, anything else is a path
+        self.path = None if source is None or hasattr(source, 'read') else str(source)
+        self.config = config if config is not None else default_config
+        self.kind = kind
+        try:
+            self.entries, self.queries = load_config(self.config, kind)
+        except ConfigError as e:
+            raise TraceError(str(e))
+        self.filters = filters
+        self.filter = EventFilter(**filters) if filters else None
+        # the database ingest() wrote, or one given to query
+        self.db = db
+        # the report of ingest(stats=True)
+        self.stats = None
+
+    @property
+    def incomplete(self):
+        # whether the last ingestion into the database ran into events
+        # without their entry or exit, as the disclaimers of queries say
+        if self.db is None or not os.path.isfile(self.db):
+            return False
+        conn = sqlite3.connect(self.db)
+        try:
+            return queries.trace_incomplete(conn.cursor())
+        finally:
+            conn.close()
+
+    def iter_events(self):
+        # Every event the filters let through, parsed into a TraceEvent as
+        # it is read. Only as much of the trace as is being looked at is in
+        # memory. The events of a trace.dat are merged from all the CPUs in
+        # the order of their time.
+        keep = self.filter
+        wanted = names_wanted([''], keep)
+        self.check_path()
+        if self.path is None:
+            events = self.parsed_lines(_text_lines(self.source))
+        elif os.path.isdir(self.path):
+            raise TraceError('{} is a directory, make a Trace of each of its '
+                             'tracefiles'.format(self.path))
+        elif not os.path.isfile(self.path):
+            # a pipe or a character device
+            events = self.lines_of(self.path)
+        elif compression(self.path):
+            events = self.decompressed(compression(self.path))
+        elif is_tracedat(self.path):
+            events = self.decoded()
+        else:
+            events = self.mapped()
+
+        for parsed in events:
+            if wanted(parsed.name):
+                yield parsed
+
+    def check_path(self):
+        if self.path is not None and not os.path.exists(self.path):
+            raise TraceError('No tracefile {}'.format(self.path))
+
+    def lines_of(self, path):
+        with open(path, 'r') as f:
+            for parsed in self.parsed_lines(f):
+                yield parsed
+
+    def parsed_lines(self, lines):
+        return line_events(lines, keep=self.filter, text=True)
+
+    def mapped(self):
+        with TraceReader(self.path) as r:
+            start, end = r.window(self.filter)
+            for o, parsed in r.events(None, start, end, None, self.filter):
+                yield parsed
+
+    def decompressed(self, fmt):
+        if missing_module(fmt):
+            raise TraceError('Reading {} compressed traces needs the {} module'.format(
+                fmt, missing_module(fmt)))
+        for parsed in line_events(decompressed_lines(self.path, fmt), keep=self.filter):
+            yield parsed
+
+    def decoded(self):
+        keep = self.filter
+        start, end = time_range(keep)
+        try:
+            trace = TraceDat(self.path)
+        except TraceDatError as e:
+            raise TraceError('Cannot read {}: {}'.format(self.path, e))
+        with trace:
+            for parsed in trace.events(lambda name: True, keep, start, end):
+                yield parsed
+
+    def ingest(self, db, events=False, intervals=False, jobs=1, append=False,
+               memory_limit=None, export=None, stats=False):
+        # What traceworks -g does, with the options of -e, -I, -j, -A, -m
+        # and -x, into the database 'db' the queries then run on. With
+        # 'stats' the report of --stats --stats-format json is kept in
+        # self.stats. Returns the Trace, with the database it went into.
+        if self.source is None:
+            raise TraceError('There is no trace to ingest')
+        stream = None
+        if self.path is None:
+            if append:
+                raise TraceError('Lines of a file object cannot be carried on from')
+            stream = _text_lines(self.source)
+        self.check_path()
+        if jobs > 1 and multiprocessing.current_process().daemon:
+            # the worker of a pool cannot have a pool of its own
+            logging.info('Ingesting %s with a single job in a pool worker', self.path)
+            jobs = 1
+
+        args = make_parser().parse_args([])
+        args.tracefile = self.path
+        args.dbfile = db
+        args.config = self.config
+        args.type = self.kind
+        args.generate = True
+        args.events = events
+        args.intervals = intervals
+        args.jobs = jobs
+        args.append = append
+        args.memory_limit = memory_limit
+        # export is the format of -x, or True for npy
+        args.export = bool(export)
+        if export in ('npy', 'parquet'):
+            args.export_format = export
+        args.stats = stats
+        args.stats_format = 'json'
+        args.pid = self.filters.get('pids')
+        args.cpu = self.filters.get('cpus')
+        args.comm = self.filters.get('comms')
+        args.start = self.filters.get('start')
+        args.end = self.filters.get('end')
+        args.allow_events = self.filters.get('allow')
+        args.deny_events = self.filters.get('deny')
+
+        t = _Ingestion(args, stream)
+        try:
+            t.run()
+        finally:
+            if t.conn is not None:
+                t.conn.close()
+        self.db = db
+        self.stats = t.stats.report(t.handlers) if stats else None
+        return self
+
+    def query(self, name, *args, **options):
+        # The column names and rows of a query of the config, by its name or
+        # its number in --list, with its arguments. trace_id picks a trace
+        # of a database of several, by its trace_id or host. The results
+        # are cached in the database as those of -q are.
+        trace_id = options.pop('trace_id', None)
+        if options:
+            raise TypeError('unexpected keyword arguments {}'.format(', '.join(sorted(options))))
+        if self.db is None or not os.path.isfile(self.db):
+            raise TraceError('There is no database to query, ingest() the trace first')
+
+        query = queries.find_query(self.queries or [], name)
+        if query is None:
+            raise QueryError('no query {}'.format(name))
+        if query.get('kind', 'sql') == 'sql' and 'query' not in query:
+            raise QueryError("query '{}' is not implemented".format(query['name']))
+        if len(args) < len(query.get('args', [])):
+            raise QueryError("query '{}' requires {} argument(s)".format(
+                query['name'], len(query['args'])))
+
+        tables = config_tables(self.entries)
+        conn = sqlite3.connect(self.db)
+        conn.isolation_level = None
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+            if not set(r[0] for r in cursor.fetchall()).intersection(tables):
+                raise TraceError('{} has none of the tables of the config, ingest() into it '
+                                 'first'.format(self.db))
+            if trace_id is not None:
+                t = str(trace_id)
+                r = queries.find_trace(cursor, t, os.path.abspath(t))
+                if not r or len(r) > 1:
+                    raise QueryError('no single trace {} in {}'.format(t, self.db))
+                trace_id = r[0][0]
+            col_names, rows, cache = queries.run_query(cursor, self.db, query,
+                                                       [str(a) for a in args], trace_id,
+                                                       tables, queries.generation(cursor))
+        finally:
+            conn.close()
+        return col_names, rows
+
+class _Ingestion(TraceUtil):
+    # an ingestion of TraceUtil which raises its errors and keeps quiet
+    def fail(self, message):
+        raise TraceError(str(message))
+
+    def notice(self, text):
+        pass
+
+def ingest(job):
+    # Trace.ingest() for the workers of a process pool, of a (trace, db) or
+    # (trace, db, options) tuple. The Trace comes back with its state.
+    trace, db = job[:2]
+    options = job[2] if len(job) > 2 else {}
+    return trace.ingest(db, **options)
+
+def _text_lines(f):
+    # the lines of a file object opened in binary mode are decoded
+    for l in f:
+        if isinstance(l, bytes) and bytes is not str:
+            l = l.decode('utf-8', 'replace')
+        yield l
@@ -0,0 +1,311 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import os
+import shutil
+
+# numpy and pyarrow are optional, they are imported when a columnar query
+# or an export needs them.
+
+# Columns of the tables as numpy arrays, exported next to the database by
+# --export and loaded back memory mapped. TEXT columns are dictionary
+# encoded: the array holds int32 codes into the column's 'labels'. The
+# layout of <dbfile>.columns/ is
+#
+#   tables.json          {table: {column: labels or null}}
+#   <table>.<col>.npy    one array per column (npy)
+#   <table>.parquet      one file per table (parquet)
+
+# free text, there is no point in a column of it
+skipped_columns = {'events': ['buf']}
+
+def missing_module(fmt='npy'):
+    # The module a columnar query or export needs which is not installed
+    try:
+        import numpy
+    except ImportError:
+        return 'numpy'
+    if fmt == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            return 'pyarrow'
+    return None
+
+def columns_dir(dbfile):
+    return dbfile + '.columns'
+
+def remove(dbfile):
+    # the export of the tables as they were before -g
+    shutil.rmtree(columns_dir(dbfile), ignore_errors=True)
+
+def is_text(sqltype):
+    return 'CHAR' in sqltype or 'TEXT' in sqltype or 'CLOB' in sqltype
+
+def is_float(sqltype):
+    return 'REAL' in sqltype or 'FLOA' in sqltype or 'DOUB' in sqltype
+
+def read_column(cursor, table, column, sqltype):
+    # One column of a table as (array, labels). Rows are read in rowid
+    # order so that the columns of a table line up, an index could give
+    # any other.
+    import numpy as np
+
+    cursor.execute('SELECT count(*) FROM {}'.format(table))
+    n = cursor.fetchone()[0]
+    rows = cursor.execute('SELECT {} FROM {} ORDER BY rowid'.format(column, table))
+
+    if table == 'events' and column == 'event':
+        # interned already, the labels are in event_names
+        labels = []
+        index = {}
+        for i, name in cursor.connection.execute('SELECT id, name FROM event_names ORDER BY id'):
+            index[i] = len(labels)
+            labels.append(name)
+        return np.fromiter((index[v] for v, in rows), np.int32, n), labels
+
+    if is_text(sqltype):
+        index = {}
+        labels = []
+        codes = np.empty(n, np.int32)
+        for i, (v, ) in enumerate(rows):
+            c = index.get(v)
+            if c is None:
+                c = index[v] = len(labels)
+                labels.append(v)
+            codes[i] = c
+        return codes, labels
+
+    if is_float(sqltype):
+        return np.fromiter((v if v is not None else float('nan') for v, in rows),
+                           np.float64, n), None
+    return np.fromiter((v or 0 for v, in rows), np.int64, n), None
+
+def table_columns(cursor, table):
+    skip = skipped_columns.get(table, [])
+    return [(r[1], r[2].upper()) for r in cursor.execute('PRAGMA table_info({})'.format(table))
+            if r[1] not in skip]
+
+def export(cursor, dbfile, tables, fmt='npy'):
+    import numpy as np
+
+    d = columns_dir(dbfile)
+    remove(dbfile)
+    os.makedirs(d)
+
+    meta = {}
+    for t in tables:
+        columns = {}
+        arrays = []
+        for name, sqltype in table_columns(cursor, t):
+            a, labels = read_column(cursor, t, name, sqltype)
+            columns[name] = labels
+            arrays.append((name, a, labels))
+            if fmt == 'npy':
+                np.save(os.path.join(d, '{}.{}.npy'.format(t, name)), a)
+
+        if fmt == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            data = []
+            for name, a, labels in arrays:
+                if labels is None:
+                    data.append(pyarrow.array(a))
+                else:
+                    data.append(pyarrow.DictionaryArray.from_arrays(a, pyarrow.array(labels)))
+            pyarrow.parquet.write_table(pyarrow.Table.from_arrays(data, [n for n, a, l in arrays]),
+                                        os.path.join(d, '{}.parquet'.format(t)))
+        meta[t] = columns
+
+    with open(os.path.join(d, 'tables.json'), 'w') as f:
+        json.dump(meta, f)
+
+class Columns(object):
+    # One table as columns for the query engine: from the export if there
+    # is one, from the database otherwise.
+    def __init__(self, cursor, dbfile, table):
+        self.cursor = cursor
+        self.table = table
+        self.dir = columns_dir(dbfile)
+        self.meta = None
+        self.parquet = None
+        self.cache = {}
+
+        path = os.path.join(self.dir, 'tables.json')
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.meta = json.load(f).get(table)
+        if self.meta is not None:
+            path = os.path.join(self.dir, '{}.parquet'.format(table))
+            if os.path.isfile(path):
+                import pyarrow.parquet
+                self.parquet = pyarrow.parquet.ParquetFile(path)
+
+    def column(self, name):
+        if name in self.cache:
+            return self.cache[name]
+
+        import numpy as np
+        if self.meta is not None and name in self.meta:
+            labels = self.meta[name]
+            if self.parquet is not None:
+                c = self.parquet.read(columns=[name]).column(0).combine_chunks()
+                a = c.indices.to_numpy() if labels is not None else c.to_numpy()
+            else:
+                a = np.load(os.path.join(self.dir, '{}.{}.npy'.format(self.table, name)),
+                            mmap_mode='r')
+        else:
+            types = dict(table_columns(self.cursor, self.table))
+            if name not in types:
+                raise KeyError(name)
+            a, labels = read_column(self.cursor, self.table, name, types[name])
+
+        self.cache[name] = (a, labels)
+        return a, labels
+
+def _groups(np, cols, by, mask):
+    # Group ids for the rows in 'mask' by the columns 'by', and the key
+    # values of each group
+    n = int(mask.sum())
+    if not by:
+        return np.zeros(n, np.int64), [()]
+
+    keys = []
+    total = 1
+    packed = True
+    for b in by:
+        a, labels = cols.column(b)
+        a = np.asarray(a)[mask]
+        keys.append((a, labels))
+        if n and a.dtype.kind in 'iu':
+            total *= int(a.max()) - int(a.min()) + 1
+        elif n:
+            packed = False
+
+    if packed and total <= np.iinfo(np.int64).max:
+        # the key of a row is its columns packed into one int64
+        combined = np.zeros(n, np.int64)
+        for a, labels in keys:
+            lo = a.min() if n else 0
+            span = int(a.max()) - int(lo) + 1 if n else 1
+            combined = combined * span + (a - lo).astype(np.int64)
+        uniq, first, inverse = np.unique(combined, return_index=True, return_inverse=True)
+    else:
+        # Wide columns would overflow the packed key, the rows are grouped
+        # on the columns side by side instead, each as the ranks of its
+        # values so that the groups come in the same order
+        stacked = np.stack([np.unique(a, return_inverse=True)[1].reshape(-1)
+                            for a, labels in keys], axis=1)
+        uniq, first, inverse = np.unique(stacked, axis=0, return_index=True,
+                                         return_inverse=True)
+    values = []
+    for a, labels in keys:
+        v = a[first].tolist()
+        values.append([labels[c] for c in v] if labels is not None else v)
+    return inverse.reshape(-1), list(zip(*values))
+
+def _where(np, cols, where, args):
+    # rows where each column equals its value, '{}' in the values are
+    # filled in from the query arguments
+    mask = None
+    for name, value in sorted(where.items()):
+        a, labels = cols.column(name)
+        value = str(value).format(*args)
+        a = np.asarray(a)
+        if labels is not None:
+            m = a == (labels.index(value) if value in labels else -1)
+        else:
+            m = a == a.dtype.type(value)
+        mask = m if mask is None else mask & m
+    return mask
+
+def run_query(cursor, dbfile, q, args):
+    # A columnar query of the config, 'kind' is one of
+    #
+    #   percentile  'percentiles' of 'value' per group (default 50, 90, 99)
+    #   histogram   counts of 'value' in power of two buckets per group, or
+    #               in 'bins' equal buckets
+    #   top         the 'n' groups with the largest 'agg' (sum, count,
+    #               mean, min, max) of 'value'
+    #
+    # over 'table', grouped by the columns in 'by' and limited to the rows
+    # matching 'where'. Returns the column names and the rows.
+    import numpy as np
+
+    cols = Columns(cursor, dbfile, q['table'])
+    by = q.get('by', [])
+    value = np.asarray(cols.column(q['value'])[0])
+    mask = _where(np, cols, q.get('where', {}), args)
+    if mask is None:
+        mask = np.ones(len(value), bool)
+    value = value[mask]
+    group, keys = _groups(np, cols, by, mask)
+    ngroups = len(keys)
+
+    counts = np.bincount(group, minlength=ngroups)
+    order = np.lexsort((value, group))
+    ordered = value[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    ends = starts + counts - 1
+
+    kind = q['kind']
+    if kind == 'percentile':
+        percentiles = q.get('percentiles', [50, 90, 99])
+        names = by + ['count'] + ['p{}'.format(p) for p in percentiles]
+        if not len(value):
+            return names, []
+        result = [counts]
+        for p in percentiles:
+            # linear interpolation between the closest ranks, like numpy
+            pos = starts + (counts - 1) * (p / 100.0)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo + 1, ends)
+            frac = pos - lo
+            result.append(ordered[lo] + (ordered[hi] - ordered[lo]) * frac)
+        rows = [k + tuple(r) for k, r in zip(keys, zip(*[c.tolist() for c in result]))
+                if r[0] > 0]
+        return names, rows
+
+    if kind == 'histogram':
+        bins = q.get('bins')
+        if bins:
+            lo, hi = (value.min().item(), value.max().item()) if len(value) else (0, 1)
+            width = max((hi - lo) / float(bins), 1e-12)
+            bucket = np.minimum(((value - lo) / width).astype(np.int64), bins - 1)
+            edges = [(lo + i * width, lo + (i + 1) * width) for i in range(bins)]
+        else:
+            # bucket 0 holds what is below 1, bucket i [2^(i-1), 2^i)
+            v = np.maximum(value, 1)
+            bucket = np.where(value >= 1, np.floor(np.log2(v)).astype(np.int64) + 1, 0)
+            bins = int(bucket.max()) + 1 if len(bucket) else 1
+            edges = [(0, 1)] + [(2 ** (i - 1), 2 ** i) for i in range(1, bins)]
+        hist = np.bincount(group * bins + bucket, minlength=ngroups * bins)
+        rows = []
+        for g, b in zip(*np.nonzero(hist.reshape(ngroups, bins))):
+            rows.append(keys[g] + edges[b] + (int(hist[g * bins + b]),))
+        return by + ['low', 'high', 'count'], rows
+
+    if kind == 'top':
+        agg = q.get('agg', 'sum')
+        names = by + ['{}({})'.format(agg, q['value'])]
+        if not len(value):
+            return names, []
+        if agg == 'count':
+            result = counts
+        elif agg == 'sum':
+            result = np.bincount(group, weights=value, minlength=ngroups)
+            if value.dtype.kind == 'i':
+                result = result.astype(np.int64)
+        elif agg == 'mean':
+            result = np.bincount(group, weights=value, minlength=ngroups) / np.maximum(counts, 1)
+        elif agg == 'min':
+            result = ordered[starts]
+        elif agg == 'max':
+            result = ordered[ends]
+        else:
+            raise ValueError('unknown aggregate {}'.format(agg))
+        n = int(str(q.get('n', 10)).format(*args))
+        top = [g for g in np.argsort(-result, kind='stable') if counts[g] > 0][:n]
+        return names, [keys[g] + (result[g].item(), ) for g in top]
+
+    raise ValueError('unknown query kind {}'.format(kind))
@@ -0,0 +1,167 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import re
+import sqlite3
+
+# --explain: the plan SQLite picks for each SQL query of the config, from
+# EXPLAIN QUERY PLAN, with what gets slow on a large database flagged:
+#
+#   full scan of T      every row of table T is read, no index is searched
+#   temp B-tree for X   the rows are sorted into a temporary B-tree for the
+#                       GROUP BY, ORDER BY or DISTINCT X
+#
+# For a query with either, an index is suggested that would do without: on
+# the columns of the table it compares for equality, then those it groups
+# and orders by, then those it compares by range, and then the rest of the
+# ones it reads, so that the index covers the query. It is only suggested
+# if the query plans better with it, which is tried on a copy of the schema
+# in memory.
+
+_scan = re.compile(r'^SCAN (?:TABLE )?(?:\w+\.)?(\w+)(?: AS (\w+))?$')
+_temp = re.compile(r'^USE TEMP B-TREE FOR (.*)$')
+_clause = r'\b{}\s+BY\s+(.*?)(?=\bGROUP\b|\bORDER\b|\bLIMIT\b|\bHAVING\b|\bWINDOW\b|\)|;|$)'
+_keywords = set(['ON', 'WHERE', 'JOIN', 'CROSS', 'INNER', 'LEFT', 'NATURAL', 'GROUP',
+                 'ORDER', 'LIMIT', 'USING', 'UNION', 'HAVING', 'WINDOW', 'AS'])
+
+def plan(cursor, sql):
+    # the lines of the plan of 'sql', as EXPLAIN QUERY PLAN details
+    return [r[3] for r in cursor.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+def problems(details, sql, tables):
+    # the full scans, as (table, None), and the temp B-trees, as (None,
+    # what for), of a plan. 'tables' are the tables of the database, the
+    # names in the plan may be aliases of them.
+    aliases = dict((t, t) for t in tables)
+    for t in tables:
+        for m in re.finditer(r'\b{}\s+(?:AS\s+)?(\w+)'.format(re.escape(t)), sql, re.I):
+            if m.group(1).upper() not in _keywords:
+                aliases.setdefault(m.group(1), t)
+
+    found = []
+    for d in details:
+        m = _scan.match(d)
+        if m is not None and aliases.get(m.group(2) or m.group(1)) is not None:
+            found.append((aliases[m.group(2) or m.group(1)], None))
+            continue
+        m = _temp.match(d)
+        if m is not None:
+            found.append((None, m.group(1)))
+    return found
+
+def describe(found):
+    return '; '.join('full scan of {}'.format(t) if t is not None
+                     else 'temp B-tree for {}'.format(what) for t, what in found)
+
+def candidate(sql, columns):
+    # the columns of 'columns' (of one table) 'sql' reads, in the order an
+    # index on them would serve it best
+    def named(text):
+        return [c for c in columns
+                if re.search(r'(?<!\w){}\b'.format(re.escape(c)), text) is not None]
+
+    eq = [c for c in columns
+          if re.search(r'\b{}\s*=(?!=)'.format(re.escape(c)), sql) is not None]
+    grouped = []
+    for m in re.finditer(_clause.format('GROUP'), sql, re.I | re.S):
+        grouped.extend(named(m.group(1)))
+    ordered = []
+    for m in re.finditer(_clause.format('ORDER'), sql, re.I | re.S):
+        ordered.extend(named(m.group(1)))
+    ranged = [c for c in columns
+              if re.search(r'\b{}\s*(?:[<>]|!=|\bBETWEEN\b)'.format(re.escape(c)), sql,
+                           re.I) is not None]
+
+    cols = []
+    for c in eq + grouped + ordered + ranged + named(sql):
+        if c not in cols:
+            cols.append(c)
+    return cols
+
+def schema_copy(cursor):
+    # the tables, indexes and views of the database, empty, in memory.
+    # The tables behind a virtual table come with it.
+    conn = sqlite3.connect(':memory:')
+    # the savepoints of advise() are not to be committed under them
+    conn.isolation_level = None
+    for sql, in cursor.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL "
+                               "AND name NOT LIKE 'sqlite_%' ORDER BY rowid").fetchall():
+        try:
+            conn.execute(sql)
+        except sqlite3.Error:
+            pass
+    return conn
+
+def advise(cursor, sql, found, columns):
+    # The index, as (table, columns), which takes the most of the 'found'
+    # problems of 'sql' away, or None. 'columns' are the columns of each
+    # table.
+    scanned = [t for t, what in found if t is not None]
+    if not scanned and found:
+        # what a temp B-tree is for is read off the tables the query names
+        scanned = [t for t in columns
+                   if re.search(r'\b{}\b'.format(re.escape(t)), sql) is not None]
+
+    best = None
+    conn = None
+    try:
+        for t in scanned:
+            cols = candidate(sql, columns[t])
+            if not cols:
+                continue
+            if conn is None:
+                conn = schema_copy(cursor)
+            c = conn.cursor()
+            c.execute('SAVEPOINT advise')
+            try:
+                c.execute('CREATE INDEX explain_candidate ON {} ({})'.format(t, ','.join(cols)))
+                left = len(problems(plan(c, sql), sql, list(columns)))
+            except sqlite3.Error:
+                left = len(found)
+            finally:
+                c.execute('ROLLBACK TO advise')
+                c.execute('RELEASE advise')
+            if left < len(found) and (best is None or left < best[0]):
+                best = (left, t, cols)
+    finally:
+        if conn is not None:
+            conn.close()
+    return None if best is None else best[1:]
+
+def explain(cursor, config_queries, qargs=None):
+    # A row of (number, name, plan, problems, suggested index) for each
+    # query of the config. The queries are planned with the -a arguments,
+    # 0 for each argument of a query beyond them.
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    tables = [r[0] for r in cursor.fetchall()]
+    columns = dict((t, [r[1] for r in cursor.execute('PRAGMA table_info({})'.format(t))])
+                   for t in tables)
+
+    rows = []
+    for i, query in enumerate(config_queries):
+        kind = query.get('kind', 'sql')
+        if kind != 'sql':
+            rows.append((i + 1, query['name'], '{} of {}.{}, worked out with numpy'.format(
+                kind, query.get('table'), query.get('value')), '', ''))
+            continue
+        if 'query' not in query:
+            rows.append((i + 1, query['name'], 'not implemented', '', ''))
+            continue
+
+        # the -a arguments go to every query, as many of them as it takes
+        n = len(query.get('args', []))
+        args = (list(qargs or []) + ['0'] * n)[:n]
+        try:
+            sql = query['query'].format(*args)
+            details = plan(cursor, sql)
+        except (sqlite3.Error, IndexError) as e:
+            rows.append((i + 1, query['name'], '', 'cannot plan: {}'.format(e), ''))
+            continue
+
+        found = problems(details, sql, tables)
+        suggestion = ''
+        if found:
+            index = advise(cursor, sql, found, columns)
+            if index is not None:
+                suggestion = '{} ({})'.format(index[0], ', '.join(index[1]))
+        rows.append((i + 1, query['name'], '\n'.join(details), describe(found), suggestion))
+    return rows
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Deterministic synthetic ftrace generator. The same arguments always give
+# the same trace, byte for byte.
+#
+#   $ python traceworks/gentrace.py -n 1000000 --cpus 8 --pids 64 \
+#         --mix syscall=70,sched_switch=15,cpu_idle=5,irq=10 --missing 0.01 -o trace.txt
+#
+# Each CPU runs one task at a time, sched_switch hands it over to another
+# one or to the idle task. A task on a CPU enters and exits syscalls, the
+# sys_enter/sys_exit pairs the shipped config matches. cpu_idle is only
+# logged by idle CPUs and irq by any CPU. With --missing a share of the
+# events is left out, as when the kernel drops events, which is what the
+# entry/exit mismatches come from. With --dat the same events are written
+# as the trace.dat of trace-cmd record.
+
+import argparse
+import random
+import shutil
+import struct
+import sys
+import tempfile
+
+syscalls = ['sys_read', 'sys_write', 'sys_openat', 'sys_close', 'sys_futex', 'sys_mmap']
+comms = ['bash', 'gnome-shell', 'kworker/0:1', 'sshd', 'python3', 'Xorg', 'systemd']
+
+default_mix = 'syscall=70,sched_switch=15,cpu_idle=5,irq=10'
+
+def parse_mix(mix):
+    weights = []
+    for part in mix.split(','):
+        name, w = part.split('=')
+        if name not in ('syscall', 'sched_switch', 'cpu_idle', 'irq'):
+            raise ValueError('unknown event kind {}'.format(name))
+        weights.append((name, float(w)))
+    return weights
+
+def generate(lines, cpus=8, pids=64, mix=default_mix, missing=0.0, seed=0, gap=50):
+    # (timestamp in microseconds, cpu, pid, kind, fields) of each event,
+    # which write_trace() prints and write_dat() packs
+    rnd = random.Random(seed)
+    weights = parse_mix(mix)
+    total = sum(w for n, w in weights)
+    cumulative = []
+    acc = 0.0
+    for name, w in weights:
+        acc += w / total
+        cumulative.append((acc, name))
+
+    tasks = list(range(1000, 1000 + pids))
+    comm = dict((p, comms[p % len(comms)]) for p in tasks)
+    running = [0] * cpus
+    insyscall = {}
+    ts = 1000000000000
+
+    for i in range(lines):
+        ts += rnd.randint(1, gap)
+        cpu = rnd.randrange(cpus)
+        pid = running[cpu]
+        r = rnd.random()
+        kind = cumulative[-1][1]
+        for acc, name in cumulative:
+            if r < acc:
+                kind = name
+                break
+        # idle CPUs make no syscalls, and log being idle
+        if kind == 'syscall' and pid == 0:
+            kind = 'cpu_idle'
+        elif kind == 'cpu_idle' and pid != 0:
+            kind = 'syscall'
+
+        if kind == 'sched_switch':
+            nxt = 0 if rnd.random() < 0.3 else rnd.choice(tasks)
+            if nxt in running:
+                # a task only runs on one CPU at a time
+                nxt = 0
+            fields = (comm.get(pid, 'swapper/{}'.format(cpu)), pid, 'R' if pid == 0 else 'S',
+                      comm.get(nxt, 'swapper/{}'.format(cpu)), nxt)
+            running[cpu] = nxt
+        elif kind == 'syscall':
+            call = insyscall.pop(pid, None)
+            if call is not None:
+                kind = 'sys_exit'
+                fields = (call, rnd.randrange(4096))
+            else:
+                kind = 'sys_enter'
+                call = rnd.choice(syscalls)
+                insyscall[pid] = call
+                fields = (call, rnd.randrange(64))
+        elif kind == 'cpu_idle':
+            fields = (rnd.choice((1, 2, 4294967295)), cpu)
+        else:
+            fields = (rnd.randrange(16, 48),)
+
+        if missing and rnd.random() < missing:
+            continue
+        yield ts, cpu, pid, kind, fields
+
+# the flags column of each kind of event
+flags = {'sched_switch': 'd..2.', 'sys_enter': '.....', 'sys_exit': '.....',
+         'cpu_idle': 'd..1.', 'irq': 'd.h..'}
+
+def body(kind, fields):
+    if kind == 'sched_switch':
+        return ('sched_switch: prev_comm={} prev_pid={} prev_prio=120 prev_state={} '
+                '==> next_comm={} next_pid={} next_prio=120'.format(*fields))
+    if kind == 'sys_enter':
+        # the kernel prints arguments below 10 in decimal
+        name, fd = fields
+        return '{}(fd: {}, buf: 0x7ffd1234, count: 0x1000)'.format(
+            name, fd if fd < 10 else hex(fd))
+    if kind == 'sys_exit':
+        return '{} -> 0x{:x}'.format(*fields)
+    if kind == 'cpu_idle':
+        return 'cpu_idle: state={} cpu_id={}'.format(*fields)
+    return 'irq_handler_entry: irq={} name=eth0'.format(*fields)
+
+def write_trace(f, lines, cpus=8, pids=64, mix=default_mix, missing=0.0, seed=0,
+                gap=50):
+    comm = dict((p, comms[p % len(comms)]) for p in range(1000, 1000 + pids))
+    f.write('# tracer: nop\n#\n'
+            '#           TASK-PID   CPU#  |||||    TIMESTAMP  FUNCTION\n'
+            '#              | |       |   |||||       |         |\n')
+    out = []
+    for ts, cpu, pid, kind, fields in generate(lines, cpus, pids, mix, missing, seed, gap):
+        out.append('{:>16}-{:<5d} [{:03d}] {} {}.{:06d}: {}\n'.format(
+            comm.get(pid, '<idle>'), pid, cpu, flags[kind], ts // 1000000, ts % 1000000,
+            body(kind, fields)))
+        if len(out) == 10000:
+            f.write(''.join(out))
+            out = []
+    f.write(''.join(out))
+
+# The same events as a trace-cmd trace.dat (file version 6, little endian,
+# 64 bit, 4k pages), with the formats of the events as a 5.x kernel has
+# them. The records of each CPU are packed into ring buffer pages in a
+# temporary file of their own, which are then put together.
+page_size = 4096
+page_data = page_size - 16
+
+header_page = (
+    '\tfield: u64 timestamp;\toffset:0;\tsize:8;\tsigned:0;\n'
+    '\tfield: local_t commit;\toffset:8;\tsize:8;\tsigned:1;\n'
+    '\tfield: int overwrite;\toffset:8;\tsize:1;\tsigned:1;\n'
+    '\tfield: char data;\toffset:16;\tsize:{};\tsigned:1;\n'.format(page_data))
+
+header_event = (
+    '# compressed entry header\n'
+    '\ttype_len    :    5 bits\n'
+    '\ttime_delta  :   27 bits\n'
+    '\tarray       :   32 bits\n\n'
+    '\tpadding     : type == 29\n'
+    '\ttime_extend : type == 30\n'
+    '\ttime_stamp : type == 31\n'
+    '\tdata max type_len  == 28\n')
+
+common_fields = (
+    '\tfield:unsigned short common_type;\toffset:0;\tsize:2;\tsigned:0;\n'
+    '\tfield:unsigned char common_flags;\toffset:2;\tsize:1;\tsigned:0;\n'
+    '\tfield:unsigned char common_preempt_count;\toffset:3;\tsize:1;\tsigned:0;\n'
+    '\tfield:int common_pid;\toffset:4;\tsize:4;\tsigned:1;\n\n')
+
+task_states = '0x0000 | 0x0001 | 0x0002 | 0x0004 | 0x0008 | 0x0010 | 0x0020 | 0x0040'
+sched_switch_format = (
+    '\tfield:char prev_comm[16];\toffset:8;\tsize:16;\tsigned:0;\n'
+    '\tfield:pid_t prev_pid;\toffset:24;\tsize:4;\tsigned:1;\n'
+    '\tfield:int prev_prio;\toffset:28;\tsize:4;\tsigned:1;\n'
+    '\tfield:long prev_state;\toffset:32;\tsize:8;\tsigned:1;\n'
+    '\tfield:char next_comm[16];\toffset:40;\tsize:16;\tsigned:0;\n'
+    '\tfield:pid_t next_pid;\toffset:56;\tsize:4;\tsigned:1;\n'
+    '\tfield:int next_prio;\toffset:60;\tsize:4;\tsigned:1;\n\n'
+    'print fmt: "prev_comm=%s prev_pid=%d prev_prio=%d prev_state=%s%s ==> next_comm=%s '
+    'next_pid=%d next_prio=%d", REC->prev_comm, REC->prev_pid, REC->prev_prio, '
+    '(REC->prev_state & (((({0}) + 1) << 1) - 1)) ? __print_flags(REC->prev_state & '
+    '(((({0}) + 1) << 1) - 1), "|", {{ 0x0001, "S" }}, {{ 0x0002, "D" }}, '
+    '{{ 0x0004, "T" }}, {{ 0x0008, "t" }}, {{ 0x0010, "X" }}, {{ 0x0020, "Z" }}, '
+    '{{ 0x0040, "P" }}, {{ 0x0080, "I" }}) : "R", REC->prev_state & ((({0}) + 1) << 1) '
+    '? "+" : "", REC->next_comm, REC->next_pid, REC->next_prio\n'.format(task_states))
+
+sys_enter_format = (
+    '\tfield:int __syscall_nr;\toffset:8;\tsize:4;\tsigned:1;\n'
+    '\tfield:unsigned int fd;\toffset:16;\tsize:8;\tsigned:0;\n'
+    '\tfield:char * buf;\toffset:24;\tsize:8;\tsigned:0;\n'
+    '\tfield:size_t count;\toffset:32;\tsize:8;\tsigned:0;\n\n'
+    'print fmt: "fd: 0x%08lx, buf: 0x%08lx, count: 0x%08lx", ((unsigned long)(REC->fd)), '
+    '((unsigned long)(REC->buf)), ((unsigned long)(REC->count))\n')
+
+sys_exit_format = (
+    '\tfield:int __syscall_nr;\toffset:8;\tsize:4;\tsigned:1;\n'
+    '\tfield:long ret;\toffset:16;\tsize:8;\tsigned:1;\n\n'
+    'print fmt: "0x%lx", REC->ret\n')
+
+cpu_idle_format = (
+    '\tfield:u32 state;\toffset:8;\tsize:4;\tsigned:0;\n'
+    '\tfield:u32 cpu_id;\toffset:12;\tsize:4;\tsigned:0;\n\n'
+    'print fmt: "state=%lu cpu_id=%lu", REC->state, REC->cpu_id\n')
+
+irq_format = (
+    '\tfield:int irq;\toffset:8;\tsize:4;\tsigned:1;\n'
+    '\tfield:__data_loc char[] name;\toffset:12;\tsize:4;\tsigned:1;\n\n'
+    'print fmt: "irq=%d name=%s", REC->irq, __get_str(name)\n')
+
+def event_format(name, id, fields):
+    return 'name: {}\nID: {}\nformat:\n{}{}'.format(name, id, common_fields, fields)
+
+# common_flags and common_preempt_count of each kind of event
+latency = {'sched_switch': (0x01, 2), 'sys_enter': (0, 0), 'sys_exit': (0, 0),
+           'cpu_idle': (0x01, 1), 'irq': (0x09, 0)}
+
+def write_dat(f, lines, cpus=8, pids=64, mix=default_mix, missing=0.0, seed=0, gap=50):
+    ids = {'sched_switch': 316, 'cpu_idle': 400, 'irq': 450}
+    systems = [('sched', [event_format('sched_switch', 316, sched_switch_format)]),
+               ('power', [event_format('cpu_idle', 400, cpu_idle_format)]),
+               ('irq', [event_format('irq_handler_entry', 450, irq_format)])]
+    formats = []
+    for i, call in enumerate(syscalls):
+        n = call[len('sys_'):]
+        ids[('sys_enter', call)] = 600 + 2 * i
+        ids[('sys_exit', call)] = 601 + 2 * i
+        formats.append(event_format('sys_enter_' + n, 600 + 2 * i, sys_enter_format))
+        formats.append(event_format('sys_exit_' + n, 601 + 2 * i, sys_exit_format))
+    systems.append(('syscalls', formats))
+
+    f.write(b'\x17\x08\x44tracing6\0\0\x08' + struct.pack('<I', page_size))
+    for name, text in (('header_page', header_page), ('header_event', header_event)):
+        text = text.encode('ascii')
+        f.write(name.encode('ascii') + b'\0' + struct.pack('<Q', len(text)) + text)
+    f.write(struct.pack('<I', 0))
+    f.write(struct.pack('<I', len(systems)))
+    for system, texts in systems:
+        f.write(system.encode('ascii') + b'\0' + struct.pack('<I', len(texts)))
+        for text in texts:
+            text = text.encode('ascii')
+            f.write(struct.pack('<Q', len(text)) + text)
+    # no kallsyms and printk formats
+    f.write(struct.pack('<I', 0) + struct.pack('<I', 0))
+    cmdlines = ''.join('{} {}\n'.format(p, comms[p % len(comms)])
+                       for p in range(1000, 1000 + pids)).encode('ascii')
+    f.write(struct.pack('<Q', len(cmdlines)) + cmdlines)
+    f.write(struct.pack('<I', cpus))
+    f.write(b'options  \0' + struct.pack('<H', 0))
+    f.write(b'flyrecord\0')
+    table = f.tell()
+    f.write(b'\0' * 16 * cpus)
+
+    pages = [tempfile.TemporaryFile() for cpu in range(cpus)]
+    data = [bytearray() for cpu in range(cpus)]
+    page_ts = [0] * cpus
+    last = [0] * cpus
+    def flush(cpu):
+        page = struct.pack('<QQ', page_ts[cpu], len(data[cpu])) + bytes(data[cpu])
+        pages[cpu].write(page + b'\0' * (page_size - len(page)))
+        data[cpu] = bytearray()
+
+    try:
+        for ts, cpu, pid, kind, fields in generate(lines, cpus, pids, mix, missing, seed, gap):
+            ns = ts * 1000
+            payload = record(ids, kind, pid, fields)
+            if len(data[cpu]) + 8 + len(payload) > page_data:
+                flush(cpu)
+            if not data[cpu]:
+                page_ts[cpu] = last[cpu] = ns
+            delta = ns - last[cpu]
+            last[cpu] = ns
+            if delta >= 1 << 27:
+                data[cpu] += struct.pack('<II', 30 | (delta & ((1 << 27) - 1)) << 5, delta >> 27)
+                delta = 0
+            data[cpu] += struct.pack('<I', len(payload) // 4 | delta << 5) + payload
+        for cpu in range(cpus):
+            if data[cpu]:
+                flush(cpu)
+
+        offsets = []
+        for cpu in range(cpus):
+            f.write(b'\0' * (-f.tell() % page_size))
+            offsets.append((f.tell(), pages[cpu].tell()))
+            pages[cpu].seek(0)
+            shutil.copyfileobj(pages[cpu], f)
+        f.seek(table)
+        for offset, size in offsets:
+            f.write(struct.pack('<QQ', offset, size))
+    finally:
+        for p in pages:
+            p.close()
+
+def record(ids, kind, pid, fields):
+    # the data of a record, of at most 112 bytes which the type_len of its
+    # header has room for
+    flags, preempt = latency[kind]
+    if kind == 'sched_switch':
+        prev_comm, prev_pid, state, next_comm, next_pid = fields
+        return struct.pack('<HBBi16siiq16sii', ids[kind], flags, preempt, pid,
+                           prev_comm.encode('ascii'), prev_pid, 120, 0 if state == 'R' else 1,
+                           next_comm.encode('ascii'), next_pid, 120)
+    if kind == 'sys_enter':
+        call, fd = fields
+        return struct.pack('<HBBii4xQQQ', ids[(kind, call)], flags, preempt, pid, 0,
+                           fd, 0x7ffd1234, 0x1000)
+    if kind == 'sys_exit':
+        call, ret = fields
+        return struct.pack('<HBBii4xq', ids[(kind, call)], flags, preempt, pid, 0, ret)
+    if kind == 'cpu_idle':
+        return struct.pack('<HBBiII', ids[kind], flags, preempt, pid, *fields)
+    return struct.pack('<HBBiiI8s', ids[kind], flags, preempt, pid, fields[0],
+                       16 | 5 << 16, b'eth0')
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic ftrace generator')
+    parser.add_argument('--lines', '-n', type=int, default=1000000,
+                        help='number of events to generate, before --missing')
+    parser.add_argument('--cpus', type=int, default=8, help='number of CPUs')
+    parser.add_argument('--pids', type=int, default=64, help='number of tasks')
+    parser.add_argument('--mix', type=str, default=default_mix,
+                        help='relative weights of syscall, sched_switch, cpu_idle and irq events')
+    parser.add_argument('--missing', type=float, default=0.0,
+                        help='share of the events to leave out')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', '-o', type=str, help='trace file, stdout by default')
+    parser.add_argument('--dat', action='store_true',
+                        help='write a trace-cmd trace.dat instead of text, to --output')
+    args = parser.parse_args()
+
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        print('Invalid --mix: {}'.format(e))
+        exit(1)
+    if args.dat:
+        if not args.output:
+            print('A trace.dat needs an --output file')
+            exit(1)
+        with open(args.output, 'wb') as f:
+            write_dat(f, args.lines, args.cpus, args.pids, args.mix, args.missing, args.seed)
+        return
+
+    f = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        write_trace(f, args.lines, args.cpus, args.pids, args.mix, args.missing, args.seed)
+    finally:
+        if args.output:
+            f.close()
+
+if __name__ == '__main__':
+    main()
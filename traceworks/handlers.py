@@ -0,0 +1,351 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from operator import attrgetter
+
+try:
+    from .utils import parse_sched_details
+except (ImportError, ValueError):
+    from utils import parse_sched_details
+
+insert_batch = 50000           # rows per executemany() call
+
+# The raw events of --events. Event names are interned into event_names.
+events_schema = ['CREATE TABLE IF NOT EXISTS event_names (id INTEGER PRIMARY KEY, name TEXT UNIQUE)',
+                 'CREATE TABLE IF NOT EXISTS events (ts INTEGER, cpu INTEGER, pid INTEGER, '
+                 'event INTEGER, comm TEXT, buf TEXT)']
+
+def compile_action(action, slot, sample=None):
+    name = action['store_name']
+    store = slot[name]
+    operation = action['operation']
+
+    # An unset slot is None. Timestamps and durations are both integer
+    # microseconds, so every field starts off as 0.
+    if operation == 'store':
+        get = attrgetter(action['field'])
+        def run(parsed, rec):
+            rec[store] = get(parsed)
+    elif operation == 'difference' and sample is not None:
+        field = slot[action['field']]
+        get = attrgetter(action['field'])
+        def run(parsed, rec):
+            if rec[store] is None:
+                rec[store] = 0
+            if rec[field] is not None:
+                d = get(parsed) - rec[field]
+                rec[store] += d
+                sample(name, parsed, d)
+    elif operation == 'difference':
+        field = slot[action['field']]
+        get = attrgetter(action['field'])
+        def run(parsed, rec):
+            if rec[store] is None:
+                rec[store] = 0
+            if rec[field] is not None:
+                rec[store] += get(parsed) - rec[field]
+    elif operation == 'increment' and sample is not None:
+        def run(parsed, rec):
+            v = rec[store]
+            rec[store] = 1 if v is None else v + 1
+            sample(name, parsed, None)
+    elif operation == 'increment':
+        def run(parsed, rec):
+            v = rec[store]
+            rec[store] = 1 if v is None else v + 1
+    else:
+        def run(parsed, rec):
+            if rec[store] is None:
+                rec[store] = 0
+
+    return run
+
+class Handler(object):
+    # A config entry compiled for the per-line path. The hierarchy, the
+    # patterns and the actions are resolved once here, so feed() does not
+    # look anything up in the JSON config.
+    #
+    # The aggregates are kept in 'data', keyed by the tuple of hierarchy
+    # values. Each record is a list with one slot per field the actions
+    # use (see 'slot') and the two entry/exit state slots at the end.
+    # 'report' is called with the flag and the missing side of an
+    # entry/exit mismatch, and 'sample', if given, with every difference
+    # and increment the actions make (see Summary.sampler()).
+    def __init__(self, cfg, report, sample=None):
+        self.cfg = cfg
+        self.name = cfg['name']
+        self.table = cfg['table_name']
+        self.fields = cfg['fields']
+        self.hierarchy = tuple(cfg['hierarchy'].split('->'))
+        self.data = {}
+        self.report = report
+        self.sample = sample
+
+        get = attrgetter(*self.hierarchy)
+        if len(self.hierarchy) == 1:
+            self.keys = lambda parsed: (get(parsed),)
+        else:
+            self.keys = get
+
+        entry_actions = cfg.get('entry_action', [])
+        exit_actions = cfg.get('exit_action', [])
+
+        # record layout
+        names = []
+        for a in entry_actions + exit_actions:
+            names.append(a['store_name'])
+            if a['operation'] == 'difference':
+                names.append(a['field'])
+        names.extend(f for f in self.fields if f not in self.hierarchy)
+        self.slot = {}
+        for n in names:
+            self.slot.setdefault(n, len(self.slot))
+        self.last_action = len(self.slot)
+        self.last_action_s = self.last_action + 1
+        self.width = self.last_action_s + 1
+
+        # table columns, either an index into the keys or into the record
+        self.columns = []
+        for f in self.fields:
+            if f in self.hierarchy:
+                self.columns.append((True, self.hierarchy.index(f)))
+            else:
+                self.columns.append((False, self.slot[f]))
+
+        # fields set by a 'store', the others accumulate
+        self.stores = set(a['store_name'] for a in entry_actions + exit_actions
+                          if a['operation'] == 'store')
+
+        self.entry_pattern = cfg['entry_pattern'] if 'entry_pattern' in cfg else None
+        self.exit_pattern = cfg['exit_pattern'] if 'exit_pattern' in cfg else None
+        self.entry = self.compile_actions(cfg.get('entry_action'))
+        self.exit = self.compile_actions(cfg.get('exit_action'))
+        self.step = self.compile_step()
+
+        # A closed record can be written out and dropped if the entry
+        # action stores everything the exit action takes a difference from,
+        # as the next entry then starts it over.
+        entry_stores = set(a['store_name'] for a in entry_actions
+                           if a['operation'] == 'store')
+        self.evictable = ((self.entry_pattern is None) != (self.exit_pattern is None)
+                          and all(a['field'] in entry_stores
+                                  for a in exit_actions
+                                  if a['operation'] == 'difference'))
+
+    def compile_actions(self, actions):
+        if actions is None:
+            return None
+
+        ops = [compile_action(a, self.slot, self.sample) for a in actions]
+        if len(ops) == 1:
+            return ops[0]
+
+        def run(parsed, rec):
+            for op in ops:
+                op(parsed, rec)
+        return run
+
+    def compile_step(self):
+        steps = []
+        if self.entry_pattern is not None:
+            steps.append(self.entry_pattern_step())
+        if self.exit_pattern is not None:
+            steps.append(self.exit_pattern_step())
+
+        if not steps:
+            return lambda rec, parsed: None
+        if len(steps) == 1:
+            return steps[0]
+
+        first, second = steps
+        def step(rec, parsed):
+            first(rec, parsed)
+            second(rec, parsed)
+        return step
+
+    def entry_pattern_step(self):
+        # One line can either be a entry or an exit, and any on of the
+        # actions will be executed, cannot be both.
+        #
+        # Ensure that an entry_pattern has to be the first match for every
+        # cpu (sched_switch case). Also, for every cpu entry->entry (two
+        # consecutive entries) and exit->exit (2 consecutive exits) are
+        # ignored.
+        pattern, entry, exit, report = (self.entry_pattern, self.entry,
+                                        self.exit, self.report)
+        state = self.last_action
+        def step(rec, parsed):
+            if pattern in parsed.buf:
+                if entry is not None:
+                    if rec[state] != 'entry':
+                        entry(parsed, rec)
+                        rec[state] = 'entry'
+                    else:
+                        report('entry', 'exit', parsed)
+            elif exit is not None:
+                if rec[state] == 'entry':
+                    exit(parsed, rec)
+                    rec[state] = 'exit'
+                else:
+                    report('entry', 'entry', parsed)
+        return step
+
+    def exit_pattern_step(self):
+        pattern, entry, exit, report = (self.exit_pattern, self.entry,
+                                        self.exit, self.report)
+        state = self.last_action_s
+        def step(rec, parsed):
+            if pattern in parsed.buf:
+                if exit is not None:
+                    if rec[state] == 'entry':
+                        exit(parsed, rec)
+                        rec[state] = 'exit'
+                    else:
+                        report('exit', 'entry', parsed)
+            elif entry is not None:
+                if rec[state] != 'entry':
+                    entry(parsed, rec)
+                    rec[state] = 'entry'
+                else:
+                    report('exit', 'exit', parsed)
+        return step
+
+    def new_record(self):
+        return [None] * self.width
+
+    def record(self, keys):
+        rec = self.data.get(keys)
+        if rec is None:
+            rec = self.data[keys] = [None] * self.width
+        return rec
+
+    def feed(self, parsed):
+        self.step(self.record(self.keys(parsed)), parsed)
+
+    def closed(self, rec):
+        return rec[self.last_action] != 'entry' and rec[self.last_action_s] != 'entry'
+
+    def row(self, keys, rec):
+        # the table row of a record, None until every field has been set
+        row = []
+        for is_key, i in self.columns:
+            v = keys[i] if is_key else rec[i]
+            if v is None:
+                return None
+            row.append(v)
+
+        return row
+
+    def rows(self):
+        for keys, rec in self.data.items():
+            row = self.row(keys, rec)
+            if row is not None:
+                yield row
+
+class EventStore(object):
+    # Every parsed event, for the raw 'events' table. It takes part in the
+    # dispatch like a config entry with an empty name, which all events
+    # match. Event names are interned, 'names' maps them to their id in the
+    # event_names table. Rows are handed to 'write' 'batch' at a time,
+    # along with the names that are new since the last call.
+    name = ''
+
+    def __init__(self, write, batch):
+        self.write = write
+        self.batch = batch
+        self.names = {}
+        self.new_names = []
+        self.rows = []
+
+    def load(self, names):
+        # (id, name) pairs already stored
+        self.names = dict((n, i) for i, n in names)
+
+    def feed(self, parsed):
+        i = self.names.get(parsed.name)
+        if i is None:
+            i = self.names[parsed.name] = len(self.names) + 1
+            self.new_names.append((i, parsed.name))
+
+        self.rows.append((parsed.timestamp, parsed.cpu, parsed.pid, i,
+                          parsed.process_name, parsed.buf))
+        if len(self.rows) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.rows or self.new_names:
+            self.write(self.new_names, self.rows)
+            self.new_names = []
+            self.rows = []
+
+def store_events(cursor, names, rows):
+    # the 'write' of an EventStore into the tables of events_schema
+    cursor.execute('BEGIN')
+    cursor.executemany('INSERT INTO event_names VALUES (?, ?)', names)
+    cursor.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)', rows)
+    cursor.execute('COMMIT')
+
+class SchedIntervals(object):
+    # What ran on each CPU when, for the 'sched_intervals' table. Every
+    # sched_switch ends the run in progress on its CPU, which started at
+    # the previous sched_switch there, and starts the run of next_pid.
+    # 'open' holds the run in progress on each CPU as (pid, comm, start),
+    # 'first' the time of the first sched_switch of each CPU which had none,
+    # so that runs across the chunks of --jobs can be joined up. Rows of
+    # (cpu, pid, comm, start_ts, end_ts) are handed to 'write' 'batch' at a
+    # time.
+    name = 'sched_switch'
+
+    def __init__(self, write=None, batch=None):
+        self.write = write
+        self.batch = batch
+        self.open = {}
+        self.first = {}
+        self.last = None
+        self.rows = []
+
+    def feed(self, parsed):
+        try:
+            d = parse_sched_details(parsed.buf)
+        except (KeyError, ValueError, IndexError):
+            # not the prev_pid=... next_pid=... format
+            return
+        cpu, ts = parsed.cpu, parsed.timestamp
+        o = self.open.get(cpu)
+        if o is not None:
+            self.rows.append((cpu, o[0], o[1], o[2], ts))
+        elif cpu not in self.first:
+            self.first[cpu] = ts
+        self.open[cpu] = (d['next_pid'], d.get('next_comm'), ts)
+        if self.last is None or ts > self.last:
+            self.last = ts
+
+        if self.batch and len(self.rows) >= self.batch:
+            self.flush()
+
+    def join(self, first, rows, open, last):
+        # Carry on with what a --jobs worker found in its chunk, which
+        # comes right after everything fed so far
+        for cpu, ts in first.items():
+            o = self.open.get(cpu)
+            if o is not None:
+                self.rows.append((cpu, o[0], o[1], o[2], ts))
+        self.rows.extend(rows)
+        self.open.update(open)
+        if last is not None and (self.last is None or last > self.last):
+            self.last = last
+        if self.batch and len(self.rows) >= self.batch:
+            self.flush()
+
+    def close(self):
+        # The runs still in progress end with the trace, for now. They stay
+        # open from where they started, so that an appended run which
+        # carries on with them replaces these rows by the whole run.
+        for cpu, (pid, comm, start) in list(self.open.items()):
+            if self.last is not None and self.last > start:
+                self.rows.append((cpu, pid, comm, start, self.last))
+        self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.write(self.rows)
+            self.rows = []
@@ -0,0 +1,224 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import binascii
+import csv
+import errno
+import itertools
+import json
+import os
+import sqlite3
+import sys
+
+try:
+    from .utils import display_results
+except (ImportError, ValueError):
+    from utils import display_results
+
+# The results of -q and -s in the format of --output. 'table' lays them out
+# with tabulate, which has to have all the rows to size the columns, so it
+# is meant for results that are read by a person. The others write the rows
+# as they are fetched, a batch at a time, in memory that does not grow with
+# the result:
+#
+#   csv     a header line with the column names, then one line per row
+#   jsonl   one JSON object per row, keyed by the column names
+#   arrow   an Arrow IPC stream, one record batch per batch of rows
+#
+# BLOBs are written as hex in csv and jsonl, and as binary in arrow.
+#
+# pyarrow is optional, it is imported when arrow output is asked for.
+
+formats = ['table', 'csv', 'jsonl', 'arrow']
+
+# rows fetched and written at a time
+batch_rows = 10000
+
+# what sqlite3 gives BLOBs as: bytes, or the buffer of Python 2, whose
+# bytes are its strings
+blobs = ((bytearray, memoryview, type(sqlite3.Binary(b'')))
+         + ((bytes,) if bytes is not str else ()))
+
+class OutputError(Exception):
+    pass
+
+def missing_module(fmt):
+    if fmt == 'arrow':
+        try:
+            import pyarrow
+        except ImportError:
+            return 'pyarrow'
+    return None
+
+def fetched(cursor, batch=batch_rows):
+    # the rows of the statement a cursor just ran, fetchmany() at a time
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            return
+        for r in rows:
+            yield r
+
+class ResultWriter(object):
+    # Writes results to a file, or to stdout without one. Several results
+    # (-q with several queries) follow each other, except in arrow, where
+    # a stream holds a single one.
+    def __init__(self, fmt, path=None):
+        self.fmt = fmt
+        self.path = path
+        self.results = 0
+        binary = fmt == 'arrow'
+        if path is None or path == '-':
+            self.f = getattr(sys.stdout, 'buffer', sys.stdout) if binary else sys.stdout
+            self.close_f = False
+        else:
+            self.f = open(path, 'wb' if binary else 'w')
+            self.close_f = True
+
+    def close(self):
+        if self.close_f:
+            self.f.close()
+        else:
+            self.f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def notice(self, text):
+        # disclaimers and the like, which must not get into the rows
+        if self.fmt == 'table' and not self.close_f:
+            print(text)
+        else:
+            sys.stderr.write(text + '\n')
+
+    def write(self, col_names, rows):
+        if self.fmt == 'arrow' and self.results:
+            raise OutputError('an arrow stream holds a single result, '
+                              'run one query at a time')
+        self.results += 1
+        try:
+            if self.fmt == 'table':
+                if self.close_f:
+                    stdout = sys.stdout
+                    sys.stdout = self.f
+                    try:
+                        display_results(col_names, rows)
+                    finally:
+                        sys.stdout = stdout
+                else:
+                    display_results(col_names, rows)
+            elif self.fmt == 'csv':
+                self.write_csv(col_names, rows)
+            elif self.fmt == 'jsonl':
+                self.write_jsonl(col_names, rows)
+            else:
+                self.write_arrow(col_names, rows)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # the reader went away (head), which is not an error. What is
+            # left in the buffer of stdout must not be flushed at exit.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), self.f.fileno())
+            exit(0)
+
+    def write_csv(self, col_names, rows):
+        if self.results > 1:
+            self.f.write('\n')
+        w = csv.writer(self.f, lineterminator='\n')
+        w.writerow(col_names)
+        for batch in batches(rows):
+            w.writerows(_csv_rows(batch))
+
+    def write_jsonl(self, col_names, rows):
+        f = self.f
+        for batch in batches(rows):
+            f.write(''.join(json.dumps(dict(zip(col_names, r)), default=_json_value) + '\n'
+                            for r in batch))
+
+    def write_arrow(self, col_names, rows):
+        # The column types are those of the values of the first batch, a
+        # column without any values there is one of strings.
+        import pyarrow as pa
+
+        writer = None
+        try:
+            for batch in batches(rows):
+                if writer is None:
+                    types = [_arrow_type(pa, [r[i] for r in batch])
+                             for i in range(len(col_names))]
+                    schema = pa.schema([pa.field(n, t) for n, t in zip(col_names, types)])
+                    writer = pa.ipc.new_stream(self.f, schema)
+                columns = []
+                for i, t in enumerate(types):
+                    values = [r[i] for r in batch]
+                    if t == pa.string():
+                        values = [None if v is None else _text(v) for v in values]
+                    try:
+                        columns.append(pa.array(values, type=t))
+                    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError) as e:
+                        raise OutputError('column {} does not fit {}: {}'.format(
+                            col_names[i], t, e))
+                writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+            if writer is None:
+                # no rows, the columns are still there
+                schema = pa.schema([pa.field(n, pa.string()) for n in col_names])
+                writer = pa.ipc.new_stream(self.f, schema)
+        finally:
+            if writer is not None:
+                writer.close()
+
+def batches(rows, n=batch_rows):
+    it = iter(rows)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+def _hex(v):
+    return binascii.hexlify(bytes(v)).decode('ascii')
+
+def _csv_value(v):
+    if isinstance(v, blobs):
+        return _hex(v)
+    if isinstance(v, type(u'')):
+        return v.encode('utf-8')
+    return v
+
+# the csv module of Python 2 writes bytes, its sqlite3 gives unicode
+_csv_converted = set(blobs) | (set([type(u'')]) if bytes is str else set())
+
+def _csv_rows(batch):
+    # The rows of a batch with the BLOBs as hex and the text of Python 2 as
+    # UTF-8. Only the columns with any of them are converted.
+    if _csv_converted.isdisjoint(map(type, itertools.chain.from_iterable(batch))):
+        return batch
+    columns = list(zip(*batch))
+    convert = [i for i, c in enumerate(columns) if not _csv_converted.isdisjoint(map(type, c))]
+    for i in convert:
+        columns[i] = [_csv_value(v) for v in columns[i]]
+    return zip(*columns)
+
+def _json_value(v):
+    if isinstance(v, blobs):
+        return _hex(v)
+    raise TypeError('{!r} is not JSON serializable'.format(v))
+
+def _text(v):
+    if isinstance(v, bytes):
+        return v.decode('utf-8', 'replace')
+    return v if isinstance(v, str) else str(v)
+
+def _arrow_type(pa, values):
+    kinds = set(type(v) for v in values if v is not None)
+    if not kinds:
+        return pa.string()
+    if kinds <= set([int, bool]):
+        return pa.int64()
+    if kinds <= set([int, bool, float]):
+        return pa.float64()
+    if kinds <= set([bytes, bytearray]):
+        return pa.binary()
+    return pa.string()
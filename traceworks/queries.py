@@ -0,0 +1,223 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import logging
+import sqlite3
+import time
+import uuid
+
+try:
+    from . import columnar
+except (ImportError, ValueError):
+    import columnar
+
+# The queries of the config run on a database, for -q and for the query
+# server. Each of them takes the cursor it runs on, so that every server
+# thread can go with a connection of its own.
+
+# Query results are cached in the database under the generation of its
+# tables, which every -g run replaces when it starts and again when it is
+# done. No results are cached or served while an ingestion is going on.
+generation_schema = ('CREATE TABLE IF NOT EXISTS ingest_generation (id TEXT, '
+                     'ingesting INTEGER, created REAL)')
+cache_schema = ('CREATE TABLE IF NOT EXISTS query_cache (generation TEXT, query TEXT, '
+                'qargs TEXT, trace_id INTEGER, columns TEXT, rows TEXT, '
+                'PRIMARY KEY (generation, query, qargs, trace_id))')
+mismatches_schema = 'CREATE TABLE IF NOT EXISTS ingest_mismatches (entry INTEGER, exit INTEGER)'
+
+# results of more rows are not cached, they are better off queried again
+# than held in memory and in the database as JSON
+cached_rows = 100000
+
+class QueryError(Exception):
+    pass
+
+def new_generation(cursor, ingesting):
+    # A new generation of the tables, which none of the cached results
+    # are of. Called within a transaction.
+    cursor.execute(generation_schema)
+    cursor.execute(cache_schema)
+    cursor.execute('DELETE FROM ingest_generation')
+    cursor.execute('INSERT INTO ingest_generation VALUES (?, ?, ?)',
+                   (uuid.uuid4().hex, int(ingesting), time.time()))
+    cursor.execute('DELETE FROM query_cache')
+
+def generation(cursor):
+    # The generation of the tables cached results are of. None while they
+    # are being generated, and for databases from before the cache.
+    try:
+        cursor.execute('SELECT id, ingesting FROM ingest_generation')
+    except sqlite3.OperationalError:
+        return None
+    r = cursor.fetchone()
+    if r is None or r[1]:
+        return None
+    return r[0]
+
+def cached_result(cursor, key):
+    cursor.execute('SELECT columns, rows FROM query_cache WHERE generation = ? '
+                   'AND query = ? AND qargs = ? AND trace_id = ?', key)
+    r = cursor.fetchone()
+    if r is None:
+        return None
+    return json.loads(r[0]), json.loads(r[1])
+
+def cache_result(cursor, key, col_names, rows):
+    # a database opened read-only, or results which are not plain numbers
+    # and text, just go without
+    try:
+        cursor.execute('INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?, ?)',
+                       key + (json.dumps(col_names), json.dumps([list(x) for x in rows])))
+    except (sqlite3.Error, TypeError) as e:
+        logging.info('Cannot cache the results: %s', e)
+
+def cache_key(generation, query, qargs, trace_id):
+    # the results of the whole database are cached as trace 0
+    kind = query.get('kind', 'sql')
+    return (generation, query['query'] if kind == 'sql' else json.dumps(query, sort_keys=True),
+            json.dumps(qargs), trace_id or 0)
+
+def partitioned_tables(cursor, tables):
+    # the tables of a -T database with a trace_id column, of the config
+    # 'tables' and the ones of -e and -I
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    present = set(r[0] for r in cursor.fetchall())
+    candidates = list(tables) + ['events', 'sched_intervals']
+    return [t for i, t in enumerate(candidates)
+            if t in present and t not in candidates[:i]]
+
+def restrict_to_trace(cursor, tables, trace_id):
+    # The tables of a -T database are shadowed by temporary views of the
+    # rows of one trace, which the queries then read instead. The view of
+    # sched_intervals keeps the rowid the R*Tree is joined on. None drops
+    # the views again.
+    for t in partitioned_tables(cursor, tables):
+        cursor.execute('DROP VIEW IF EXISTS temp.{}'.format(t))
+        if trace_id is not None:
+            cursor.execute('CREATE TEMP VIEW {0} AS SELECT {1}* FROM main.{0} '
+                           'WHERE trace_id = {2}'.format(
+                               t, 'rowid AS rowid, ' if t == 'sched_intervals' else '',
+                               int(trace_id)))
+
+def find_trace(cursor, t, path=None):
+    # (trace_id, host, file) of the traces of a -T database 't' names, by
+    # trace_id, host or file. None if the database has no traces table.
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='traces'")
+    if cursor.fetchone() is None:
+        return None
+    cursor.execute('SELECT trace_id, host, file FROM traces WHERE '
+                   'CAST(trace_id AS TEXT) = ? OR host = ? OR file = ?',
+                   (t, t, path or t))
+    return cursor.fetchall()
+
+def save_mismatches(cursor, entry, exit):
+    # Whether the -g run ran into events without their entry or without
+    # their exit, for the disclaimers of the queries. Called within the
+    # transaction that ends the run.
+    cursor.execute(mismatches_schema)
+    cursor.execute('DELETE FROM ingest_mismatches')
+    cursor.execute('INSERT INTO ingest_mismatches VALUES (?, ?)', (int(entry), int(exit)))
+
+def trace_incomplete(cursor):
+    # whether the last -g run of the database ran into mismatches
+    try:
+        cursor.execute('SELECT entry, exit FROM ingest_mismatches')
+    except sqlite3.OperationalError:
+        return False
+    r = cursor.fetchone()
+    return r is not None and bool(r[0] or r[1])
+
+def find_query(config_queries, q):
+    # a query of the config by its number, from 1 as in --list, or by its
+    # name. None if there is no such query.
+    if isinstance(q, int) or isinstance(q, str) and q.isdigit():
+        q = int(q)
+        return config_queries[q - 1] if 0 < q <= len(config_queries) else None
+    for query in config_queries:
+        if query['name'] == q:
+            return query
+    return None
+
+def run_query(cursor, dbfile, query, qargs, trace_id=None, tables=(),
+              generation=None, store=True):
+    # The column names and rows of a config query, and whether they came
+    # from the cache: 'hit', 'miss' or None without a 'generation'. The
+    # rows of a miss are cached as well unless 'store' is False.
+    col_names, rows, cache = iter_query(cursor, dbfile, query, qargs, trace_id, tables,
+                                        generation, store)
+    return col_names, list(rows), cache
+
+def iter_query(cursor, dbfile, query, qargs, trace_id=None, tables=(),
+               generation=None, store=True, batch=10000):
+    # run_query() with the rows of an SQL query fetched 'batch' at a time
+    # as they are iterated over, for results of any size. A miss is cached
+    # once all of its rows went by, unless there are over cached_rows.
+    # SQLite errors, while running the query or fetching its rows, are
+    # raised as QueryError with the name of the query.
+    kind = query.get('kind', 'sql')
+    key = cache_key(generation, query, qargs, trace_id)
+    if generation is not None:
+        cached = cached_result(cursor, key)
+        if cached is not None:
+            return cached[0], iter(cached[1]), 'hit'
+
+    if kind != 'sql':
+        # percentile, histogram and top queries are worked out with numpy,
+        # on the columns --export wrote or on the table itself
+        m = columnar.missing_module()
+        if m:
+            raise QueryError("query '{}' needs the {} module".format(query['name'], m))
+        if trace_id is not None:
+            query = dict(query, where=dict(query.get('where', {}), trace_id=trace_id))
+        try:
+            col_names, r = columnar.run_query(cursor, dbfile, query, qargs)
+        except (KeyError, ValueError, IndexError) as e:
+            raise QueryError("query '{}' is not valid: {}".format(query['name'], e))
+        except sqlite3.Error as e:
+            raise QueryError("query '{}' failed: {}".format(query['name'], e))
+        if generation is None:
+            return col_names, iter(r), None
+        if store:
+            cache_result(cursor, key, col_names, r)
+        return col_names, iter(r), 'miss'
+
+    if trace_id is not None:
+        restrict_to_trace(cursor, tables, trace_id)
+    try:
+        cursor.execute(query['query'].format(*qargs))
+    except Exception as e:
+        if trace_id is not None:
+            restrict_to_trace(cursor, tables, None)
+        if isinstance(e, (IndexError, KeyError)):
+            raise QueryError("query '{}' takes {} argument(s)".format(
+                query['name'], len(query.get('args', []))))
+        if isinstance(e, sqlite3.Error):
+            raise QueryError("query '{}' failed: {}".format(query['name'], e))
+        raise
+    col_names = list(map(lambda x: x[0], cursor.description))
+    key = key if generation is not None and store else None
+    return (col_names, _fetched(cursor, query['name'], col_names, key, trace_id, tables,
+                                batch),
+            None if generation is None else 'miss')
+
+def _fetched(cursor, name, col_names, key, trace_id, tables, batch):
+    kept = [] if key is not None else None
+    try:
+        while True:
+            try:
+                rows = cursor.fetchmany(batch)
+            except sqlite3.Error as e:
+                raise QueryError("query '{}' failed: {}".format(name, e))
+            if not rows:
+                break
+            if kept is not None:
+                kept.extend(rows)
+                if len(kept) > cached_rows:
+                    kept = None
+            for r in rows:
+                yield r
+    finally:
+        if trace_id is not None:
+            restrict_to_trace(cursor, tables, None)
+    if kept is not None:
+        cache_result(cursor, key, col_names, kept)
@@ -0,0 +1,409 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import gzip
+import mmap
+import os
+import select
+import stat
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from .utils import parseline, parsebytes
+except (ImportError, ValueError):
+    from utils import parseline, parsebytes
+
+# optional decompressors
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class TraceReader(object):
+    # Reads a trace file through a read only mmap, as bytes. Nothing is
+    # split into lines up front: the event name pattern is searched for in
+    # the mapping itself and only the lines around its matches are parsed,
+    # see events(). The mapping is backed by the page cache, so the worker
+    # processes of --jobs read the same pages without copying them.
+    #
+    # Positions are byte offsets into the file, which is what the chunks
+    # of chunks() are made of as well.
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.map = None
+        if self.size:
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunks(self, chunks, start=0, end=None):
+        # Split the file from 'start' to 'end' into at most 'chunks' byte
+        # ranges, each of them starting and ending on a line boundary.
+        end = self.size if end is None else end
+        offsets = [start]
+        for i in range(1, chunks):
+            pos = start + (end - start) * i // chunks
+            if pos <= offsets[-1]:
+                continue
+            pos = self.map.find(b'\n', pos - 1, end) + 1
+            if pos <= 0 or pos >= end:
+                break
+            if pos > offsets[-1]:
+                offsets.append(pos)
+        offsets.append(end)
+
+        return list(zip(offsets[:-1], offsets[1:]))
+
+    def events(self, pattern, start=0, end=None, reject=None, keep=None):
+        if self.map is None:
+            return iter(())
+        return events(self.map, pattern, start, self.size if end is None else end,
+                      reject, keep)
+
+    def find_time(self, ts, start=0, end=None):
+        # The offset of the first line from 'start' on which holds an event
+        # at 'ts' or later, or 'end', by bisecting the file. Events are in
+        # time order in a trace, lines which do not parse are passed over.
+        # All the events before 'lo' are earlier than 'ts', the first one
+        # from 'hi' on is not.
+        lo = start
+        hi = self.size if end is None else end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.map.rfind(b'\n', lo, mid) + 1 or lo
+            # the first event from the start of the line holding 'mid' on
+            parsed = None
+            e = pos
+            while e < hi:
+                s = e
+                e = self.map.find(b'\n', s, hi)
+                if e < 0:
+                    e = hi
+                parsed = parsebytes(self.map, s, e)
+                e += 1
+                if parsed is not None:
+                    break
+
+            if parsed is None or parsed.timestamp >= ts:
+                hi = pos
+            else:
+                lo = min(e, hi)
+        return lo
+
+    def window(self, keep, start=0, end=None):
+        # the byte range of the lines in the time window of an EventFilter
+        end = self.size if end is None else end
+        if keep is None or self.map is None:
+            return start, end
+        if keep.start is not None:
+            start = self.find_time(keep.start, start, end)
+        if keep.end is not None:
+            end = self.find_time(keep.end + 1, start, end)
+        return start, end
+
+    def line_end(self, start=0, end=None):
+        # the end of the last complete line in [start, end), a line still
+        # being written at the end of the file is left out
+        end = self.size if end is None else end
+        if self.map is None:
+            return start
+        return self.map.rfind(b'\n', start, end) + 1 or start
+
+    def lines(self, start=0, end=None, block=16 << 20):
+        # number of lines in [start, end), counted a block at a time
+        end = self.size if end is None else end
+        n = 0
+        for pos in range(start, end, block):
+            n += self.map[pos:min(pos + block, end)].count(b'\n')
+        if end > start and self.map[end - 1:end] != b'\n':
+            n += 1
+        return n
+
+def events(data, pattern, start, end, reject=None, keep=None):
+    # Generate (offset, event) for the parsed lines of data[start:end]
+    # which contain a match of the compiled bytes 'pattern', or for every
+    # line if 'pattern' is None. 'start' has to be the start of a line.
+    # 'reject' is called for each of those lines which does not parse.
+    # The lines and events an EventFilter 'keep' drops are skipped.
+    line = keep.line.match if keep is not None and keep.line is not None else None
+    window = keep.window if keep is not None and keep.timed else None
+    pos = start
+    while pos < end:
+        if pattern is None:
+            s = pos
+            e = data.find(b'\n', pos, end)
+        else:
+            m = pattern.search(data, pos, end)
+            if m is None:
+                return
+            s = data.rfind(b'\n', pos, m.start()) + 1 or pos
+            e = data.find(b'\n', m.end(), end)
+        if e < 0:
+            e = end
+
+        if line is not None and line(data, s, e) is None:
+            pos = e + 1
+            continue
+        parsed = parsebytes(data, s, e)
+        if parsed is not None:
+            if window is None or window(parsed):
+                yield s, parsed
+        elif reject is not None:
+            reject()
+        pos = e + 1
+
+def line_events(lines, pattern=None, reject=None, keep=None, skip=None, text=False):
+    # events() for the lines of an iterable, such as a decompressor or a
+    # trace being followed: generate the event of each bytes line, or str
+    # line with 'text', which contains a match of the compiled 'pattern'.
+    # Besides what 'reject' and 'keep' do there, the events up to 'skip',
+    # the last timestamp of an earlier -A run, are left out.
+    search = pattern.search if pattern is not None else None
+    line = None
+    window = None
+    if keep is not None:
+        line = keep.text if text else keep.line
+        line = line.match if line is not None else None
+        window = keep.window if keep.timed else None
+    for l in lines:
+        if search is not None and search(l) is None:
+            continue
+        if line is not None and line(l) is None:
+            continue
+        parsed = parseline(l) if text else parsebytes(l, 0, len(l))
+        if parsed is None:
+            if reject is not None:
+                reject()
+            continue
+        if skip is not None and parsed.timestamp <= skip:
+            continue
+        if window is None or window(parsed):
+            yield parsed
+
+def follow_lines(path, offset=0, timeout=1.0, bufsize=65536):
+    # Generate (offset, line) for the complete lines of a trace which is
+    # still being written: trace_pipe, a FIFO or a growing regular file.
+    # The line is bytes without its newline and 'offset' is where the next
+    # line starts. A regular file is read from byte 'offset' on and polled
+    # for more once its end is reached, a pipe is read until its writer
+    # goes away. None is generated whenever there was nothing new to read
+    # for 'timeout' seconds.
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        regular = stat.S_ISREG(os.fstat(fd).st_mode)
+        if regular:
+            os.lseek(fd, offset, os.SEEK_SET)
+        pending = b''
+        while True:
+            if not regular:
+                r, w, x = select.select([fd], [], [], timeout)
+                if not r:
+                    yield None
+                    continue
+
+            data = os.read(fd, bufsize)
+            if not data:
+                if not regular:
+                    break
+                yield None
+                time.sleep(timeout)
+                continue
+
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for l in lines:
+                offset += len(l) + 1
+                yield offset, l
+
+        if pending:
+            yield offset + len(pending), pending
+    finally:
+        os.close(fd)
+
+_magic = ((b'\x1f\x8b', 'gzip'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd'))
+
+def compression(path):
+    # The compression format of a regular file from its magic number, or
+    # None for a plain trace.
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, fmt in _magic:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+def missing_module(fmt):
+    # The module a compression format needs which is not installed, if any
+    if fmt == 'xz' and lzma is None:
+        return 'lzma'
+    if fmt == 'zstd' and zstandard is None:
+        return 'zstandard'
+    return None
+
+def open_compressed(path, fmt):
+    if fmt == 'gzip':
+        return gzip.open(path, 'rb')
+    if fmt == 'xz':
+        return lzma.LZMAFile(path, 'rb')
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),
+                                                       read_across_frames=True,
+                                                       closefd=True)
+
+def _pump(f, q, bufsize):
+    try:
+        while True:
+            data = f.read(bufsize)
+            q.put(data)
+            if not data:
+                break
+    except Exception as e:
+        q.put(e)
+    finally:
+        f.close()
+
+def decompressed_lines(path, fmt, blocks=8, bufsize=1 << 20):
+    # Generate the lines of a compressed trace, as bytes without the
+    # newline. The decompressor runs in a thread and stays up to 'blocks'
+    # blocks of 'bufsize' bytes ahead, zlib, lzma and zstandard all let go
+    # of the GIL while they work, so it overlaps with the parsing.
+    q = queue.Queue(blocks)
+    t = threading.Thread(target=_pump, args=(open_compressed(path, fmt), q, bufsize))
+    t.daemon = True
+    t.start()
+
+    pending = b''
+    while True:
+        data = q.get()
+        if isinstance(data, Exception):
+            raise data
+        if not data:
+            break
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for l in lines:
+            yield l
+
+    if pending:
+        yield pending
+
+def _members(data, fmt, start, end):
+    # Generate the (start, end) byte ranges of the members of a compressed
+    # file which can be decompressed independently: the blocks of BGZF, the
+    # gzip variant bgzip(1) writes, and zstd frames. They are found from
+    # their headers alone. ValueError if the file is not made of them.
+    pos = start
+    while pos < end:
+        if fmt == 'gzip':
+            # BGZF keeps the size of a member in the 'BC' extra subfield
+            if data[pos:pos + 4] != b'\x1f\x8b\x08\x04':
+                raise ValueError('not BGZF')
+            xlen, = struct.unpack_from('<H', data, pos + 10)
+            p = pos + 12
+            size = None
+            while p < pos + 12 + xlen:
+                slen, = struct.unpack_from('<H', data, p + 2)
+                if data[p:p + 2] == b'BC' and slen == 2:
+                    size, = struct.unpack_from('<H', data, p + 4)
+                p += 4 + slen
+            if size is None:
+                raise ValueError('not BGZF')
+            yield pos, pos + size + 1
+            pos += size + 1
+        elif fmt == 'zstd':
+            magic, = struct.unpack_from('<I', data, pos)
+            if magic & 0xfffffff0 == 0x184d2a50:
+                # skippable frame, no data in it
+                size, = struct.unpack_from('<I', data, pos + 4)
+                pos += 8 + size
+                continue
+            if magic != 0xfd2fb528:
+                raise ValueError('not a zstd frame')
+
+            # frame header: descriptor, window, dictionary id and content
+            # size, the last three sized by the descriptor
+            fhd = bytearray(data[pos + 4:pos + 5])[0]
+            single = (fhd >> 5) & 1
+            p = pos + 5 + (0 if single else 1) + (0, 1, 2, 4)[fhd & 3]
+            p += (1 if single else 0, 2, 4, 8)[fhd >> 6]
+            last = 0
+            while not last:
+                b0, b1, b2 = bytearray(data[p:p + 3])
+                h = b0 | b1 << 8 | b2 << 16
+                last, btype, bsize = h & 1, (h >> 1) & 3, h >> 3
+                if btype == 3:
+                    raise ValueError('corrupt zstd block')
+                p += 3 + (1 if btype == 1 else bsize)
+            if (fhd >> 2) & 1:
+                p += 4
+            yield pos, p
+            pos = p
+        else:
+            raise ValueError('{} cannot be split'.format(fmt))
+
+def compressed_chunks(path, fmt, chunks):
+    # Split a compressed file into at most 'chunks' byte ranges on member
+    # boundaries, for the --jobs workers to decompress on their own. None
+    # if the file cannot be split.
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            starts = [s for s, e in _members(data, fmt, 0, size)]
+        except (ValueError, struct.error):
+            return None
+        finally:
+            data.close()
+
+    if len(starts) < 2:
+        return None
+
+    offsets = [0]
+    j = 0
+    for i in range(1, chunks):
+        pos = size * i // chunks
+        while j < len(starts) and starts[j] < pos:
+            j += 1
+        if j == len(starts):
+            break
+        if starts[j] > offsets[-1]:
+            offsets.append(starts[j])
+    offsets.append(size)
+
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def decompress_range(path, fmt, start, end):
+    # The decompressed data of the members in [start, end) of a file
+    # compressed_chunks() split
+    with open(path, 'rb') as f:
+        f.seek(start)
+        raw = f.read(end - start)
+
+    out = []
+    for s, e in _members(raw, fmt, 0, len(raw)):
+        if fmt == 'gzip':
+            out.append(zlib.decompress(raw[s:e], 16 + zlib.MAX_WBITS))
+        else:
+            out.append(zstandard.ZstdDecompressor().decompressobj().decompress(raw[s:e]))
+    return b''.join(out)
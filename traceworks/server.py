@@ -0,0 +1,260 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import logging
+import os
+import signal
+import sqlite3
+import stat
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs, quote, unquote
+except ImportError:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qs
+    from urllib import quote, unquote
+
+try:
+    from . import queries
+    from .queries import QueryError
+except (ImportError, ValueError):
+    import queries
+    from queries import QueryError
+
+# The query server of --serve. It keeps the config and a pool of read-only
+# connections to the database, and answers each request on a thread of its
+# own with a connection from the pool, so that as many queries run at once
+# as there are connections. SQLite lets go of the GIL while it runs a
+# query. The database is in WAL mode once -g has been at it, in which
+# readers and the writer do not wait for each other: queries can be asked
+# while an ingestion is going on, and see what it committed so far.
+#
+# A request is a JSON object
+#
+#   {"query": 6, "args": ["10"], "trace_id": "web2"}
+#
+# naming the query by its number in --list or by its name, or {"list": true}
+# for the queries. The answer is a JSON object with the 'columns' and
+# 'rows' of the result, whether it was a cache 'hit' or 'miss' and the
+# 'ms' it took, or with an 'error'.
+#
+# On a Unix socket requests and answers are one per line. Over HTTP they
+# are GET /queries, GET /query/<number or name>?args=...&trace_id=... and
+# POST /query with the request as the body.
+
+# results kept in memory per generation of the tables, at most
+cached_results = 1024
+
+class QueryServer(object):
+    def __init__(self, dbfile, config_queries, tables, connections):
+        self.dbfile = dbfile
+        self.queries = config_queries
+        self.tables = tables
+        self.pool = queue.Queue()
+        for i in range(connections):
+            self.pool.put(self.connect())
+        # The results of the current generation. The read-only connections
+        # cannot add to the query_cache table, hits there are used though.
+        self.results = {}
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # Read-only, which still lets the --trace-id views be created in
+        # the temp database. Python 2 has no URIs, and query_only would keep
+        # those views out as well, so it goes with a plain connection: the
+        # server never stores anything, run() does not add to query_cache.
+        try:
+            conn = sqlite3.connect('file:{}?mode=ro'.format(quote(self.dbfile)), uri=True,
+                                   timeout=30, check_same_thread=False)
+        except TypeError:
+            conn = sqlite3.connect(self.dbfile, timeout=30, check_same_thread=False)
+        # transactions are started explicitly, to read a single snapshot
+        conn.isolation_level = None
+        mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        if mode.lower() != 'wal':
+            logging.warning('%s is not in WAL mode, queries will wait for ingestions',
+                            self.dbfile)
+        return conn
+
+    def lookup(self, q):
+        return queries.find_query(self.queries, q)
+
+    def answer(self, request):
+        # (HTTP status, answer) of a request
+        if not isinstance(request, dict):
+            return 400, {'error': 'a request is a JSON object'}
+        if request.get('list'):
+            return 200, {'queries': [
+                {'number': i + 1, 'name': q['name'], 'desc': q.get('desc'),
+                 'args': q.get('args', [])} for i, q in enumerate(self.queries)]}
+
+        query = self.lookup(request.get('query'))
+        if query is None:
+            return 404, {'error': 'no query {}'.format(request.get('query'))}
+        if query.get('kind', 'sql') == 'sql' and 'query' not in query:
+            return 400, {'error': "query '{}' is not implemented".format(query['name'])}
+        args = request.get('args') or []
+        if not isinstance(args, list):
+            args = [args]
+        args = [str(a) for a in args]
+        if len(args) < len(query.get('args', [])):
+            return 400, {'error': "query '{}' requires {} argument(s)".format(
+                query['name'], len(query['args']))}
+
+        start = time.time()
+        conn = self.pool.get()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            try:
+                trace_id = None
+                if request.get('trace_id') is not None:
+                    t = str(request['trace_id'])
+                    r = queries.find_trace(cursor, t)
+                    if not r or len(r) > 1:
+                        return 404, {'error': 'no single trace {}'.format(t)}
+                    trace_id = r[0][0]
+                col_names, rows, cache = self.run(cursor, query, args, trace_id)
+                incomplete = 'disclaimer' in query and queries.trace_incomplete(cursor)
+            finally:
+                cursor.execute('COMMIT')
+        except QueryError as e:
+            return 400, {'error': str(e)}
+        except sqlite3.Error as e:
+            # the tables are not there yet, or being rebuilt
+            return 503, {'error': 'database error: {}'.format(e)}
+        finally:
+            self.pool.put(conn)
+
+        a = {'name': query['name'], 'columns': col_names, 'rows': rows,
+             'cache': cache, 'ms': round((time.time() - start) * 1000, 3)}
+        if incomplete:
+            a['disclaimer'] = query['disclaimer']
+        return 200, a
+
+    def run(self, cursor, query, args, trace_id):
+        generation = queries.generation(cursor)
+        key = queries.cache_key(generation, query, args, trace_id)
+        if generation is not None:
+            with self.lock:
+                r = self.results.get(key)
+            if r is not None:
+                return r[0], r[1], 'hit'
+
+        col_names, rows, cache = queries.run_query(cursor, self.dbfile, query, args, trace_id,
+                                                   self.tables, generation, store=False)
+        rows = [list(r) for r in rows]
+        if cache == 'miss':
+            with self.lock:
+                # results of an earlier generation are of no use any more
+                if generation != self.generation or len(self.results) >= cached_results:
+                    self.results = {}
+                    self.generation = generation
+                self.results[key] = (col_names, rows)
+        return col_names, rows, cache
+
+    def serve(self, address):
+        # Serve on a Unix socket, or over HTTP on [HOST:]PORT, until
+        # interrupted.
+        host, sep, port = address.rpartition(':')
+        if port.isdigit() and '/' not in address:
+            server = _HTTPServer((host or '127.0.0.1', int(port)), _HTTPHandler)
+            where = 'http://{}:{}/'.format(*server.server_address[:2])
+            path = None
+        else:
+            path = address
+            if os.path.exists(path):
+                if not stat.S_ISSOCK(os.stat(path).st_mode):
+                    raise OSError('{} is not a socket'.format(path))
+                # left over by a server which is gone
+                os.remove(path)
+            server = _UnixServer(path, _UnixHandler)
+            where = path
+        server.app = self
+        print('Serving the queries of {} on {} with {} connections'.format(
+            self.dbfile, where, self.pool.qsize()))
+        sys.stdout.flush()
+        # a kill stops the server as ^C does, which removes the socket
+        signal.signal(signal.SIGTERM, _interrupt)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+class _HTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') == '/queries':
+            self.reply(*self.server.app.answer({'list': True}))
+            return
+        if not url.path.startswith('/query/'):
+            self.reply(404, {'error': 'no such path {}'.format(url.path)})
+            return
+        params = parse_qs(url.query)
+        request = {'query': unquote(url.path[len('/query/'):]),
+                   'args': params.get('args', [])}
+        if 'trace_id' in params:
+            request['trace_id'] = params['trace_id'][0]
+        self.reply(*self.server.app.answer(request))
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/query':
+            self.reply(404, {'error': 'no such path {}'.format(self.path)})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            request = json.loads(body.decode('utf-8'))
+        except ValueError as e:
+            self.reply(400, {'error': 'not JSON: {}'.format(e)})
+            return
+        self.reply(*self.server.app.answer(request))
+
+    def reply(self, status, answer):
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.info(fmt, *args)
+
+class _UnixHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                answer = {'error': 'not JSON: {}'.format(e)}
+            else:
+                answer = self.server.app.answer(request)[1]
+            self.wfile.write(json.dumps(answer).encode('utf-8') + b'\n')
+            self.wfile.flush()
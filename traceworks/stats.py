@@ -0,0 +1,140 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import os
+import resource
+import sys
+import time
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes, except on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def cpu_time():
+    # user and system time of the process, and of the --jobs workers once
+    # they have exited
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+class _Stage(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = cpu_time()
+
+    def __exit__(self, *exc):
+        self.stats.stages.append((self.name, time.time() - self.wall,
+                                  cpu_time() - self.cpu))
+
+class Stats(object):
+    # What --stats reports about an ingestion. The stages are always timed,
+    # that is a couple of calls each. Counting the lines and the event
+    # names costs a little on the per-line path, so it is only done when
+    # 'enabled'.
+    #
+    # 'lines' and 'bytes' are what was read of the trace, decompressed.
+    # Lines that contain one of the event names of the config are parsed,
+    # the ones of them that do not parse are counted in 'rejected'.
+    # 'names' counts the parsed events by event name and 'mismatches' the
+    # entry/exit mismatches by (config entry index, missing side).
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = []
+        self.lines = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.names = {}
+        self.mismatches = {}
+        self.allocations = None
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def reject(self):
+        self.rejected += 1
+
+    def counted(self, lines, newline=0):
+        # the lines of a text or decompressed trace, counted as they go by
+        for l in lines:
+            self.lines += 1
+            self.bytes += len(l) + newline
+            yield l
+
+    def count_lookups(self, dispatch):
+        # Count the events by name on their way through an EventDispatch.
+        # The per-line path calls dispatch.lookup() once per parsed event.
+        names = self.names
+        lookup = dispatch.lookup
+        def counting(name):
+            names[name] = names.get(name, 0) + 1
+            return lookup(name)
+        dispatch.lookup = counting
+
+    def mismatch(self, index, missing, n=1):
+        key = (index, missing)
+        self.mismatches[key] = self.mismatches.get(key, 0) + n
+
+    def merge(self, names, mismatches, rejected, lines=0, size=0):
+        # what a --jobs worker counted in its chunk
+        for name, n in names.items():
+            self.names[name] = self.names.get(name, 0) + n
+        for (i, missing), n in mismatches:
+            self.mismatch(i, missing, n)
+        self.rejected += rejected
+        self.lines += lines
+        self.bytes += size
+
+    def report(self, handlers):
+        parse = sum(wall for name, wall, cpu in self.stages if name == 'process_trace')
+        events = sum(self.names.values())
+        entries = []
+        for i, h in enumerate(handlers):
+            entries.append({
+                'name': h.name, 'table': h.table,
+                'events': sum(n for name, n in self.names.items() if h.name in name),
+                'missing_entry': self.mismatches.get((i, 'entry'), 0),
+                'missing_exit': self.mismatches.get((i, 'exit'), 0)})
+
+        r = {'stages': [{'name': name, 'wall': wall, 'cpu': cpu}
+                        for name, wall, cpu in self.stages],
+             'lines': self.lines, 'bytes': self.bytes,
+             'lines_per_sec': self.lines / parse if parse else None,
+             'bytes_per_sec': self.bytes / parse if parse else None,
+             'events': events, 'unparseable': self.rejected,
+             'filtered': max(self.lines - events - self.rejected, 0),
+             'event_names': self.names, 'entries': entries,
+             'peak_rss': peak_rss(),
+             'workers_peak_rss': peak_rss(resource.RUSAGE_CHILDREN)}
+        if self.allocations is not None:
+            r['allocations'] = self.allocations
+        return r
+
+    def write(self, handlers, fmt, out=sys.stderr):
+        r = self.report(handlers)
+        if fmt == 'json':
+            out.write(json.dumps(r, sort_keys=True) + '\n')
+            return
+
+        from tabulate import tabulate
+        out.write('\nIngestion statistics\n====================\n')
+        out.write(tabulate([(s['name'], s['wall'], s['cpu']) for s in r['stages']],
+                           headers=['stage', 'wall (s)', 'cpu (s)'], floatfmt='.3f') + '\n\n')
+        if r['lines_per_sec'] is not None:
+            out.write('{} lines, {} bytes read: {:.0f} lines/sec, {:.1f} MB/sec\n'.format(
+                r['lines'], r['bytes'], r['lines_per_sec'], r['bytes_per_sec'] / (1 << 20)))
+        out.write('{} events parsed, {} lines unparseable, {} lines of no interest\n\n'.format(
+            r['events'], r['unparseable'], r['filtered']))
+        out.write(tabulate([(e['name'], e['table'], e['events'], e['missing_entry'],
+                             e['missing_exit']) for e in r['entries']],
+                           headers=['entry', 'table', 'events', 'missing entry',
+                                    'missing exit']) + '\n\n')
+        out.write('peak RSS {:.1f} MB, {:.1f} MB for the workers\n'.format(
+            r['peak_rss'] / float(1 << 20), r['workers_peak_rss'] / float(1 << 20)))
+        if self.allocations:
+            out.write('\n' + tabulate([(a['where'], a['size'], a['count'])
+                                       for a in self.allocations],
+                                      headers=['allocated at', 'bytes', 'blocks']) + '\n')
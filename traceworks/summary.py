@@ -0,0 +1,195 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from operator import attrgetter
+
+# Sub-bucket bits of the histograms. Values below 2^precision get a bucket
+# each, above that every power of two is split into 2^(precision-1)
+# buckets, so a bucket is never wider than 1/64th of the values in it.
+precision = 7
+
+def bucket(v, half=1 << (precision - 1)):
+    # index of the bucket of a non negative integer
+    if v < 2 * half:
+        return v
+    shift = v.bit_length() - precision
+    return shift * half + (v >> shift)
+
+def bucket_range(i, half=1 << (precision - 1)):
+    # lowest value in the bucket, and its width
+    if i < 2 * half:
+        return i, 1
+    shift = i // half - 1
+    return (i - shift * half) << shift, 1 << shift
+
+class Histogram(object):
+    # Log-linear histogram of integer durations, in the spirit of HDR
+    # histograms. The number of buckets only depends on the range of the
+    # values, and two histograms merge by adding up their buckets.
+    __slots__ = ('count', 'sum', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, v):
+        self.count += 1
+        self.sum += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+        # a duration can only come out negative on a broken trace
+        i = bucket(v) if v > 0 else 0
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        for i, n in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + n
+
+    def percentile(self, p):
+        # the middle of the bucket holding the value at rank p, which is
+        # within half a bucket of the exact one
+        if not self.count:
+            return None
+        rank = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= rank:
+                low, width = bucket_range(i)
+                return min(max(low + (width - 1) // 2, self.min), self.max)
+        return self.max
+
+    def to_json(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'buckets': sorted(self.buckets.items())}
+
+    @classmethod
+    def from_json(cls, d):
+        h = cls()
+        h.count = d['count']
+        h.sum = d['sum']
+        h.min = d['min']
+        h.max = d['max']
+        h.buckets = dict((i, n) for i, n in d['buckets'])
+        return h
+
+class Summary(object):
+    # --summarize: what the actions of the config entries would have added
+    # up in the tables, kept per group instead. Each 'difference' goes into
+    # a histogram and each 'increment' into a counter, grouped by the
+    # 'summary' fields of the entry, the last level of its hierarchy by
+    # default. Groups are keyed by their values joined with '->', so that
+    # summaries of separate runs can be loaded and merged.
+    #
+    # tables is {table: {'by': fields, 'histograms': {store: {group: Histogram}},
+    #                    'counters': {store: {group: count}}}}
+    def __init__(self):
+        self.tables = {}
+        self.incomplete = False
+
+    def table(self, name, by):
+        t = self.tables.get(name)
+        if t is None:
+            t = self.tables[name] = {'by': list(by), 'histograms': {}, 'counters': {}}
+        return t
+
+    def sampler(self, cfg):
+        # The function the actions of a config entry report their values
+        # to: the store name, the event and the difference, or None for an
+        # increment.
+        by = cfg.get('summary', cfg['hierarchy'].split('->')[-1:])
+        t = self.table(cfg['table_name'], by)
+        histograms = t['histograms']
+        counters = t['counters']
+        get = attrgetter(*by)
+        if len(by) == 1:
+            group = lambda parsed: str(get(parsed))
+        else:
+            group = lambda parsed: '->'.join(str(v) for v in get(parsed))
+
+        def sample(store, parsed, value):
+            g = group(parsed)
+            if value is None:
+                c = counters.setdefault(store, {})
+                c[g] = c.get(g, 0) + 1
+                return
+
+            hs = histograms.setdefault(store, {})
+            h = hs.get(g)
+            if h is None:
+                h = hs[g] = Histogram()
+            h.add(value)
+        return sample
+
+    def merge(self, other):
+        self.incomplete = self.incomplete or other.incomplete
+        for name, o in other.tables.items():
+            t = self.table(name, o['by'])
+            for store, groups in o['histograms'].items():
+                hs = t['histograms'].setdefault(store, {})
+                for g, h in groups.items():
+                    if g not in hs:
+                        hs[g] = Histogram()
+                    hs[g].merge(h)
+            for store, groups in o['counters'].items():
+                c = t['counters'].setdefault(store, {})
+                for g, n in groups.items():
+                    c[g] = c.get(g, 0) + n
+
+    def to_json(self):
+        tables = {}
+        for name, t in self.tables.items():
+            tables[name] = {
+                'by': t['by'],
+                'histograms': dict((store, dict((g, h.to_json()) for g, h in groups.items()))
+                                   for store, groups in t['histograms'].items()),
+                'counters': t['counters']}
+        return {'precision': precision, 'incomplete': self.incomplete, 'tables': tables}
+
+    @classmethod
+    def from_json(cls, d):
+        if d.get('precision') != precision:
+            raise ValueError('histograms of precision {} cannot be merged with {}'.format(
+                d.get('precision'), precision))
+        s = cls()
+        s.incomplete = d.get('incomplete', False)
+        for name, o in d['tables'].items():
+            t = s.table(name, o['by'])
+            for store, groups in o['histograms'].items():
+                t['histograms'][store] = dict((g, Histogram.from_json(h))
+                                              for g, h in groups.items())
+            t['counters'] = dict((store, dict(groups))
+                                 for store, groups in o['counters'].items())
+        return s
+
+    def results(self, percentiles=(50, 90, 99)):
+        # (column names, rows) per table and store, for display_results()
+        out = []
+        for name in sorted(self.tables):
+            t = self.tables[name]
+            for store in sorted(t['histograms']):
+                groups = t['histograms'][store]
+                rows = []
+                for g in sorted(groups, key=lambda g: -groups[g].sum):
+                    h = groups[g]
+                    rows.append(g.split('->') + [h.count, h.sum, h.min, h.sum // h.count]
+                                + [h.percentile(p) for p in percentiles] + [h.max])
+                out.append(('{}.{}'.format(name, store),
+                            t['by'] + ['count', 'total', 'min', 'mean']
+                            + ['p{}'.format(p) for p in percentiles] + ['max'], rows))
+            for store in sorted(t['counters']):
+                groups = t['counters'][store]
+                rows = [g.split('->') + [groups[g]]
+                        for g in sorted(groups, key=lambda g: -groups[g])]
+                out.append(('{}.{}'.format(name, store), t['by'] + [store], rows))
+        return out
@@ -0,0 +1,1160 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import bisect
+import codecs
+import heapq
+import logging
+import mmap
+import re
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from .utils import TraceEvent
+except (ImportError, ValueError):
+    from utils import TraceEvent
+
+# Reads the binary trace.dat files of trace-cmd record (file versions 6
+# and 7) without a round trip through trace-cmd report. The file holds the
+# format of every event, the pid to comm map and, per CPU, the pages of
+# the kernel ring buffer as they were recorded. Version 6 has them one
+# after the other:
+#
+#   magic, version, endianness, long size, page size
+#   header_page, header_event     layout of a page and of a record header
+#   ftrace and event formats      one text description per event
+#   kallsyms, printk formats, saved cmdlines
+#   number of CPUs, options, flyrecord: offset and size of each CPU's pages
+#
+# Version 7, what trace-cmd 3 writes, has the same headers in sections
+# anywhere in the file, after the name of the compression they are in
+# (none, zstd or zlib) and the offset of the first list of options. The
+# options give the offset of each section, and the offset and size of the
+# pages of each CPU, compressed in chunks of a few pages in a compressed
+# file. A list of options ends with the offset of the next one.
+#
+# Records are decoded into the same TraceEvent parseline() makes of the
+# text output of the kernel, with 'buf' rendered from the print format of
+# the event, so the config does not care where its events come from.
+# Syscall and function events are printed the way the kernel prints them
+# in its text output, which is not what their print format says.
+#
+# Timestamps are in nanoseconds in the file and microseconds from here on,
+# as in the text output.
+
+magic = b'\x17\x08\x44tracing'
+
+# record types of the ring buffer
+_padding = 29
+_time_extend = 30
+# and 31, an absolute time stamp
+_max_data_type = 28
+# the size of the data in the 'commit' word of a page, the other bits are
+# flags (events lost before the page)
+_commit_mask = (1 << 27) - 1
+_missed_events = 1 << 31
+
+# options and sections of version 7
+_option_done = 0
+_option_buffer = 3
+_option_cpucount = 8
+_option_buffer_text = 22
+_sections = [(16, 'headers'), (17, 'ftrace events'), (18, 'event formats'),
+             (19, 'kallsyms'), (20, 'printk formats'), (21, 'cmdlines')]
+_section_compressed = 1
+
+class TraceDatError(Exception):
+    pass
+
+def is_tracedat(path):
+    with open(path, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+class _Unsupported(Exception):
+    # a print format this does not know how to evaluate
+    pass
+
+# Field of an event format:
+#   field:unsigned short common_type;	offset:0;	size:2;	signed:0;
+_field_re = re.compile(r'field:\s*(.*?);\s*offset:\s*(\d+);\s*size:\s*(\d+);(?:\s*signed:\s*(\d+);)?')
+_decl_re = re.compile(r'(.*?)\s*(\w+)\s*(?:\[(\w*)\])?$')
+
+_ints = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+class _Field(object):
+    __slots__ = ('name', 'type', 'offset', 'size', 'signed', 'kind', 'count')
+
+    def __init__(self, decl, offset, size, signed):
+        self.offset = offset
+        self.size = size
+        self.signed = signed
+        m = _decl_re.match(decl)
+        if m is None:
+            raise TraceDatError('cannot parse field {}'.format(decl))
+        self.type, self.name, count = m.group(1), m.group(2), m.group(3)
+        self.count = 1
+        if '__data_loc' in self.type:
+            # offset and length of the data within the record, in 32 bits
+            self.kind = 'loc_str' if 'char' in self.type else 'loc'
+        elif count is not None and 'char' in self.type:
+            self.kind = 'str'
+        elif count is not None and count.isdigit() and int(count) and size % int(count) == 0 \
+                and size // int(count) in _ints:
+            self.kind = 'array'
+            self.count = int(count)
+        elif count is None and size in _ints:
+            self.kind = 'int'
+        else:
+            self.kind = 'bytes'
+
+    def code(self):
+        # the struct format of the field
+        if self.kind in ('int', 'array'):
+            c = _ints[self.size // self.count]
+            c = c if self.signed else c.upper()
+            return '{}{}'.format(self.count, c) if self.kind == 'array' else c
+        if self.kind in ('loc', 'loc_str'):
+            return 'I'
+        return '{}s'.format(self.size)
+
+class EventFormat(object):
+    # One event format of the file, and how to decode and print its records
+    def __init__(self, system, text, trace):
+        self.system = system
+        self.name = None
+        self.id = None
+        self.fields = []
+        self.print_fmt = None
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith('name:'):
+                self.name = line[5:].strip()
+            elif line.startswith('ID:'):
+                self.id = int(line[3:])
+            elif line.startswith('field:'):
+                m = _field_re.match(line)
+                if m is None:
+                    raise TraceDatError('cannot parse {}'.format(line))
+                self.fields.append(_Field(m.group(1), int(m.group(2)), int(m.group(3)),
+                                          m.group(4) == '1'))
+            elif line.startswith('print fmt:'):
+                self.print_fmt = line[10:].strip()
+        if self.name is None or self.id is None:
+            raise TraceDatError('event format without a name or ID')
+
+        # all the fields are read with a single unpack_from()
+        layout = sorted(self.fields, key=lambda f: f.offset)
+        code = trace.endian
+        pos = 0
+        self.layout = []
+        for f in layout:
+            if f.offset < pos:
+                # overlaps the previous field
+                continue
+            code += '{}x'.format(f.offset - pos) if f.offset > pos else ''
+            code += f.code()
+            pos = f.offset + f.size
+            self.layout.append(f)
+        self.struct = struct.Struct(code)
+        self.names = [f.name for f in self.layout]
+        self.values = self.unpacker()
+
+        self.event_name = self.name
+        self.render = None
+        self.trace = trace
+        if system == 'syscalls' and (self.name.startswith('sys_enter_')
+                                     or self.name.startswith('sys_exit_')):
+            self.render = self.syscall_renderer()
+        elif system == 'ftrace' and self.name == 'function':
+            self.render = self.function_renderer()
+        elif self.print_fmt is not None:
+            try:
+                self.render = compile_print_fmt(self.print_fmt, self.names, trace)
+            except _Unsupported:
+                pass
+        if self.render is None:
+            self.render = self.fields_renderer()
+        # the text output starts with the event name, but for the events
+        # printed the kernel's own way
+        self.prefix = self.name + ': ' if self.event_name == self.name else ''
+
+    def unpacker(self):
+        # record -> {field: value}, with the strings and dynamic arrays
+        # read out of the record
+        unpack = self.struct.unpack_from
+        fields = self.layout
+        if not any(f.kind in ('str', 'loc', 'loc_str', 'array') for f in fields):
+            names = self.names
+            return lambda data, pos: dict(zip(names, unpack(data, pos)))
+
+        def values(data, pos):
+            raw = unpack(data, pos)
+            rec = {}
+            i = 0
+            for f in fields:
+                if f.kind == 'array':
+                    v = list(raw[i:i + f.count])
+                    i += f.count
+                else:
+                    v = raw[i]
+                    i += 1
+                    if f.kind == 'str':
+                        v = v.split(b'\0', 1)[0].decode('utf-8', 'replace')
+                    elif f.kind in ('loc', 'loc_str'):
+                        start = pos + (v & 0xffff)
+                        v = data[start:start + (v >> 16)]
+                        if f.kind == 'loc_str':
+                            v = v.split(b'\0', 1)[0].decode('utf-8', 'replace')
+                rec[f.name] = v
+            return rec
+        return values
+
+    def syscall_renderer(self):
+        # sys_enter_read is printed as 'sys_read(fd: 3, buf: 0x7ffd1234, ...)'
+        # and sys_exit_read as 'sys_read -> 0x3', under the name sys_read.
+        # As the kernel does, arguments below 10 are printed in decimal.
+        enter = self.name.startswith('sys_enter_')
+        self.event_name = 'sys_' + self.name[len('sys_enter_' if enter else 'sys_exit_'):]
+        name = self.event_name
+        mask = (1 << (8 * self.trace.long_size)) - 1
+        if enter:
+            args = [f.name for f in self.fields
+                    if not f.name.startswith('common_') and f.name != '__syscall_nr']
+            template = '{}({})'.format(name, ', '.join(a + ': %s' for a in args))
+            def value(v):
+                v &= mask
+                return str(v) if v < 10 else '0x%x' % v
+            return lambda rec: template % tuple([value(rec[a]) for a in args])
+        template = name + ' -> 0x%x'
+        return lambda rec: template % (rec['ret'] & mask)
+
+    def function_renderer(self):
+        # 'do_sys_open <-do_sys_openat2', named after the function
+        symbol = self.trace.symbol
+        self.event_name = None
+        return lambda rec: '{} <-{}'.format(symbol(rec['ip']), symbol(rec['parent_ip']))
+
+    def fields_renderer(self):
+        # what trace-cmd prints for a format it cannot evaluate either
+        names = [f.name for f in self.layout if not f.name.startswith('common_')]
+        return lambda rec: ' '.join('{}={}'.format(n, _plain(rec[n])) for n in names)
+
+def _plain(v):
+    if isinstance(v, bytes):
+        return ' '.join('{:02x}'.format(c) for c in bytearray(v))
+    return v
+
+# A C expression evaluator for the arguments of print formats, as they
+# are written by the TRACE_EVENT() macros: REC->field, casts, arithmetic,
+# ?: and the __print_*() and __get_*() helpers. Each expression compiles
+# into a function of the record.
+_token_re = re.compile(r'''\s*(?:
+    (?P<num>0[xX][0-9a-fA-F]+|\d+)[uUlL]* |
+    (?P<str>"(?:[^"\\]|\\.)*") |
+    (?P<chr>'(?:[^'\\]|\\.)') |
+    (?P<op>->|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^~!<>?:(),{}\[\]]) |
+    (?P<id>[A-Za-z_]\w*))''', re.X)
+
+_binary = {'||': 1, '&&': 2, '|': 3, '^': 4, '&': 5, '==': 6, '!=': 6,
+           '<': 7, '>': 7, '<=': 7, '>=': 7, '<<': 8, '>>': 8,
+           '+': 9, '-': 9, '*': 10, '/': 10, '%': 10}
+
+def _constant(v):
+    # an expression of no field, which is worked out once
+    f = lambda rec: v
+    f.constant = v
+    return f
+
+def _constants(*exprs):
+    return all(hasattr(e, 'constant') for e in exprs)
+
+def _cdiv(a, b):
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+_apply = {'|': lambda a, b: a | b, '^': lambda a, b: a ^ b, '&': lambda a, b: a & b,
+          '==': lambda a, b: int(a == b), '!=': lambda a, b: int(a != b),
+          '<': lambda a, b: int(a < b), '>': lambda a, b: int(a > b),
+          '<=': lambda a, b: int(a <= b), '>=': lambda a, b: int(a >= b),
+          '<<': lambda a, b: a << b, '>>': lambda a, b: a >> b,
+          '+': lambda a, b: a + b, '-': lambda a, b: a - b, '*': lambda a, b: a * b,
+          '/': _cdiv, '%': lambda a, b: a - b * _cdiv(a, b)}
+
+_type_words = set(['unsigned', 'signed', 'int', 'long', 'short', 'char', 'void', 'bool',
+                   '_Bool', 'const', 'struct', 'volatile'])
+
+def _tokens(text):
+    out = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _token_re.match(text, pos)
+        if m is None or m.end() == pos:
+            raise _Unsupported(text[pos:])
+        pos = m.end()
+        kind = m.lastgroup
+        out.append((kind, m.group(kind)))
+    return out
+
+def _c_string(s):
+    return codecs.decode(s[1:-1].encode('latin-1'), 'unicode_escape')
+
+class _Parser(object):
+    def __init__(self, tokens, fields, trace):
+        self.tokens = tokens
+        self.pos = 0
+        self.fields = set(fields)
+        self.trace = trace
+        self.long_bits = 8 * trace.long_size
+
+    def peek(self, ahead=0):
+        i = self.pos + ahead
+        return self.tokens[i] if i < len(self.tokens) else (None, None)
+
+    def take(self, value=None):
+        t = self.peek()
+        if t[0] is None or value is not None and t[1] != value:
+            raise _Unsupported('expected {}'.format(value))
+        self.pos += 1
+        return t
+
+    def args(self):
+        # comma separated expressions, up to the end
+        out = []
+        while self.peek()[0] is not None:
+            out.append(self.expr())
+            if self.peek()[0] is not None:
+                self.take(',')
+        return out
+
+    def expr(self):
+        cond = self.binary(1)
+        if self.peek()[1] != '?':
+            return cond
+        self.take('?')
+        a = self.expr()
+        self.take(':')
+        b = self.expr()
+        if _constants(cond):
+            return a if cond.constant else b
+        return lambda rec: a(rec) if cond(rec) else b(rec)
+
+    def binary(self, level):
+        left = self.unary()
+        while True:
+            kind, op = self.peek()
+            if kind != 'op' or op not in _binary or _binary[op] < level:
+                return left
+            self.take()
+            right = self.binary(_binary[op] + 1)
+            left = self.combine(op, left, right)
+
+    def combine(self, op, a, b):
+        f = self.combined(op, a, b)
+        if _constants(a, b):
+            try:
+                return _constant(f(None))
+            except ZeroDivisionError:
+                pass
+        return f
+
+    def combined(self, op, a, b):
+        if op == '&&':
+            return lambda rec: int(bool(a(rec)) and bool(b(rec)))
+        if op == '||':
+            return lambda rec: int(bool(a(rec)) or bool(b(rec)))
+        f = _apply[op]
+        return lambda rec: f(a(rec), b(rec))
+
+    def cast(self):
+        # the mask and sign of a cast, when a '(' starts one
+        words = []
+        i = 0
+        while True:
+            kind, v = self.peek(1 + i)
+            if v == ')':
+                break
+            if kind != 'id' and v != '*':
+                return None
+            words.append(v)
+            i += 1
+        if not words or not (words[0] in _type_words or words[0].endswith('_t')
+                             or re.match(r'^_*[us](8|16|32|64)$', words[0])):
+            return None
+        self.pos += i + 2
+
+        if '*' in words:
+            return self.long_bits, False
+        bits = 32
+        unsigned = 'unsigned' in words
+        for w in words:
+            m = re.match(r'^_*([us])(8|16|32|64)$', w)
+            if m:
+                bits, unsigned = int(m.group(2)), m.group(1) == 'u'
+            elif w == 'char':
+                bits = 8
+            elif w == 'short':
+                bits = 16
+            elif w in ('size_t', 'ssize_t'):
+                bits, unsigned = self.long_bits, w == 'size_t'
+        if words.count('long') == 1:
+            bits = self.long_bits
+        elif words.count('long') > 1:
+            bits = 64
+        if 'bool' in words or '_Bool' in words or 'void' in words:
+            return None, False
+        return bits, unsigned
+
+    def unary(self):
+        kind, v = self.peek()
+        if kind == 'op' and v in ('!', '~', '-', '+'):
+            self.take()
+            a = self.unary()
+            if _constants(a):
+                return _constant({'!': lambda x: int(not x), '~': lambda x: ~x,
+                                  '-': lambda x: -x, '+': lambda x: x}[v](a.constant))
+            if v == '!':
+                return lambda rec: int(not a(rec))
+            if v == '~':
+                return lambda rec: ~a(rec)
+            if v == '-':
+                return lambda rec: -a(rec)
+            return a
+        if v == '(':
+            c = self.cast()
+            if c is not None:
+                a = self.unary()
+                bits, unsigned = c
+                if bits is None:
+                    return a
+                mask = (1 << bits) - 1
+                top = 1 << (bits - 1)
+                def cast(rec):
+                    x = a(rec)
+                    if not isinstance(x, int):
+                        return x
+                    x &= mask
+                    return x - (1 << bits) if not unsigned and x & top else x
+                return _constant(cast(None)) if _constants(a) else cast
+        return self.postfix()
+
+    def postfix(self):
+        a = self.primary()
+        while self.peek()[1] == '[':
+            self.take('[')
+            i = self.expr()
+            self.take(']')
+            a = (lambda a, i: lambda rec: a(rec)[i(rec)])(a, i)
+        return a
+
+    def primary(self):
+        kind, v = self.take()
+        if kind == 'num':
+            n = int(v, 0) if not (len(v) > 1 and v[0] == '0' and v[1] not in 'xX') else int(v, 8)
+            return _constant(n)
+        if kind == 'str':
+            s = _c_string(v)
+            while self.peek()[0] == 'str':
+                s += _c_string(self.take()[1])
+            return _constant(s)
+        if kind == 'chr':
+            return _constant(ord(_c_string(v)))
+        if v == '(':
+            a = self.expr()
+            self.take(')')
+            return a
+        if v == '{':
+            # the { value, "name" } pairs of __print_flags/__print_symbolic
+            items = []
+            while self.peek()[1] != '}':
+                items.append(self.expr())
+                if self.peek()[1] == ',':
+                    self.take(',')
+            self.take('}')
+            if _constants(*items):
+                return _constant(tuple(i.constant for i in items))
+            return lambda rec: tuple(i(rec) for i in items)
+        if kind == 'id' and v == 'REC':
+            self.take('->')
+            name = self.take()[1]
+            if name not in self.fields:
+                raise _Unsupported(name)
+            return lambda rec: rec[name]
+        if kind == 'id' and self.peek()[1] == '(':
+            return self.call(v)
+        raise _Unsupported(v)
+
+    def field_arg(self):
+        # __get_str(name) and friends take the bare field name
+        self.take('(')
+        name = self.take()[1]
+        if name not in self.fields:
+            raise _Unsupported(name)
+        self.take(')')
+        return name
+
+    def call(self, func):
+        if func in ('__get_str', '__get_dynamic_array', '__get_rel_str',
+                    '__get_rel_dynamic_array'):
+            name = self.field_arg()
+            return lambda rec: rec[name]
+        if func in ('__get_dynamic_array_len', '__get_rel_dynamic_array_len'):
+            name = self.field_arg()
+            return lambda rec: len(rec[name])
+        if func == '__get_bitmask':
+            name = self.field_arg()
+            return lambda rec: ','.join('{:02x}'.format(c) for c in reversed(bytearray(rec[name])))
+
+        self.take('(')
+        args = []
+        while self.peek()[1] != ')':
+            args.append(self.expr())
+            if self.peek()[1] == ',':
+                self.take(',')
+        self.take(')')
+
+        if func == '__print_flags' and len(args) > 1 and _constants(*args[1:]):
+            value, delim = args[0], args[1].constant
+            pairs = [a.constant for a in args[2:]]
+            return lambda rec: _print_flags(value(rec), delim, pairs)
+        if func == '__print_symbolic' and _constants(*args[1:]):
+            value, pairs = args[0], [a.constant for a in args[1:]]
+            return lambda rec: _print_symbolic(value(rec), pairs)
+        if func in ('__print_hex', '__print_hex_str'):
+            sep = ' ' if func == '__print_hex' else ''
+            return lambda rec: sep.join('{:02x}'.format(c) for c in
+                                        bytearray(args[0](rec)[:args[1](rec)]))
+        if func == '__print_array':
+            return lambda rec: '{' + ','.join('0x{:x}'.format(x) for x in args[0](rec)) + '}'
+        raise _Unsupported(func)
+
+def _print_flags(value, delim, pairs):
+    if value == 0:
+        for v, s in pairs:
+            if v == 0:
+                return s
+        return ''
+    out = []
+    for v, s in pairs:
+        if v and value & v == v:
+            out.append(s)
+            value &= ~v
+    if value:
+        out.append('0x{:x}'.format(value))
+    return delim.join(out)
+
+def _print_symbolic(value, pairs):
+    for v, s in pairs:
+        if v == value:
+            return s
+    return '0x{:x}'.format(value)
+
+_spec_re = re.compile(r'%([-+ #0]*)(\*|\d+)?(?:\.(\*|\d+))?(hh|h|ll|l|z|L|j|t|q)?([diouxXcsp%])')
+
+def compile_print_fmt(text, fields, trace):
+    # '"format", args' into a function of the record
+    tokens = _tokens(text)
+    if not tokens or tokens[0][0] != 'str':
+        raise _Unsupported(text)
+    fmt = ''
+    i = 0
+    while i < len(tokens) and tokens[i][0] == 'str':
+        fmt += _c_string(tokens[i][1])
+        i += 1
+    parser = _Parser(tokens, fields, trace)
+    parser.pos = i
+    args = []
+    if parser.peek()[0] is not None:
+        parser.take(',')
+        args = parser.args()
+
+    # the literal text stays in a template of the conversions
+    long_bits = 8 * trace.long_size
+    template = ''
+    convs = []
+    pos = 0
+    n = 0
+    for m in _spec_re.finditer(fmt):
+        template += fmt[pos:m.start()].replace('%', '%%')
+        pos = m.end()
+        flags, width, prec, length, conv = m.groups()
+        if conv == '%':
+            template += '%%'
+            continue
+        if width == '*' or prec == '*':
+            raise _Unsupported('* width')
+        ext = ''
+        if conv == 'p':
+            e = re.match(r'[a-zA-Z]+', fmt[pos:])
+            if e:
+                ext = e.group(0)
+                pos += len(ext)
+        if n >= len(args):
+            raise _Unsupported('too few arguments')
+        spec, value = _converter(flags, width, prec, length, conv, ext, long_bits, trace,
+                                 args[n])
+        template += spec
+        convs.append(value)
+        n += 1
+    template += fmt[pos:].replace('%', '%%')
+    if n != len(args):
+        raise _Unsupported('too many arguments')
+
+    return lambda rec: template % tuple([c(rec) for c in convs])
+
+def _converter(flags, width, prec, length, conv, ext, long_bits, trace, arg):
+    # the conversion in the template and the function of the record which
+    # gives the value for it
+    spec = '%' + flags + (width or '') + ('.' + prec if prec is not None else '')
+    bits = long_bits if length in ('l', 'z', 't') else 64 if length in ('ll', 'L', 'j', 'q') else 32
+    mask = (1 << bits) - 1
+    if conv in 'di':
+        return spec + 'd', lambda rec: _number(arg(rec))
+    if conv in 'uoxX':
+        return spec + ('d' if conv == 'u' else conv), lambda rec: _number(arg(rec)) & mask
+    if conv == 'c':
+        return spec + 'c', lambda rec: chr(_number(arg(rec)) & 0xff)
+    if conv == 's':
+        return spec + 's', lambda rec: _text(arg(rec))
+    # %p, and %pS and the like which print the symbol at the address
+    pmask = (1 << long_bits) - 1
+    if ext[:1] in ('S', 's', 'F', 'f', 'B'):
+        symbol = trace.symbol
+        return spec + 's', lambda rec: symbol(_number(arg(rec)) & pmask)
+    return spec + 's', lambda rec: '0x{:x}'.format(_number(arg(rec)) & pmask)
+
+def _number(v):
+    if v.__class__ is int:
+        return v
+    if isinstance(v, (list, tuple)):
+        v = v[0] if v else 0
+    if isinstance(v, bytes):
+        v = sum(c << (8 * i) for i, c in enumerate(bytearray(v[:8])))
+    return int(v)
+
+def _text(v):
+    if v.__class__ is str:
+        return v
+    if isinstance(v, bytes):
+        return v.split(b'\0', 1)[0].decode('utf-8', 'replace')
+    return str(v)
+
+class _Pages(object):
+    # The ring buffer pages of a CPU, as (data, offset) of each page:
+    # straight out of the file, or out of the 'chunks' of a compressed
+    # file, (first page, offset, size, decompressed size) each, which are
+    # decompressed as they are needed
+    def __init__(self, data, offset, size, page_size, chunks=None, decompress=None):
+        self.data = data
+        self.offset = offset
+        self.size = size
+        self.page_size = page_size
+        self.chunks = chunks
+        self.decompress = decompress
+        self.cached = None
+        if chunks is None:
+            self.count = size // page_size
+        else:
+            self.firsts = [c[0] for c in chunks]
+            self.count = chunks[-1][0] + chunks[-1][3] // page_size if chunks else 0
+
+    def page(self, p):
+        if self.chunks is None:
+            return self.data, self.offset + p * self.page_size
+        i = bisect.bisect_right(self.firsts, p) - 1
+        if self.cached is None or self.cached[0] != i:
+            first, offset, size, full = self.chunks[i]
+            self.cached = (i, self.decompress(self.data[offset:offset + size], full))
+        return self.cached[1], (p - self.chunks[i][0]) * self.page_size
+
+# the letters of the flags column of the text output
+def _latency_flags(flags, preempt):
+    irqs = 'd' if flags & 0x01 else 'X' if flags & 0x02 else '.'
+    nr, pr = flags & 0x04, flags & 0x20
+    resched = 'N' if nr and pr else 'n' if nr else 'p' if pr else '.'
+    hard, soft, nmi = flags & 0x08, flags & 0x10, flags & 0x40
+    irq = ('Z' if nmi and hard else 'z' if nmi else 'H' if hard and soft
+           else 'h' if hard else 's' if soft else '.')
+    count = '{:x}'.format(preempt & 0xf) if preempt & 0xf else '.'
+    migrate = '{:x}'.format(preempt >> 4) if preempt >> 4 else '.'
+    return irqs + resched + irq + count + migrate
+
+class TraceDat(object):
+    # A trace.dat file, mapped read only
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise TraceDatError('empty file')
+        try:
+            self.read_headers()
+        except (struct.error, IndexError, ValueError) as e:
+            self.close()
+            raise TraceDatError('truncated or damaged: {}'.format(e))
+        except TraceDatError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, fmt):
+        v = struct.unpack_from(self.endian + fmt, self.buf, self.pos)
+        self.pos += struct.calcsize(self.endian + fmt)
+        return v[0]
+
+    def string(self):
+        end = self.buf.find(b'\0', self.pos)
+        if end < 0:
+            raise TraceDatError('unterminated string')
+        s = self.buf[self.pos:end].decode('utf-8', 'replace')
+        self.pos = end + 1
+        return s
+
+    def block(self, size):
+        data = self.buf[self.pos:self.pos + size]
+        if len(data) != size:
+            raise TraceDatError('truncated')
+        self.pos += size
+        return data.decode('utf-8', 'replace')
+
+    def read_headers(self):
+        # 'buf' is what the headers are read from at 'pos', the file or a
+        # decompressed section
+        if self.map[:len(magic)] != magic:
+            raise TraceDatError('not a trace.dat file')
+        self.buf = self.map
+        self.pos = len(magic)
+        self.endian = '<'
+        version = self.string()
+        if version not in ('6', '7'):
+            raise TraceDatError('file version {} is not supported'.format(version))
+        self.endian = '>' if self.map[self.pos:self.pos + 1] == b'\x01' else '<'
+        self.long_size = bytearray(self.map[self.pos + 1:self.pos + 2])[0]
+        self.pos += 2
+        self.page_size = self.read('I')
+
+        self.decompress = None
+        if version == '6':
+            self.read_header_info()
+            self.read_ftrace_formats()
+            self.read_event_formats()
+            self.read_kallsyms()
+            self.read_printk()
+            self.read_cmdlines()
+            self.read_flyrecord()
+        else:
+            self.read_sections()
+        self.buf = None
+        self.size = sum(c.size for c in self.cpus)
+
+    def read_header_info(self):
+        if self.string() != 'header_page':
+            raise TraceDatError('no header_page')
+        page = {}
+        for m in _field_re.finditer(self.block(self.read('Q'))):
+            f = _Field(m.group(1), int(m.group(2)), int(m.group(3)), m.group(4) == '1')
+            page[f.name] = f
+        self.commit = struct.Struct(self.endian + ('Q' if page['commit'].size == 8 else 'I'))
+        self.commit_offset = page['commit'].offset
+        self.data_offset = page['data'].offset
+        if self.string() != 'header_event':
+            raise TraceDatError('no header_event')
+        self.block(self.read('Q'))
+
+    def read_ftrace_formats(self):
+        self.formats = {}
+        for i in range(self.read('I')):
+            self.add_format('ftrace', self.block(self.read('Q')))
+
+    def read_event_formats(self):
+        for i in range(self.read('I')):
+            system = self.string()
+            for j in range(self.read('I')):
+                self.add_format(system, self.block(self.read('Q')))
+
+    def read_kallsyms(self):
+        self.symbols = []
+        for line in self.block(self.read('I')).splitlines():
+            parts = line.split()
+            if len(parts) >= 3:
+                self.symbols.append((int(parts[0], 16), parts[2]))
+        self.symbols.sort()
+        self.addresses = [a for a, s in self.symbols]
+
+    def read_printk(self):
+        self.block(self.read('I'))
+
+    def read_cmdlines(self):
+        self.comms = {}
+        for line in self.block(self.read('Q')).splitlines():
+            pid, sep, comm = line.strip().partition(' ')
+            if pid.isdigit():
+                self.comms[int(pid)] = comm
+        self.comms[0] = '<idle>'
+
+    def read_flyrecord(self):
+        cpus = self.read('I')
+        while True:
+            section = self.map[self.pos:self.pos + 10]
+            self.pos += 10
+            if section == b'options  \0':
+                while self.read('H') != 0:
+                    size = self.read('I')
+                    self.pos += size
+            elif section == b'flyrecord\0':
+                break
+            elif section == b'latency  \0':
+                raise TraceDatError('a latency trace holds text, not ring buffer pages')
+            else:
+                raise TraceDatError('unknown section {!r}'.format(section))
+        self.cpus = []
+        for cpu in range(cpus):
+            offset = self.read('Q')
+            size = self.read('Q')
+            self.cpus.append(self.cpu_pages(cpu, offset, size))
+
+    def read_sections(self):
+        # version 7: the headers, and the pages of the top level ring
+        # buffer, wherever the options say they are
+        self.decompress = self.decompressor(self.string())
+        self.string()
+        options = self.read('Q')
+        sections = {}
+        buffers = []
+        cpus = 0
+        seen = set()
+        while options:
+            if options in seen:
+                raise TraceDatError('the options go round in circles')
+            seen.add(options)
+            end = self.section(options, _option_done)
+            options = 0
+            while self.pos < end:
+                kind = self.read('H')
+                size = self.read('I')
+                start = self.pos
+                if kind == _option_done:
+                    options = self.read('Q')
+                    break
+                elif kind in dict(_sections):
+                    sections[kind] = self.read('Q')
+                elif kind == _option_buffer:
+                    buffers.append(self.read_buffer())
+                elif kind == _option_cpucount:
+                    cpus = self.read('I')
+                elif kind == _option_buffer_text:
+                    raise TraceDatError('a latency trace holds text, not ring buffer pages')
+                self.pos = start + size
+
+        for (kind, name), read in zip(_sections, (
+                self.read_header_info, self.read_ftrace_formats, self.read_event_formats,
+                self.read_kallsyms, self.read_printk, self.read_cmdlines)):
+            if kind not in sections:
+                raise TraceDatError('no {} section'.format(name))
+            self.section(sections[kind], kind)
+            read()
+
+        top = [percpu for name, percpu in buffers if name == '']
+        if not top:
+            raise TraceDatError('no ring buffer pages')
+        ids = [cpu for cpu, offset, size in top[0]]
+        self.cpus = [_Pages(self.map, 0, 0, self.page_size)
+                     for cpu in range(max([cpus] + [i + 1 for i in ids]))]
+        for cpu, offset, size in top[0]:
+            self.cpus[cpu] = self.cpu_pages(cpu, offset, size)
+
+    def read_buffer(self):
+        # the name of a ring buffer, '' for the top level one, and the
+        # (cpu, offset, size) of the pages of each of its CPUs
+        self.read('Q')
+        name = self.string()
+        self.string()
+        if self.read('I') != self.page_size:
+            raise TraceDatError('ring buffer {!r} has pages of another size'.format(name))
+        cpus = []
+        for i in range(self.read('I')):
+            cpu = self.read('I')
+            offset = self.read('Q')
+            cpus.append((cpu, offset, self.read('Q')))
+        return name, cpus
+
+    def section(self, offset, kind):
+        # Go to the data of the section at 'offset', decompressed if it
+        # is. Returns where it ends.
+        found, flags, desc, size = struct.unpack_from(self.endian + 'HHIQ', self.map, offset)
+        if found != kind:
+            raise TraceDatError('section {} expected at {}, not {}'.format(kind, offset, found))
+        start = offset + 16
+        if flags & _section_compressed:
+            if self.decompress is None:
+                raise TraceDatError('compressed section {} in a file which is not'.format(kind))
+            size, full = struct.unpack_from(self.endian + 'II', self.map, start)
+            self.buf = self.decompress(self.map[start + 8:start + 8 + size], full)
+            self.pos = 0
+            return len(self.buf)
+        self.buf = self.map
+        self.pos = start
+        return start + size
+
+    def decompressor(self, name):
+        # data, decompressed size -> the data decompressed, for the
+        # compression of the file
+        if name == 'none':
+            return None
+        if name == 'zstd':
+            if zstandard is None:
+                raise TraceDatError('the file is compressed with zstd, which needs the '
+                                    'zstandard module')
+            errors = (zstandard.ZstdError,)
+            def decompress(data):
+                return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        elif name == 'zlib':
+            errors = (zlib.error,)
+            decompress = zlib.decompress
+        else:
+            raise TraceDatError('unknown compression {}'.format(name))
+
+        def checked(data, size):
+            try:
+                out = decompress(data)
+            except errors as e:
+                raise TraceDatError('damaged compressed data: {}'.format(e))
+            if len(out) != size:
+                raise TraceDatError('damaged compressed data')
+            return out
+        return checked
+
+    def cpu_pages(self, cpu, offset, size):
+        if offset + size > len(self.map):
+            # a copy which was cut short, what is there can be read
+            logging.warning('%s: the pages of CPU %d are cut short', self.path, cpu)
+            size = max(len(self.map) - offset, 0)
+        if self.decompress is None:
+            return _Pages(self.map, offset, size, self.page_size)
+
+        # a count of chunks, then the size, decompressed size and data of
+        # each. The size trace-cmd gives leaves the count out, the chunks
+        # are only bounded by the end of the file.
+        chunks = []
+        end = len(self.map)
+        if size >= 4:
+            pos = offset + 4
+            first = 0
+            for i in range(struct.unpack_from(self.endian + 'I', self.map, offset)[0]):
+                if pos + 8 > end:
+                    break
+                csize, full = struct.unpack_from(self.endian + 'II', self.map, pos)
+                if pos + 8 + csize > end:
+                    break
+                chunks.append((first, pos + 8, csize, full))
+                first += full // self.page_size
+                pos += 8 + csize
+        return _Pages(self.map, offset, size, self.page_size, chunks, self.decompress)
+
+    def add_format(self, system, text):
+        f = EventFormat(system, text, self)
+        self.formats[f.id] = f
+
+    def symbol(self, address):
+        i = bisect.bisect_right(self.addresses, address) - 1
+        if i < 0 or not address:
+            return '0x{:x}'.format(address)
+        a, name = self.symbols[i]
+        return name if a == address else '{}+0x{:x}'.format(name, address - a)
+
+    def pages(self, cpu):
+        return self.cpus[cpu].count
+
+    def page_time(self, cpu, page):
+        data, offset = self.cpus[cpu].page(page)
+        return struct.unpack_from(self.endian + 'Q', data, offset)[0]
+
+    def windows(self, n):
+        # Up to 'n' time ranges in nanoseconds with about as many pages in
+        # each, for decoding in parallel. The last one is open ended.
+        times = sorted(self.page_time(cpu, p) for cpu in range(len(self.cpus))
+                       for p in range(self.pages(cpu)))
+        if not times:
+            return [(0, None)]
+        bounds = [0]
+        for i in range(1, n):
+            t = times[len(times) * i // n]
+            if t > bounds[-1]:
+                bounds.append(t)
+        return list(zip(bounds, bounds[1:] + [None]))
+
+    def records(self, cpu, start=0, end=None):
+        # (timestamp, data, offset, length) of the data of each record of a
+        # CPU from the page which may hold 'start' on, up to 'end'
+        source = self.cpus[cpu]
+        pages = source.count
+        first = 0
+        if start:
+            # the first page starting after 'start' is past it
+            lo, hi = 0, pages
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.page_time(cpu, mid) <= start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            first = max(lo - 1, 0)
+
+        u32 = struct.Struct(self.endian + 'I').unpack_from
+        little = self.endian == '<'
+        commit = self.commit.unpack_from
+        for p in range(first, pages):
+            data, page = source.page(p)
+            ts = struct.unpack_from(self.endian + 'Q', data, page)[0]
+            if end is not None and ts >= end:
+                return
+            flags = commit(data, page + self.commit_offset)[0]
+            if flags & _missed_events and ts >= start:
+                self.missed += 1
+            pos = page + self.data_offset
+            stop = pos + (flags & _commit_mask)
+            while pos < stop:
+                h = u32(data, pos)[0]
+                if little:
+                    type_len, delta = h & 0x1f, h >> 5
+                else:
+                    type_len, delta = h >> 27, h & 0x7ffffff
+                pos += 4
+                if type_len == 0:
+                    length = (u32(data, pos)[0] - 4 + 3) & ~3
+                    pos += 4
+                elif type_len <= _max_data_type:
+                    length = type_len * 4
+                elif type_len == _padding:
+                    if delta == 0:
+                        # the rest of the page is unused
+                        break
+                    ts += delta
+                    pos += u32(data, pos)[0]
+                    continue
+                elif type_len == _time_extend:
+                    ts += (u32(data, pos)[0] << 27) + delta
+                    pos += 4
+                    continue
+                else:
+                    ts = (u32(data, pos)[0] << 27) + delta
+                    pos += 4
+                    continue
+                ts += delta
+                if end is not None and ts >= end:
+                    return
+                if ts >= start:
+                    yield ts, data, pos, length
+                pos += length
+
+    def cpu_events(self, cpu, wanted, keep=None, start=0, end=None):
+        # (nanoseconds, TraceEvent) of the records of a CPU 'wanted' says
+        # yes to by the event name, and the EventFilter 'keep' lets through
+        formats = self.formats
+        comms = self.comms
+        common = struct.Struct(self.endian + 'HBBi').unpack_from
+        flag_letters = {}
+        names = {}
+        for ts, data, pos, length in self.records(cpu, start, end):
+            self.count += 1
+            kind, flags, preempt, pid = common(data, pos)
+            f = formats.get(kind)
+            if f is None:
+                # of a format the file does not have
+                self.unknown += 1
+                continue
+            name = f.event_name
+            if name is not None:
+                w = names.get(kind)
+                if w is None:
+                    w = names[kind] = wanted(name)
+                if not w:
+                    continue
+            comm = comms.get(pid, '<...>')
+            if keep is not None and not keep.task(pid, cpu, comm):
+                continue
+            # rounded, as the text output is
+            usec = (ts + 500) // 1000
+            if keep is not None and keep.timed and not keep.window_ts(usec):
+                continue
+
+            rec = f.values(data, pos)
+            try:
+                text = f.render(rec)
+            except (_Unsupported, KeyError, IndexError, TypeError, ValueError,
+                    ZeroDivisionError):
+                text = f.fields_renderer()(rec)
+            if name is None:
+                # named after the function, which is only known now
+                name = text.split(' ', 1)[0]
+                if not wanted(name):
+                    continue
+            buf = f.prefix + text
+
+            letters = flag_letters.get((flags, preempt))
+            if letters is None:
+                letters = flag_letters[(flags, preempt)] = _latency_flags(flags, preempt)
+            yield ts, TraceEvent(comm, pid, cpu, letters, usec, name, buf)
+
+    def events(self, wanted, keep=None, start=0, end=None):
+        # The TraceEvents of all CPUs in time order, of the records from
+        # 'start' up to 'end' nanoseconds. Records of the same time go in
+        # CPU order.
+        self.count = 0
+        self.unknown = 0
+        self.missed = 0
+        heap = []
+        for cpu in range(len(self.cpus)):
+            it = self.cpu_events(cpu, wanted, keep, start, end)
+            for ts, e in it:
+                heap.append((ts, cpu, e, it))
+                break
+        heapq.heapify(heap)
+        while heap:
+            ts, cpu, e, it = heap[0]
+            yield e
+            for ts, n in it:
+                heapq.heapreplace(heap, (ts, cpu, n, it))
+                break
+            else:
+                heapq.heappop(heap)
+
+def time_range(keep):
+    # the nanoseconds from and up to which the --from/--to window of an
+    # EventFilter reaches
+    start, end = 0, None
+    if keep is not None and keep.start is not None:
+        start = max(keep.start * 1000 - 500, 0)
+    if keep is not None and keep.end is not None:
+        end = (keep.end + 1) * 1000 - 500
+    return start, end
+
+def names_wanted(names, filter=None):
+    # whether an event name is of use to the config entries (or other
+    # handlers) of these names, see EventDispatch
+    cache = {}
+    def wanted(name):
+        w = cache.get(name)
+        if w is None:
+            w = cache[name] = (any(n in name for n in names)
+                               and (filter is None or filter.allows(name)))
+        return w
+    return wanted
@@ -3,363 +3,1318 @@
 import json
 import sys
 import os
-import re
-import datetime
 import sqlite3
 import time
-import argparse
+import itertools
 import logging
-
-from utils import parseline, display_results, flattenMap
+import multiprocessing
+import tempfile
+
+# Imported as the package by the library (see api.py), run as a script from
+# this directory otherwise.
+try:
+    from .utils import display_results
+    from .utils import current_rss
+    from .utils import EventDispatch, EventFilter
+    from .handlers import Handler, EventStore, SchedIntervals
+    from .handlers import events_schema, insert_batch, store_events
+    from .reader import TraceReader, follow_lines, line_events
+    from .reader import compression, missing_module, decompressed_lines
+    from .reader import compressed_chunks
+    from .tracedat import TraceDat, TraceDatError, is_tracedat, names_wanted, time_range
+    from . import columnar
+    from . import explain
+    from . import output
+    from . import queries
+    from .queries import QueryError
+    from .output import ResultWriter, OutputError
+    from .summary import Summary
+    from .stats import Stats
+    from .aggregate import process_chunk, process_file
+except (ImportError, ValueError):
+    from utils import display_results
+    from utils import current_rss
+    from utils import EventDispatch, EventFilter
+    from handlers import Handler, EventStore, SchedIntervals
+    from handlers import events_schema, insert_batch, store_events
+    from reader import TraceReader, follow_lines, line_events
+    from reader import compression, missing_module, decompressed_lines
+    from reader import compressed_chunks
+    from tracedat import TraceDat, TraceDatError, is_tracedat, names_wanted, time_range
+    import columnar
+    import explain
+    import output
+    import queries
+    from queries import QueryError
+    from output import ResultWriter, OutputError
+    from summary import Summary
+    from stats import Stats
+    from aggregate import process_chunk, process_file
 
 bug_address="drajarshi@in.ibm.com,santosiv@in.ibm.com"
 
-trace_state_file = '/tmp/trace_state' # Internal use only
-
-trace_mismatch_entry = False   # entry_pattern
-trace_mismatch_exit  = False   # exit_pattern
-
-trace_state_set = False        # Mark if trace was incomplete
-
-class TraceUtil:
-    def __init__(self):
-        cdir, filename = os.path.split(__file__)
-        default_jsonconfig_path = os.path.join(cdir, "traceconfig.json")
-        parser = argparse.ArgumentParser(description='''Work with traces.''',
-                                         epilog='''See man page for more details.
-                                         Report bugs to <{}>'''.format(bug_address),
-                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-        parser.add_argument('tracefile', type=str, nargs='?', help='trace file')
-        parser.add_argument('dbfile', type=str, nargs='?', default="tracedump.db",
-                            help='sqlite3 database file')
-        parser.add_argument('--type', '-t', type=str,
-                            help='Top level type from the config file',
-                            default='ftrace')
-        parser.add_argument('--query', '-q', type=int, nargs='+',
-                            help='the query number to run')
-        parser.add_argument('--qargs', '-a', type=str, nargs='+',
-                            help='arguments to the query if any')
-        parser.add_argument('--list', '-l', action='store_true',
-                            help='List all the available queries')
-        parser.add_argument('--generate', '-g', action='store_true',
-                            help='Store data in database from tracefile')
-        parser.add_argument('--debug', '-d', action='store_true',
-                            help='Print debug information')
-        parser.add_argument('--verbose', "-v", action='store_true',
-                            help="increase output verbosity")
-        parser.add_argument("--logfile", '-f', type=str, nargs=1, help='Save all logging and debug information to this file')
-        parser.add_argument('--config', '-c', type=str, nargs=1,
-                            help='JSON config file', default=default_jsonconfig_path)
-        parser.add_argument('--version', action='version', version='%(prog)s 1.0')
-
-        if len(sys.argv) == 1:
-            parser.print_usage()
-            sys.exit(1)
-
-        log_level = logging.WARNING
-        self.args = parser.parse_args()
-
-        if self.args.debug:
-            log_level = logging.DEBUG
-
-        if self.args.verbose:
-            if not self.args.debug:
-                log_level = logging.INFO
-
-        if self.args.logfile:
-            logfile = self.args.logfile[0]
-        else:
-            logfile = None
-
-        # Changes to match python3 logging format
-        logformat = '%(asctime)s %(levelname)s: %(message)s'
-
-        logging.basicConfig(level=log_level,
-                            filename=logfile,
-                            format=logformat)
-
-        sh = logging.StreamHandler(sys.stderr)
-        sh.setLevel(log_level)
-        sh.setFormatter(logging.Formatter(logformat))
-        logging.getLogger('').addHandler(sh)
-
-        with open(self.args.config) as json_file:
-            try:
-                self.config = json.load(json_file)
-            except ValueError:
-                print("Invalid JSON file")
-                exit(1)
-
-        if 'traceworks' not in self.config:
-            print("JSON file does not contain traceworks.")
+default_config = os.path.join(os.path.split(__file__)[0], "traceconfig.json")
+
+# The database can always be regenerated from the trace, so the bulk load
+# trades durability for speed.
+ingest_pragmas = ['journal_mode=WAL', 'synchronous=OFF',
+                  'cache_size=-262144', 'temp_store=MEMORY']
+flush_interval = 65536         # lines between --memory-limit checks
+compressed_chunk = 8 << 20     # compressed bytes per --jobs chunk
+
+# The indexes of the raw events of --events, whose tables are those of
+# events_schema (see handlers.py).
+events_indexes = [('event', 'ts'), ('pid', 'ts'), ('cpu', 'ts')]
+
+# The run intervals of --intervals. They are looked up by time through an
+# R*Tree over (start_ts, end_ts, cpu), whose single precision bounds are
+# rounded outwards, so queries go through it and check the exact values in
+# sched_intervals. Without the rtree module it is a plain indexed table.
+intervals_schema = ('CREATE TABLE IF NOT EXISTS sched_intervals (cpu INTEGER, pid INTEGER, '
+                    'comm TEXT, start_ts INTEGER, end_ts INTEGER)')
+intervals_rtree = ('CREATE VIRTUAL TABLE IF NOT EXISTS sched_intervals_rtree '
+                   'USING rtree(id, start_ts, end_ts, cpu_lo, cpu_hi)')
+intervals_indexes = [('cpu', 'start_ts'), ('pid', 'start_ts')]
+intervals_table = ['CREATE TABLE IF NOT EXISTS sched_intervals_rtree (id INTEGER PRIMARY KEY, '
+                   'start_ts INTEGER, end_ts INTEGER, cpu_lo INTEGER, cpu_hi INTEGER)',
+                   'CREATE INDEX IF NOT EXISTS sched_intervals_rtree_idx '
+                   'ON sched_intervals_rtree (cpu_lo, start_ts)']
+
+# The traces of a -T database, whose rows all carry the trace_id of the
+# trace they come from.
+traces_schema = ('CREATE TABLE IF NOT EXISTS traces (trace_id INTEGER PRIMARY KEY, '
+                 'host TEXT, file TEXT UNIQUE, start_ts INTEGER, end_ts INTEGER, '
+                 'lines INTEGER, mismatches INTEGER)')
+
+def with_trace_id(statement):
+    # the CREATE TABLE statement with a trace_id column in front
+    return statement.replace(' (', ' (trace_id INTEGER, ', 1)
+
+def index_statement(table, index):
+    # The CREATE INDEX of an entry of 'indexes' in the config: a list of
+    # columns, or an object with the 'columns', more columns to 'include'
+    # after them so that the index covers the queries which read those as
+    # well, a 'where' clause which makes it a partial index of the rows
+    # matching it, and 'unique' and a 'name' if need be.
+    if isinstance(index, list):
+        index = {'columns': index}
+    where = index.get('where')
+    return 'CREATE {}INDEX IF NOT EXISTS {} ON {} ({}){}'.format(
+        'UNIQUE ' if index.get('unique') else '', index_name(table, index), table,
+        ','.join(index_columns(index)), ' WHERE ' + where if where else '')
+
+def index_name(table, index):
+    if isinstance(index, list):
+        return '{}_{}_idx'.format(table, '_'.join(index))
+    return index.get('name') or '{}_{}{}_idx'.format(
+        table, '_'.join(index_columns(index)), '_partial' if index.get('where') else '')
+
+def index_columns(index):
+    if isinstance(index, list):
+        return list(index)
+    cols = list(index['columns'])
+    cols.extend(c for c in index.get('include', []) if c not in cols)
+    return cols
+
+def table_statement(c, partitioned=False):
+    # the CREATE TABLE of a config entry, with a trace_id column for -T
+    table_string = 'CREATE TABLE IF NOT EXISTS ' + c['table_name'] + '('
+    if partitioned:
+        table_string += 'trace_id INTEGER,'
+    # create table for each set of fields
+    for j in range(len(c['fields'])):
+        table_string += c['fields'][j] + ' ' + c['types'][j] + ','
+    return table_string.rstrip(',') + ')'
+
+def partitioned_index(index):
+    # an index of a summary table of a -T database, by trace first
+    if isinstance(index, list):
+        index = {'columns': index}
+    return dict(index, columns=['trace_id'] + [c for c in index['columns'] if c != 'trace_id'])
+
+def summary_select(c, s, partitioned=False):
+    # The rows of a summary table of a config entry: the aggregates of its
+    # table grouped 'by' some of its columns, its 'columns' being [name,
+    # SQL aggregate] pairs. Those of a -T database are by trace as well.
+    by = list(s['by'])
+    if partitioned:
+        by.insert(0, 'trace_id')
+    return 'SELECT {} FROM {} GROUP BY {}'.format(
+        ', '.join(by + ['{} AS {}'.format(e, n) for n, e in s['columns']]),
+        c['table_name'], ', '.join(by))
+
+def config_tables(config):
+    # the tables of the config entries, and their summary tables
+    t = []
+    for c in config or []:
+        t.append(c['table_name'])
+        t.extend(s['table_name'] for s in c.get('summary_tables', []))
+    return t
+
+def trace_format(path):
+    # how a file of a -T run is read: the compression, 'tracedat' for the
+    # binary trace.dat of trace-cmd or None for text
+    return compression(path) or ('tracedat' if is_tracedat(path) else None)
+
+def timestamp(s):
+    # SECONDS.USEC as in the trace, or integer microseconds as in the database
+    import argparse
+    try:
+        if '.' in s:
+            sec, usec = s.split('.')
+            return int(sec) * 1000000 + int((usec + '000000')[:6])
+        return int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not a timestamp'.format(s))
+
+class ConfigError(Exception):
+    pass
+
+def load_config(config, kind='ftrace'):
+    # The config entries and the queries of type 'kind' of a JSON config,
+    # given by its path or already parsed. Either of them is None if the
+    # type has none.
+    if not isinstance(config, dict):
+        try:
+            with open(config) as json_file:
+                config = json.load(json_file)
+        except (IOError, OSError) as e:
+            raise ConfigError("Cannot read {}: {}".format(config, e))
+        except ValueError:
+            raise ConfigError("Invalid JSON file")
+
+    if 'traceworks' not in config:
+        raise ConfigError("JSON file does not contain traceworks.")
+
+    c = config['traceworks']
+    if kind not in c:
+        raise ConfigError("Invalid config type. Available types in the config file are:\n"
+                          + '\n'.join('    {}'.format(i) for i in c))
+
+    c = c[kind][0]
+    return c.get('config'), c.get('queries')
+
+def make_parser():
+    # argparse is only imported by the command line
+    import argparse
+
+    parser = argparse.ArgumentParser(description='''Work with traces.''',
+                                     epilog='''See man page for more details.
+                                     Report bugs to <{}>'''.format(bug_address),
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('tracefile', type=str, nargs='?', help='trace file')
+    parser.add_argument('dbfile', type=str, nargs='?', default="tracedump.db",
+                        help='sqlite3 database file')
+    parser.add_argument('--type', '-t', type=str,
+                        help='Top level type from the config file',
+                        default='ftrace')
+    parser.add_argument('--query', '-q', type=int, nargs='+',
+                        help='the query number to run')
+    parser.add_argument('--qargs', '-a', type=str, nargs='+',
+                        help='arguments to the query if any')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='run the queries even if their results are cached')
+    parser.add_argument('--list', '-l', action='store_true',
+                        help='List all the available queries')
+    parser.add_argument('--generate', '-g', action='store_true',
+                        help='Store data in database from tracefile')
+    parser.add_argument('--debug', '-d', action='store_true',
+                        help='Print debug information')
+    parser.add_argument('--verbose', "-v", action='store_true',
+                        help="increase output verbosity")
+    parser.add_argument("--logfile", '-f', type=str, nargs=1, help='Save all logging and debug information to this file')
+    parser.add_argument('--config', '-c', type=str,
+                        help='JSON config file', default=default_config)
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of processes to parse the tracefile with')
+    parser.add_argument('--memory-limit', '-m', type=int,
+                        help='''write aggregates to the database while parsing
+                        whenever the process grows beyond this many MB''')
+    parser.add_argument('--follow', '-F', action='store_true',
+                        help='''keep reading the tracefile as it is written
+                        (trace_pipe, a FIFO or a growing file) until interrupted''')
+    parser.add_argument('--append', '-A', action='store_true',
+                        help='''add to the tables instead of recreating them,
+                        carrying on from where the tracefile was last read''')
+    parser.add_argument('--interval', '-i', type=float, default=1.0,
+                        help='seconds between database updates with --follow')
+    parser.add_argument('--events', '-e', action='store_true',
+                        help='store every event of the tracefile in the events table as well')
+    parser.add_argument('--intervals', '-I', action='store_true',
+                        help='''store what ran on each CPU when in the sched_intervals
+                        table as well, from sched_switch''')
+    parser.add_argument('--traces', '-T', type=str, nargs='+', metavar='[HOST=]PATH',
+                        help='''read all these tracefiles, or the files in these
+                        directories, into one database with -g, one --jobs worker
+                        per file. The only positional argument is then the database
+                        file''')
+    parser.add_argument('--pid', type=int, nargs='+',
+                        help='only read the events of these pids')
+    parser.add_argument('--cpu', type=int, nargs='+',
+                        help='only read the events of these CPUs')
+    parser.add_argument('--comm', type=str, nargs='+',
+                        help='only read the events of these process names')
+    parser.add_argument('--from', type=timestamp, dest='start', metavar='TIMESTAMP',
+                        help='''only read the events from this timestamp on, in
+                        seconds as in the trace (12345.678901) or in microseconds''')
+    parser.add_argument('--to', type=timestamp, dest='end', metavar='TIMESTAMP',
+                        help='only read the events up to this timestamp')
+    parser.add_argument('--allow-events', type=str, nargs='+', metavar='NAME',
+                        help='''only read these events, by name or shell-style
+                        pattern (sys_*)''')
+    parser.add_argument('--deny-events', type=str, nargs='+', metavar='NAME',
+                        help='do not read these events, by name or pattern')
+    parser.add_argument('--trace-id', type=str, metavar='ID|HOST',
+                        help='only query this trace of a database built with -T')
+    parser.add_argument('--serve', type=str, metavar='PATH|[HOST:]PORT',
+                        help='''answer queries as JSON on this Unix socket, or over
+                        HTTP on this port, until interrupted''')
+    parser.add_argument('--output', '-o', type=str, default='table', choices=output.formats,
+                        help='''how -q and -s write the results: a table, or rows
+                        streamed as they are fetched in csv, jsonl or arrow''')
+    parser.add_argument('--output-file', type=str, metavar='FILE',
+                        help='write the results of -q and -s to FILE instead of stdout')
+    parser.add_argument('--sql', '-s', type=str,
+                        help='run this SQL statement on the database')
+    parser.add_argument('--explain', action='store_true',
+                        help='''plan every query of the config with EXPLAIN QUERY PLAN,
+                        report the full scans and temporary B-trees and suggest
+                        indexes which do without them''')
+    parser.add_argument('--export', '-x', action='store_true',
+                        help='''also write the tables as columns next to the
+                        database file, for the percentile, histogram and top queries''')
+    parser.add_argument('--export-format', type=str, default='npy',
+                        choices=['npy', 'parquet'],
+                        help='write the columns of -x as npy files or as parquet')
+    parser.add_argument('--summarize', '-S', action='store_true',
+                        help='''print latency histograms and counts of the tracefile
+                        instead of storing anything in the database''')
+    parser.add_argument('--summary-format', type=str, default='text',
+                        choices=['text', 'json'],
+                        help='print the summaries of -S as tables or as JSON')
+    parser.add_argument('--merge', '-M', type=str, nargs='+',
+                        help='summaries of earlier -S --summary-format json runs to add in')
+    parser.add_argument('--stats', action='store_true',
+                        help='''report where the time went while reading the tracefile,
+                        how much of it was of use and how each config entry fared,
+                        on stderr''')
+    parser.add_argument('--stats-format', type=str, default='text',
+                        choices=['text', 'json'],
+                        help='write the report of --stats as tables or as JSON')
+    parser.add_argument('--profile', type=str, metavar='FILE',
+                        help='profile the run with cProfile and save the stats to this file')
+    parser.add_argument('--tracemalloc', type=int, metavar='N',
+                        help='trace memory allocations and report the top N places with --stats')
+    parser.add_argument('--version', action='version', version='%(prog)s 1.0')
+    return parser
+
+def parse_args(argv=None):
+    # the options of the command line, sys.argv unless 'argv' is given
+    parser = make_parser()
+    if argv is None and len(sys.argv) == 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    args = parser.parse_args(argv)
+
+    # with -T the only positional argument is the database file
+    if args.traces and args.tracefile:
+        if args.dbfile != parser.get_default('dbfile'):
+            print("-T takes the place of the tracefile argument")
             exit(1)
+        args.dbfile = args.tracefile
+        args.tracefile = None
+    # and so it is with --serve
+    if (args.serve and args.tracefile
+            and args.dbfile == parser.get_default('dbfile')):
+        args.dbfile = args.tracefile
+        args.tracefile = None
+    return args
+
+def setup_logging(args):
+    log_level = logging.WARNING
+    if args.debug:
+        log_level = logging.DEBUG
+
+    if args.verbose:
+        if not args.debug:
+            log_level = logging.INFO
+
+    if args.logfile:
+        logfile = args.logfile[0]
+    else:
+        logfile = None
+
+    # Changes to match python3 logging format
+    logformat = '%(asctime)s %(levelname)s: %(message)s'
+
+    logging.basicConfig(level=log_level,
+                        filename=logfile,
+                        format=logformat)
+
+    sh = logging.StreamHandler(sys.stderr)
+    sh.setLevel(log_level)
+    sh.setFormatter(logging.Formatter(logformat))
+    logging.getLogger('').addHandler(sh)
 
-        c = self.config['traceworks']
-        if self.args.type not in c:
-            print("Invalid config type. Available types in the config file are:")
-            for i in c:
-                print("   ", i)
-
-            exit(0)
-
-        self.config = c[self.args.type][0]
-        if 'queries' in self.config:
-            self.queries = self.config['queries']
-        else:
-            self.queries = None
-
-        if 'config' in self.config:
-            self.config = self.config['config']
-        else:
-            self.config = None
+class TraceUtil:
+    def __init__(self, args=None, stream=None):
+        # The command line parses its options and sets up logging. The
+        # library passes options of its own (see api.py), and lines to read
+        # in 'stream' rather than a tracefile if it likes.
+        if args is None:
+            args = parse_args()
+            setup_logging(args)
+        self.args = args
+
+        try:
+            self.config, self.queries = load_config(self.args.config, self.args.type)
+        except ConfigError as e:
+            self.fail(e)
 
         self.tracefile = self.args.tracefile
-        self.data = {}
+        self.stream = stream
+        # aggregates are merged into the tables as they are written out
+        self.streaming = bool(self.args.memory_limit or self.args.follow
+                              or self.args.append)
+        self.position = None
+        self.resume = None
+        self.handlers = []
+        self.dispatch = None
+        self.events = None
+        self.intervals = None
+        self.unique = {}
+        # (host, path) of each trace of a -T run
+        self.traces = None
+        self.summary = Summary() if self.args.summarize else None
+        self.stats = Stats(bool(self.args.stats or self.args.tracemalloc))
+        self.conn = None
+        # whether events turned up without their entry or without their
+        # exit, kept in the database for the disclaimers of the queries
+        self.mismatch_entry = False
+        self.mismatch_exit = False
+        # the filters of the ingestion, which the workers get as well
+        self.filters = dict((k, v) for k, v in (
+            ('pids', self.args.pid), ('cpus', self.args.cpu), ('comms', self.args.comm),
+            ('start', self.args.start), ('end', self.args.end),
+            ('allow', self.args.allow_events), ('deny', self.args.deny_events))
+                            if v is not None)
+        self.filter = EventFilter(**self.filters) if self.filters else None
+        if self.config:
+            self.compile_config()
 
         return
 
+    def fail(self, message):
+        # The command line stops at the first error, the library raises it
+        print(message)
+        exit(1)
+
+    def notice(self, text):
+        # what is said about the trace on stdout, next to the results
+        print(text)
+
     def initdb(self):
         logging.info("Initialising database")
         self.conn = sqlite3.connect(self.args.dbfile)
+        # transactions are started and committed explicitly
+        self.conn.isolation_level = None
         self.cursor = self.conn.cursor()
 
     def create_tables(self):
         logging.info("Creating tables in the database")
+        for p in ingest_pragmas:
+            self.cursor.execute('PRAGMA ' + p)
+        # the page cache counts towards the memory limit as well
+        if self.args.memory_limit:
+            self.cursor.execute('PRAGMA cache_size=-{}'.format(self.args.memory_limit * 256))
+
+        # the columns exported from the tables are out of date from now on
+        columnar.remove(self.args.dbfile)
+
+        if self.args.append:
+            self.check_partitioning()
+
+        self.cursor.execute('BEGIN')
+        # how far each tracefile has been read, see save_position()
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS ingest_state '
+                            '(tracefile TEXT PRIMARY KEY, byte_offset INTEGER, '
+                            'timestamp INTEGER)')
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS ingest_open '
+                            '(tracefile TEXT, entry INTEGER, keys TEXT, record TEXT)')
+        queries.new_generation(self.cursor, True)
+        if not self.args.append:
+            self.cursor.execute('DROP TABLE IF EXISTS traces')
+        if self.traces is not None:
+            self.cursor.execute(traces_schema)
         for i in range(len(self.config)):
             c = self.config[i]
-            self.data[c['table_name']] = {}
-            self.cursor.execute('DROP TABLE IF EXISTS {}'.format(c['table_name']))
-
-            table_string = 'CREATE TABLE IF NOT EXISTS ' + c['table_name'] + '('
-            # create table for each set of fields
-            for j in range(len(c['fields'])):
-                table_string += c['fields'][j] + ' ' + c['types'][j] + ','
-
-            table_string = table_string.rstrip(',') + ')'
-            self.cursor.execute(table_string)
-
+            if not self.args.append:
+                self.cursor.execute('DROP TABLE IF EXISTS {}'.format(c['table_name']))
+                for summary in c.get('summary_tables', []):
+                    self.cursor.execute('DROP TABLE IF EXISTS {}'.format(summary['table_name']))
+
+            self.cursor.execute(table_statement(c, self.traces is not None))
+
+        # streamed aggregates are merged into the rows by upserts on the
+        # hierarchy. An index rather than a table constraint, so that it can
+        # be added to the tables of an earlier run as well.
+        if self.streaming:
+            for table, keys in self.unique.items():
+                self.cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS {0}_hierarchy_key '
+                                    'ON {0} ({1})'.format(table, ','.join(keys)))
+
+        if not self.args.append:
+            self.cursor.execute('DROP TABLE IF EXISTS events')
+            self.cursor.execute('DROP TABLE IF EXISTS event_names')
+        if self.events is not None:
+            self.cursor.execute(events_schema[0])
+            if self.traces is not None:
+                self.cursor.execute(with_trace_id(events_schema[1]))
+            else:
+                self.cursor.execute(events_schema[1])
+            self.events.load(self.cursor.execute('SELECT id, name FROM event_names'))
+
+        if not self.args.append:
+            self.cursor.execute('DROP TABLE IF EXISTS sched_intervals')
+            self.cursor.execute('DROP TABLE IF EXISTS sched_intervals_rtree')
+        if self.intervals is not None:
+            if self.traces is not None:
+                self.cursor.execute(with_trace_id(intervals_schema))
+            else:
+                self.cursor.execute(intervals_schema)
+            try:
+                self.cursor.execute(intervals_rtree)
+            except sqlite3.OperationalError:
+                logging.warning('SQLite has no rtree module, lookups in '
+                                'sched_intervals will be slower')
+                for statement in intervals_table:
+                    self.cursor.execute(statement)
+
+        if self.args.append and self.traces is None:
+            path = os.path.abspath(self.args.tracefile)
+            self.cursor.execute('SELECT byte_offset, timestamp FROM ingest_state '
+                                'WHERE tracefile = ?', (path,))
+            self.resume = self.cursor.fetchone()
+            self.cursor.execute('SELECT entry, keys, record FROM ingest_open '
+                                'WHERE tracefile = ?', (path,))
+            for i, keys, rec in self.cursor.fetchall():
+                if i < 0:
+                    # the runs in progress, see save_position()
+                    if self.intervals is not None:
+                        cpu = json.loads(keys)[0]
+                        self.intervals.open[cpu] = tuple(json.loads(rec))
+                        self.reopen_run(cpu, self.intervals.open[cpu])
+                elif i < len(self.handlers):
+                    self.handlers[i].data[tuple(json.loads(keys))] = json.loads(rec)
+
+        self.cursor.execute('COMMIT')
         return
 
-    def flatten_data(self, cfg):
-        filter=cfg["filter"] if "filter" in cfg else None
-        # filter out 'last_action' and 'last_action_s' since they are internal
-        # fields to manage error conditions only.
-        filter.append('last_action')
-        filter.append('last_action_s')
-        store_vars = []
-        for a in ["exit_action", "entry_action"]:
-            for f in cfg[a]:
-                if f['store_name'] not in filter:
-                    store_vars.append(f['store_name'])
-
-        # flatten is required only if we have a hierarchy and only one end
-        # value, if no hierarchy and multiple values in the dict, we don't
-        # need a complicated flattening process
-        #
-        # case 1: (key1: {key2: {key3: {...: value}}})
-        if len(store_vars) == 1:
-            d = flattenMap(self.data[cfg['table_name']], key_list = cfg['fields'],
-                           value_index = len(cfg['fields']),
-                           lift=lambda a:(a,),
-                           filter=filter)
-
-            return d
-
-        # case 2: (key1: {key2: {key2: value1, key3: value2}})
-        if len(store_vars) > 1:
-            d = flattenMap(self.data[cfg['table_name']], lift=lambda a: (a,))
-            flat = []
-            t = []
-            i = 0
-            for s in d:
-                # Skip all 'last_action' and 'last_action_s' entries.
-                if set(s[0]).intersection(set(filter)):
-                    continue
-                t.append(s)
-                i=i+1
-                if i > len(store_vars) - 1:
-                    # For each entry in 't', the common ('matching') subkeys
-                    # are exactly the ones listed as part of the hierarchy.
-                    subkey_count = len(cfg['hierarchy'].split("->"));
-                    subkeys = []
-                    l=0
-                    (k,v)= t[0]
-                    for sk in k:
-                        subkeys.append(sk)
-                        l=l+1
-                        if l==subkey_count: # Pick only the subkeys to match
-                                break
-
-                    match = True
-                    l=0
-                    # Each entry in 't' must have matching subkeys before we
-                    # can proceed.
-                    for j in range(1,len(store_vars)):
-                        (k,v) = t[j]
-                        # Match the first 'subkey_count' subkeys from the key
-                        for sk,l in zip(k,range(0,subkey_count)):
-                                if (sk != subkeys[l]):
-                                        match = False
-                                        break
-
-                    if match == False:
-                        i = 0
-                        t = []
-                        continue
-
-                    i = 0
-                    z = []
-                    t1 = {}
-                    for k, v in t:
-                        for sk in k:
-                            if sk not in z:
-                                z.append(sk)
-                        for sk in store_vars:
-                            if sk in k:
-                                t1[sk] = v
-                    d1 = dict(zip(cfg['fields'], z))
-                    d1.update(t1)
-                    flat.append(d1)
-                    t = []
-
-            return flat
-
-        return None
-
-    def execute_action(self, parsed, d, actions):
-        for action in actions:
-            if action['store_name'] not in d:
-                if action['type'] == "timestamp":
-                    d[action['store_name']] = datetime.datetime.fromtimestamp(0)
-                if action['type'] == "timedelta":
-                    d[action['store_name']] = datetime.timedelta(0)
-                else:
-                    d[action['store_name']] = 0
-
-            if action['operation'] == 'store':
-                d[action['store_name']] = parsed[action['field']]
-            elif action['operation'] == 'difference':
-                if action['field'] in d:
-                    d[action['store_name']] += (parsed[action['field']] - d[action['field']])
-            elif action['operation'] == "increment":
-                d[action['store_name']] += 1
-
-
-    def get_dict(self, hierarchy, parsed, data):
-        d = data
-        l = hierarchy.split("->")
-
-        for i in range(len(l)):
-            # for 'sched_switch', one dict per cpu is created.
-            if parsed[l[i]] not in d:
-                d[parsed[l[i]]] = {}
-                # Always call it with a common head name 'd'
-            d = d[parsed[l[i]]]
-
-        if type(parsed['name']) is not str:
-            print(l, d, parsed)
-        return d
-
-    def match_store(self, cfg, parsed):
-        global trace_mismatch_entry
-        global trace_mismatch_exit
-
-        if cfg['name'] in parsed['name']:
-            if "hierarchy" in cfg:
-                d = self.get_dict(cfg["hierarchy"], parsed,
-                                  self.data[cfg['table_name']])
-
-                if 'entry_pattern' in cfg:
-                    # check for a entry pattern, and see if this is entry or
-                    # exit. One line can either be a entry or an exit, and any
-                    # on of the actions will be executed, cannot be both.
-		    #
-		    # Ensure that an entry_pattern has to be the first match
-		    # for every cpu (sched_switch case). Also, for every cpu
-		    # entry->entry (two consecutive entries) and exit->exit
-		    # (2 consecutive exits) are ignored.
-                    if cfg['entry_pattern'] in parsed['buf']:
-                        if 'entry_action' in cfg:
-                            if 'last_action' not in d or d['last_action'] == 'exit':
-                                self.execute_action(parsed, d, cfg['entry_action'])
-                                d['last_action'] = 'entry'
-                            else:
-                                if not trace_mismatch_entry:
-                                        print('Incomplete trace data.\n')
-                                        logging.warning('mismatch in trace: missing exit: %s\n',parsed)
-                                        logging.warning('Only the first mismatch is reported.\n')
-                                        trace_mismatch_entry = True
-                    else:
-                        if 'exit_action' in cfg:
-                            if 'last_action' in d and d['last_action'] == 'entry':
-                                self.execute_action(parsed, d, cfg['exit_action'])
-                                d['last_action'] = 'exit'
-                            else:
-                                if not trace_mismatch_entry:
-                                        print('Incomplete trace data.\n')
-                                        logging.warning('mismatch in trace: missing entry: %s\n',parsed)
-                                        logging.warning('Only the first mismatch is reported.\n')
-                                        trace_mismatch_entry = True
-
-
-                if 'exit_pattern' in cfg:
-                    if cfg['exit_pattern'] in parsed['buf']:
-                        if "exit_action" in cfg:
-                            if 'last_action_s' in d and d['last_action_s'] == 'entry':
-                                self.execute_action(parsed, d, cfg['exit_action'])
-                                d['last_action_s'] = 'exit'
-                            else:
-                                if not trace_mismatch_exit:
-                                        print('Incomplete trace data.\n')
-                                        logging.warning('mismatch in trace: missing entry: %s\n',parsed)
-                                        logging.warning('Only the first mismatch is reported.\n')
-                                        trace_mismatch_exit = True
-                    else:
-                        if "entry_action" in cfg:
-                            if 'last_action_s' not in d or d['last_action_s'] == 'exit':
-                                self.execute_action(parsed, d, cfg['entry_action'])
-                                d['last_action_s'] = 'entry'
-                            else:
-                                if not trace_mismatch_exit:
-                                        print('Incomplete trace data.\n')
-                                        logging.warning('mismatch in trace: missing exit: %s\n',parsed)
-                                        logging.warning('Only the first mismatch is reported.\n')
-                                        trace_mismatch_exit = True
+    def check_partitioning(self):
+        # -A carries on with the database the way it was built, from one
+        # tracefile or with -T
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tables = set(r[0] for r in self.cursor.fetchall())
+        if 'traces' in tables and self.traces is None:
+            self.fail("{} holds several traces, add to it with -T".format(self.args.dbfile))
+        if ('traces' not in tables and self.traces is not None
+                and tables.intersection(self.table_list_from_config())):
+            self.fail("{} holds a single trace, -T cannot add to it".format(self.args.dbfile))
+
+    def partitioned_tables(self):
+        # the tables of a -T database with a trace_id column
+        return queries.partitioned_tables(self.cursor, self.table_list_from_config())
+
+    def build_summary_tables(self):
+        # The summary tables are rebuilt from their tables whole, once they
+        # are loaded and at every --follow update, so the queries of the
+        # totals read a few rows instead of grouping every row of the trace.
+        summaries = [(c, s) for c in self.config for s in c.get('summary_tables', [])]
+        if not summaries:
+            return
+        self.cursor.execute('BEGIN')
+        for c, s in summaries:
+            logging.info('Building summary table %s', s['table_name'])
+            self.cursor.execute('DROP TABLE IF EXISTS {}'.format(s['table_name']))
+            self.cursor.execute('CREATE TABLE {} AS {}'.format(
+                s['table_name'], summary_select(c, s, self.traces is not None)))
+            for index in s.get('indexes', []):
+                if self.traces is not None:
+                    index = partitioned_index(index)
+                self.cursor.execute(index_statement(s['table_name'], index))
+        self.cursor.execute('COMMIT')
+
+    def check_indexes(self):
+        # The indexes and summary tables of the config are checked before
+        # a long ingestion rather than after it, and before the tables of
+        # the last run are dropped: their columns must be fields of the
+        # table, and they are built on empty tables of the config in
+        # memory, where their where clauses and aggregates must run.
+        partitioned = self.traces is not None
+        extra = ['trace_id'] if partitioned else []
+        conn = sqlite3.connect(':memory:')
+        try:
+            cursor = conn.cursor()
+            for c in self.config:
+                self.check_sql(cursor, table_statement(c, partitioned), c['table_name'])
+            for c in self.config:
+                fields = extra + c['fields']
+                for index in c.get('indexes', []):
+                    missing = [f for f in index_columns(index) if f not in fields]
+                    if missing:
+                        self.fail("Index {} of {} is on {}, which are not fields of it".format(
+                            index_name(c['table_name'], index), c['table_name'],
+                            ', '.join(missing)))
+                    self.check_sql(cursor, index_statement(c['table_name'], index),
+                                   index_name(c['table_name'], index))
+                for s in c.get('summary_tables', []):
+                    self.check_sql(cursor, 'CREATE TABLE {} AS {}'.format(
+                        s['table_name'], summary_select(c, s, partitioned)), s['table_name'])
+                    columns = extra + list(s['by']) + [n for n, e in s['columns']]
+                    for index in s.get('indexes', []):
+                        missing = [f for f in index_columns(index) if f not in columns]
+                        if missing:
+                            self.fail("Index {} of {} is on {}, which are not columns of it".format(
+                                index_name(s['table_name'], index), s['table_name'],
+                                ', '.join(missing)))
+                        if partitioned:
+                            index = partitioned_index(index)
+                        self.check_sql(cursor, index_statement(s['table_name'], index),
+                                       index_name(s['table_name'], index))
+        finally:
+            conn.close()
+
+    def check_sql(self, cursor, sql, what):
+        try:
+            cursor.execute(sql)
+        except sqlite3.Error as e:
+            self.fail("Bad SQL in the config for {}: {}".format(what, e))
+
+    def create_indexes(self):
+        # Indexes are built once the tables are loaded, which is a lot
+        # cheaper than keeping them up to date row by row. 'indexes' is a
+        # list of the indexes of the table, see index_statement().
+        self.cursor.execute('BEGIN')
+        for c in self.config:
+            for index in c.get('indexes', []):
+                logging.info('Creating index %s', index_name(c['table_name'], index))
+                self.cursor.execute(index_statement(c['table_name'], index))
+        if self.events is not None:
+            for cols in events_indexes:
+                logging.info('Creating index events_%s_idx', '_'.join(cols))
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS events_{}_idx ON events ({})'.format(
+                    '_'.join(cols), ','.join(cols)))
+        if self.intervals is not None:
+            for cols in intervals_indexes:
+                logging.info('Creating index sched_intervals_%s_idx', '_'.join(cols))
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS sched_intervals_{}_idx '
+                                    'ON sched_intervals ({})'.format('_'.join(cols), ','.join(cols)))
+        if self.traces is not None:
+            # for --trace-id and for replacing a trace with -A
+            for t in self.partitioned_tables():
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS {0}_trace_id_idx '
+                                    'ON {0} (trace_id)'.format(t))
+        self.cursor.execute('COMMIT')
+
+    def reopen_run(self, cpu, run):
+        # The row the last -A run wrote of a run still in progress, up to
+        # the end of the trace then, is written again once the run ends
+        pid, comm, start = run
+        select = ('SELECT rowid FROM sched_intervals WHERE cpu = ? AND pid = ? '
+                  'AND start_ts = ?')
+        self.cursor.execute('DELETE FROM sched_intervals_rtree WHERE id IN ({})'.format(select),
+                            (cpu, pid, start))
+        self.cursor.execute('DELETE FROM sched_intervals WHERE rowid IN ({})'.format(select),
+                            (cpu, pid, start))
+
+    def write_events(self, names, rows):
+        store_events(self.cursor, names, rows)
+
+    def write_intervals(self, rows, trace_id=None):
+        self.cursor.execute('BEGIN')
+        self.cursor.execute('SELECT ifnull(max(rowid), 0) FROM sched_intervals')
+        last = self.cursor.fetchone()[0]
+        if trace_id is not None:
+            self.cursor.executemany('INSERT INTO sched_intervals VALUES (?, ?, ?, ?, ?, ?)',
+                                    ((trace_id,) + tuple(r) for r in rows))
+        else:
+            self.cursor.executemany('INSERT INTO sched_intervals VALUES (?, ?, ?, ?, ?)', rows)
+        self.cursor.execute('INSERT INTO sched_intervals_rtree SELECT rowid, start_ts, end_ts, '
+                            'cpu, cpu FROM sched_intervals WHERE rowid > ?', (last,))
+        self.cursor.execute('COMMIT')
+
+    def copy_events(self, path, trace_id=None):
+        # Move the events a --jobs worker stored in its own database over,
+        # mapping its event name ids to ours.
+        self.events.flush()
+        self.cursor.execute('ATTACH DATABASE ? AS chunk', (path,))
+        self.cursor.execute('BEGIN')
+        self.cursor.execute('INSERT OR IGNORE INTO event_names (name) '
+                            'SELECT name FROM chunk.event_names ORDER BY id')
+        self.cursor.execute('INSERT INTO events SELECT {}e.ts, e.cpu, e.pid, n.id, e.comm, e.buf '
+                            'FROM chunk.events e JOIN chunk.event_names c ON c.id = e.event '
+                            'JOIN event_names n ON n.name = c.name'.format(
+                                '{}, '.format(int(trace_id)) if trace_id is not None else ''))
+        self.cursor.execute('COMMIT')
+        self.cursor.execute('DETACH DATABASE chunk')
+        os.remove(path)
+        self.events.load(self.cursor.execute('SELECT id, name FROM event_names'))
+
+    def compile_config(self):
+        # Entries without a hierarchy have nothing to store.
+        for c in self.config:
+            if "hierarchy" in c:
+                sample = self.summary.sampler(c) if self.summary else None
+                self.handlers.append(Handler(c, self.reporter(len(self.handlers)), sample))
+
+        entries = self.handlers
+        if self.args.events:
+            self.events = EventStore(self.write_events, insert_batch)
+            entries = entries + [self.events]
+        if self.args.intervals:
+            self.intervals = SchedIntervals(self.write_intervals, insert_batch)
+            entries = entries + [self.intervals]
+        self.dispatch = EventDispatch(entries, self.filter)
+        if self.stats.enabled:
+            self.stats.count_lookups(self.dispatch)
+
+        # the rows of a table are keyed by the first hierarchy writing to it
+        for h in self.handlers:
+            self.unique.setdefault(h.table, h.hierarchy)
+
+    def upsert_statement(self, h):
+        # Stored fields are overwritten, everything else is accumulated.
+        sets = []
+        for f, (is_key, i) in zip(h.fields, h.columns):
+            if is_key:
+                continue
+            if f in h.stores:
+                sets.append('{0} = excluded.{0}'.format(f))
+            else:
+                sets.append('{0} = {0} + excluded.{0}'.format(f))
+
+        return 'INSERT INTO {} VALUES ({}) ON CONFLICT({}) DO {}'.format(
+            h.table, ','.join('?' * len(h.columns)), ','.join(self.unique[h.table]),
+            'UPDATE SET ' + ', '.join(sets) if sets else 'NOTHING')
+
+    def reporter(self, i):
+        # every mismatch is counted for --stats, only the first one is shown
+        def report(flag, missing, parsed):
+            self.stats.mismatch(i, missing)
+            self.report_mismatch(flag, missing, parsed)
+        return report
+
+    def report_mismatch(self, flag, missing, parsed):
+        # 'entry' mismatches come from entry_pattern configs, 'exit' ones
+        # from exit_pattern configs.
+        if flag == 'entry':
+            if self.mismatch_entry:
+                return
+            self.mismatch_entry = True
+        else:
+            if self.mismatch_exit:
+                return
+            self.mismatch_exit = True
+
+        if self.summary is not None:
+            self.summary.incomplete = True
+        # keep the JSON on stdout clean, the warning below goes to stderr
+        if not self.args.summarize or self.args.summary_format != 'json':
+            self.notice('Incomplete trace data.\n')
+        logging.warning('mismatch in trace: missing %s: %s\n', missing, parsed)
+        logging.warning('Only the first mismatch is reported.\n')
 
     def process_trace(self):
+        if self.stream is not None:
+            # lines the library hands over, read like a pipe
+            self.process_lines(None, self.stream)
+            return
         if not self.args.tracefile:
-            print("Cannot generate data without a tracefile")
-            exit(1)
+            self.fail("Cannot generate data without a tracefile")
+
+        # A regular file carries on from the byte offset it was last read
+        # up to, unless it got shorter since. A pipe has no offsets, the
+        # events up to the last timestamp read are skipped instead.
+        offset, timestamp = self.resume or (None, None)
+        regular = os.path.isfile(self.args.tracefile)
+        fmt = compression(self.args.tracefile) if regular else None
+        if regular and not fmt and is_tracedat(self.args.tracefile):
+            if self.args.follow:
+                self.fail("Cannot follow a trace.dat file")
+            self.process_tracedat(timestamp)
+            return
+        if fmt:
+            missing = missing_module(fmt)
+            if missing:
+                self.fail("Reading {} compressed traces needs the {} module".format(fmt, missing))
+            if self.args.follow:
+                self.fail("Cannot follow a compressed trace")
+            self.process_compressed(fmt, timestamp)
+            return
+
+        if regular:
+            if offset and offset > os.path.getsize(self.args.tracefile):
+                logging.warning('%s is shorter than when it was last read, '
+                                'reading it from the start', self.args.tracefile)
+                offset = None
+            if offset:
+                timestamp = None
+                logging.info('Carrying on from byte %d of %s', offset, self.args.tracefile)
+        offset = offset or 0
+
+        if self.args.follow:
+            self.process_follow(regular, offset, timestamp)
+            return
+
+        # Regular files are mapped and scanned as bytes, anything else
+        # (a pipe, a character device) is read line by line.
+        if not regular:
+            self.process_lines(timestamp)
+            return
+
+        # only the lines in the --from/--to window are read. With -A a line
+        # still being written at the end is left for the next run, which
+        # carries on from the end of the last complete line.
+        with TraceReader(self.args.tracefile) as r:
+            start, end = r.window(self.filter, offset)
+            stop = r.size
+            if self.args.append:
+                end = stop = r.line_end(start, end)
+        if (start, end) != (offset, os.path.getsize(self.args.tracefile)):
+            logging.info('Reading bytes %d to %d of %s', start, end, self.args.tracefile)
+
+        if self.args.jobs > 1:
+            with TraceReader(self.args.tracefile) as r:
+                chunks = r.chunks(self.args.jobs * 4, start, end)
+            self.process_trace_parallel(self.args.jobs, chunks)
+            if self.stats.enabled:
+                with TraceReader(self.args.tracefile) as r:
+                    self.stats.lines += r.lines(start, end)
+                    self.stats.bytes += end - start
+            return
+
+        dispatch = self.dispatch
+        parsed = None
+        with TraceReader(self.args.tracefile) as r:
+            events = r.events(dispatch.pattern, start, end, self.stats.reject, self.filter)
+            if self.args.memory_limit:
+                events = self.streamed(events)
+
+            for o, parsed in events:
+                for h in dispatch.lookup(parsed.name):
+                    h.feed(parsed)
+
+            self.position = (stop, parsed.timestamp if parsed else timestamp)
+            if self.stats.enabled:
+                self.stats.lines += r.lines(start, end)
+                self.stats.bytes += end - start
+
+    def process_lines(self, skip=None, f=None):
+        if f is None:
+            with open(self.args.tracefile, "r") as f:
+                self.process_lines(skip, f)
+            return
+
+        dispatch = self.dispatch
+        last = skip
+        lines = f
+        if self.stats.enabled:
+            lines = self.stats.counted(lines)
+        if self.args.memory_limit:
+            lines = self.streamed(lines)
+
+        for parsed in line_events(lines, dispatch.text_pattern, self.stats.reject,
+                                  self.filter, skip, text=True):
+            last = parsed.timestamp
+
+            for h in dispatch.lookup(parsed.name):
+                h.feed(parsed)
+
+        self.position = (None, last)
+
+    def process_compressed(self, fmt, skip=None):
+        # Compressed traces are decompressed as they are parsed, nothing is
+        # written to disk. Files made of independent members (bgzip, zstd
+        # with several frames) are decompressed by the --jobs workers as
+        # well, everything else in a thread next to the parsing. Positions
+        # in the file are no use for --append, it is read like a pipe.
+        path = self.args.tracefile
+        if self.args.jobs > 1 and skip is None:
+            chunks = compressed_chunks(path, fmt, max(self.args.jobs * 4,
+                                                      os.path.getsize(path) // compressed_chunk))
+            if chunks:
+                self.process_trace_parallel(self.args.jobs, chunks, fmt)
+                return
+            logging.info('%s is a single %s stream, decompressing it in one thread',
+                         path, fmt)
+
+        dispatch = self.dispatch
+        last = skip
+        lines = decompressed_lines(path, fmt)
+        if self.stats.enabled:
+            lines = self.stats.counted(lines, 1)
+        if self.args.memory_limit:
+            lines = self.streamed(lines)
+
+        for parsed in line_events(lines, dispatch.pattern, self.stats.reject, self.filter,
+                                  skip):
+            last = parsed.timestamp
+
+            for h in dispatch.lookup(parsed.name):
+                h.feed(parsed)
+
+        self.position = (None, last)
+
+    def process_tracedat(self, skip=None):
+        # The binary trace.dat of trace-cmd record, decoded into the events
+        # the text would parse into (see tracedat.py). The --jobs workers
+        # take a time range of the pages of all CPUs each, as chunks of
+        # process_trace_parallel(). Like a compressed trace, it is carried
+        # on from the last timestamp read by --append.
+        path = self.args.tracefile
+        keep = self.filter
+        start, end = time_range(keep)
+        if skip is not None:
+            start = max(start, (skip + 1) * 1000 - 500)
+
+        try:
+            trace = TraceDat(path)
+        except TraceDatError as e:
+            self.fail("Cannot read {}: {}".format(path, e))
+
+        with trace:
+            self.stats.bytes += trace.size
+            if self.args.jobs > 1:
+                chunks = []
+                for lo, hi in trace.windows(self.args.jobs * 4):
+                    lo = max(lo, start)
+                    if end is not None:
+                        hi = end if hi is None else min(hi, end)
+                    if hi is None or hi > lo:
+                        chunks.append((lo, hi))
+                self.process_trace_parallel(self.args.jobs, chunks, 'tracedat')
+                return
+
+            dispatch = self.dispatch
+            last = skip
+            events = trace.events(names_wanted([h.name for h in dispatch.entries], keep),
+                                  keep, start, end)
+            if self.args.memory_limit:
+                events = self.streamed(events)
+
+            for parsed in events:
+                last = parsed.timestamp
+                for h in dispatch.lookup(parsed.name):
+                    h.feed(parsed)
+
+            self.stats.lines += trace.count
+            self.stats.rejected += trace.unknown
+            if trace.missed:
+                logging.warning('%s: events were lost on %d pages of the ring buffer',
+                                path, trace.missed)
+
+        self.position = (None, last)
+
+    def process_follow(self, regular, offset, skip):
+        # Write out what is closed every --interval seconds, along with the
+        # position, in one short transaction each. Entries still waiting for
+        # their exit stay in memory across the writes. The writes are made
+        # between the lines, when the next one is asked for, and the
+        # position is the offset of the last line and timestamp of the last
+        # event fed.
+        dispatch = self.dispatch
+        interval = self.args.interval
+        position = [offset, skip]
+
+        def lines():
+            flushed = time.time()
+            for item in follow_lines(self.args.tracefile, offset, interval):
+                if item is not None:
+                    position[0], l = item
+                    self.stats.lines += 1
+                    self.stats.bytes += len(l) + 1
+                    yield l
+
+                if self.summary is None and time.time() - flushed >= interval:
+                    self.position = (position[0] if regular else None, position[1])
+                    if self.events is not None:
+                        self.events.flush()
+                    if self.intervals is not None:
+                        self.intervals.flush()
+                    self.flush_data()
+                    self.build_summary_tables()
+                    flushed = time.time()
+
+        logging.info('Following %s, interrupt to stop', self.args.tracefile)
+        try:
+            for parsed in line_events(lines(), dispatch.pattern, self.stats.reject,
+                                      self.filter, skip):
+                position[1] = parsed.timestamp
+                for h in dispatch.lookup(parsed.name):
+                    h.feed(parsed)
+        except KeyboardInterrupt:
+            logging.info('Stopped following %s', self.args.tracefile)
+
+        self.position = (position[0] if regular else None, position[1])
+
+    def streamed(self, items):
+        n = 0
+        for i in items:
+            yield i
+            n += 1
+            if n == flush_interval:
+                n = 0
+                self.check_memory()
+
+    def check_memory(self):
+        if current_rss() > self.args.memory_limit * 1024 * 1024:
+            self.flush_data()
+
+    def flush_data(self, final=False):
+        # Write closed records out as upserts and drop them, only the ones
+        # waiting for an exit stay in memory. The final flush writes out
+        # everything that is left.
+        self.cursor.execute('BEGIN')
+        for h in self.handlers:
+            if not final and not h.evictable:
+                continue
 
-        with open(self.args.tracefile, "r") as f:
-            for l in f:
-                parsed = parseline(l, return_type="dict");
-                if parsed is None:
+            upsert = self.upsert_statement(h)
+            rows = []
+            done = []
+            for keys, rec in h.data.items():
+                if not final and not h.closed(rec):
+                    continue
+                row = h.row(keys, rec)
+                if row is not None:
+                    rows.append(row)
+                else:
+                    self.update_partial(h, keys, rec)
+                done.append(keys)
+
+            self.cursor.executemany(upsert, rows)
+            if not final:
+                for keys in done:
+                    del h.data[keys]
+            logging.info('Flushed %d rows into %s', len(rows), h.table)
+        if self.position is not None:
+            self.save_position(final)
+        self.cursor.execute('COMMIT')
+
+    def save_position(self, final=True):
+        # Where the next --append run of the tracefile carries on from: the
+        # byte offset for a regular file and the last event timestamp read.
+        # Lines the library hands over have no file to carry on with.
+        if self.stream is not None:
+            return
+        path = os.path.abspath(self.args.tracefile)
+        self.cursor.execute('INSERT OR REPLACE INTO ingest_state VALUES (?, ?, ?)',
+                            (path,) + tuple(self.position))
+        if not final:
+            return
+
+        # At the end the records the next events still depend on are kept
+        # as well: the ones waiting for an exit, and all of them for entries
+        # which are not evictable. Their accumulated fields are in the
+        # tables already, only the stored fields and the entry/exit state
+        # are carried over.
+        self.cursor.execute('DELETE FROM ingest_open WHERE tracefile = ?', (path,))
+        rows = []
+        for i, h in enumerate(self.handlers):
+            keep = [h.slot[n] for n in h.stores] + [h.last_action, h.last_action_s]
+            for keys, rec in h.data.items():
+                if h.evictable and h.closed(rec):
                     continue
+                state = h.new_record()
+                for j in keep:
+                    state[j] = rec[j]
+                rows.append((path, i, json.dumps(keys), json.dumps(state)))
+        if self.intervals is not None:
+            for cpu, run in self.intervals.open.items():
+                rows.append((path, -1, json.dumps([cpu]), json.dumps(run)))
+        self.cursor.executemany('INSERT INTO ingest_open VALUES (?, ?, ?, ?)', rows)
+
+    def update_partial(self, h, keys, rec):
+        # A record which never got all its fields only adds to the row an
+        # earlier flush wrote, if there is one.
+        sets = []
+        vals = []
+        for f, (is_key, i) in zip(h.fields, h.columns):
+            if not is_key and rec[i] is not None:
+                if f in h.stores:
+                    sets.append('{0} = ?'.format(f))
+                else:
+                    sets.append('{0} = {0} + ?'.format(f))
+                vals.append(rec[i])
 
-                for i in range(len(self.config)):
-                    c = self.config[i]
-                    self.match_store(c, parsed)
-
-    def save_data(self, cfg, d):
-        for t in d:
-            insert_statement = "INSERT INTO {} VALUES (".format(cfg["table_name"])
-            l = []
-            for i in range(len(cfg['fields'])):
-                insert_statement += '?,'
-                val = t[cfg['fields'][i]]
-                if cfg['types'][i] == "TIMESTAMP":
-                    if type(val) is datetime.timedelta:
-                        val = (val.seconds * 1000000) + val.microseconds
-                    else:
-                        logging.debug('field: %s, val timetuple: %ld', cfg['fields'][i], val)
-                        val = time.mktime(val.timetuple())
-                l.append(val)
+        if not sets:
+            return
 
-            insert_statement = insert_statement.rstrip(',') + ')'
-            logging.debug(insert_statement + ' ' + ' '.join(str(e) for e in l))
-            self.cursor.execute(insert_statement, l)
+        where = ' AND '.join('{} = ?'.format(k) for k in h.hierarchy)
+        self.cursor.execute('UPDATE {} SET {} WHERE {}'.format(
+            h.table, ', '.join(sets), where), vals + list(keys))
 
+    def process_trace_parallel(self, jobs, chunks, fmt=None):
+        # More chunks than workers so that a slow chunk does not hold up the
+        # whole pool. Results are merged in file order as they come in.
+        #
+        # Chunks of a compressed file do not end on line boundaries, the
+        # line across two of them is put together and fed in between. The
+        # chunks of a trace.dat are time ranges, which have no lines across.
+        logging.info('Processing %s in %d chunks with %d jobs',
+                     self.args.tracefile, len(chunks), jobs)
+
+        # with --events each worker stores them in a database of its own
+        dbs = [None] * len(chunks)
+        if self.events is not None:
+            d, f = os.path.split(os.path.abspath(self.args.dbfile))
+            for i in range(len(chunks)):
+                fd, dbs[i] = tempfile.mkstemp(prefix=f + '.', suffix='.events', dir=d)
+                os.close(fd)
+
+        tasks = [(self.config, self.args.tracefile, fmt, s, e,
+                  {'events_db': db, 'summarize': self.summary is not None,
+                   'intervals': self.intervals is not None, 'stats': self.stats.enabled,
+                   'filters': self.filters})
+                 for (s, e), db in zip(chunks, dbs)]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            timestamp = self.resume[1] if self.resume else None
+            carry = b''
+            for r in pool.imap(process_chunk, tasks):
+                if r['lead'] is None:
+                    carry += r['trail']
+                    continue
+                parsed = self.feed_line(carry + r['lead'])
+                if parsed is not None:
+                    timestamp = parsed.timestamp
+                carry = r['trail']
+
+                self.merge_chunk(r)
+                if r['events'] is not None:
+                    self.copy_events(r['events'])
+                if r['summary'] is not None:
+                    self.summary.merge(Summary.from_json(r['summary']))
+                if r['intervals'] is not None:
+                    self.intervals.join(*r['intervals'])
+                if r['stats'] is not None:
+                    self.stats.merge(*r['stats'])
+                if r['timestamp'] is not None:
+                    timestamp = r['timestamp']
+                if self.args.memory_limit:
+                    self.check_memory()
+
+            parsed = self.feed_line(carry)
+            if parsed is not None:
+                timestamp = parsed.timestamp
+            if carry:
+                self.stats.lines += 1
+        finally:
+            pool.close()
+            pool.join()
+            for db in dbs:
+                if db is not None and os.path.exists(db):
+                    os.remove(db)
+
+        self.position = (None if fmt else chunks[-1][1], timestamp)
+
+    def trace_paths(self):
+        # The traces of a -T run, or of a directory given as the tracefile,
+        # as (host, path). The files of a directory are all read, the ones
+        # in its subdirectories as well. A HOST=PATH argument names the
+        # host, otherwise it is the file name up to the first dot.
+        args = self.args.traces or [self.args.tracefile]
+        traces = []
+        seen = set()
+        for a in args:
+            host = None
+            if '=' in a and not os.path.exists(a):
+                host, a = a.split('=', 1)
+            if os.path.isdir(a):
+                paths = []
+                for d, dirs, files in os.walk(a):
+                    dirs[:] = sorted(n for n in dirs if not n.startswith('.'))
+                    paths.extend(os.path.join(d, n) for n in sorted(files)
+                                 if not n.startswith('.'))
+            elif os.path.isfile(a):
+                paths = [a]
+            else:
+                self.fail("{} is not a tracefile or a directory of them".format(a))
+
+            for p in paths:
+                p = os.path.abspath(p)
+                if p in seen:
+                    continue
+                seen.add(p)
+                traces.append((host or os.path.basename(p).split('.')[0], p))
+
+        if not traces:
+            self.fail("No tracefiles in {}".format(', '.join(args)))
+        for host, p in traces:
+            fmt = trace_format(p)
+            if fmt == 'tracedat':
+                try:
+                    TraceDat(p).close()
+                except TraceDatError as e:
+                    self.fail("Cannot read {}: {}".format(p, e))
+            elif fmt and missing_module(fmt):
+                self.fail("Reading {} compressed traces needs the {} module".format(
+                    fmt, missing_module(fmt)))
+        return traces
+
+    def process_traces(self):
+        # Each trace is read whole by a worker of its own, --jobs of them at
+        # a time, and stored under its trace_id as the results come in. With
+        # -A a trace read before (the same file) is replaced and keeps its
+        # trace_id, the others are added.
+        tables = self.partitioned_tables()
+        known = {}
+        if self.args.append:
+            for trace_id, path in self.cursor.execute('SELECT trace_id, file FROM traces'):
+                known[path] = trace_id
+
+        ids = []
+        self.cursor.execute('BEGIN')
+        for host, path in self.traces:
+            trace_id = known.get(path)
+            if trace_id is None:
+                self.cursor.execute('INSERT INTO traces (host, file) VALUES (?, ?)', (host, path))
+                ids.append(self.cursor.lastrowid)
+                continue
+
+            logging.info('Replacing trace %d, %s', trace_id, path)
+            if 'sched_intervals' in tables:
+                self.cursor.execute('DELETE FROM sched_intervals_rtree WHERE id IN '
+                                    '(SELECT rowid FROM sched_intervals WHERE trace_id = ?)',
+                                    (trace_id,))
+            for t in tables:
+                self.cursor.execute('DELETE FROM {} WHERE trace_id = ?'.format(t), (trace_id,))
+            self.cursor.execute('UPDATE traces SET host = ? WHERE trace_id = ?', (host, trace_id))
+            ids.append(trace_id)
+        self.cursor.execute('COMMIT')
+
+        # with --events each worker stores them in a database of its own
+        dbs = [None] * len(self.traces)
+        if self.events is not None:
+            d, f = os.path.split(os.path.abspath(self.args.dbfile))
+            for i in range(len(dbs)):
+                fd, dbs[i] = tempfile.mkstemp(prefix=f + '.', suffix='.events', dir=d)
+                os.close(fd)
+
+        tasks = [(self.config, path, trace_format(path),
+                  {'events_db': db, 'intervals': self.intervals is not None,
+                   'stats': self.stats.enabled, 'filters': self.filters})
+                 for (host, path), db in zip(self.traces, dbs)]
+        jobs = min(self.args.jobs, len(tasks))
+        logging.info('Processing %d traces with %d jobs', len(tasks), jobs)
+        pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        try:
+            if pool is not None:
+                results = pool.imap(process_file, tasks)
+            else:
+                results = (process_file(t) for t in tasks)
+            for (host, path), trace_id, r in zip(self.traces, ids, results):
+                self.store_trace(trace_id, r)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for db in dbs:
+                if db is not None and os.path.exists(db):
+                    os.remove(db)
+
+    def store_trace(self, trace_id, r):
+        for flag, missing, parsed in r['mismatches']:
+            self.report_mismatch(flag, missing, parsed)
+        if r['stats'] is not None:
+            self.stats.merge(*r['stats'])
+
+        for h, rows in zip(self.handlers, r['rows']):
+            self.save_data(h.cfg, rows, trace_id)
+        if r['events'] is not None:
+            self.copy_events(r['events'], trace_id)
+        if r['intervals'] is not None:
+            self.write_intervals(r['intervals'], trace_id)
+
+        self.cursor.execute('BEGIN')
+        self.cursor.execute('UPDATE traces SET start_ts = ?, end_ts = ?, lines = ?, '
+                            'mismatches = ? WHERE trace_id = ?',
+                            tuple(r['range']) + (r['lines'], r['count'], trace_id))
+        self.cursor.execute('COMMIT')
+
+    def feed_line(self, l):
+        dispatch = self.dispatch
+        parsed = None
+        if l:
+            for parsed in line_events([l], dispatch.pattern, self.stats.reject, self.filter):
+                for h in dispatch.lookup(parsed.name):
+                    h.feed(parsed)
+        return parsed
+
+    def merge_chunk(self, result):
+        # Replay the events a chunk could not resolve on its own, and fold
+        # its partial aggregates in, in the order they happened in the file.
+        # This keeps both the data and the first reported mismatch identical
+        # to a serial run.
+        ops = []
+        for i, keys, head, rec, stored, rec_offset, tail in result['keys']:
+            for o, parsed in head:
+                ops.append((o, i, 'event', parsed))
+            if rec is not None:
+                ops.append((rec_offset, i, 'partial', (keys, rec, stored)))
+            for o, parsed in tail:
+                ops.append((o, i, 'event', parsed))
+
+        for o, i, flag, missing, parsed in result['mismatches']:
+            ops.append((o, i, 'mismatch', (flag, missing, parsed)))
+
+        ops.sort(key=lambda o: (o[0], o[1]))
+        for o, i, op, arg in ops:
+            h = self.handlers[i]
+            if op == 'event':
+                h.feed(arg)
+            elif op == 'partial':
+                keys, rec, stored = arg
+                d = h.record(keys)
+                # stored fields and the entry/exit state are absolute,
+                # everything else accumulated from 0 within the chunk.
+                for j, v in enumerate(rec):
+                    if v is None:
+                        continue
+                    if j in stored or j >= h.last_action:
+                        d[j] = v
+                    else:
+                        d[j] = (d[j] or 0) + v
+            else:
+                self.report_mismatch(*arg)
+
+    def save_data(self, cfg, rows, trace_id=None):
+        width = len(cfg['fields'])
+        if trace_id is not None:
+            rows = ([trace_id] + row for row in rows)
+            width += 1
+        insert_statement = "INSERT INTO {} VALUES ({})".format(
+            cfg["table_name"], ','.join('?' * width))
+        logging.debug(insert_statement)
+
+        # rows come in field order, and TIMESTAMP fields are already
+        # integer microseconds
+        start = time.time()
+        n = 0
+        rows = iter(rows)
+        self.cursor.execute('BEGIN')
+        while True:
+            batch = list(itertools.islice(rows, insert_batch))
+            if not batch:
+                break
+            self.cursor.executemany(insert_statement, batch)
+            n += len(batch)
+        self.cursor.execute('COMMIT')
+
+        elapsed = time.time() - start
+        logging.info('Saved %d rows into %s (%.0f rows/sec)', n,
+                     cfg['table_name'], n / elapsed if elapsed else 0)
         return
 
     def list_queries(self):
@@ -375,118 +1330,329 @@ class TraceUtil:
         exit(0)
 
     def table_list_from_config(self):
-        t = []
-        for i in range(len(self.config)):
-            t.append(self.config[i]['table_name'])
-
-        return t
-
-    def execute_query(self):
-        global trace_mismatch_entry
-        global trace_mismatch_exit
-        global trace_state_set
-
-        # Read the state of the trace data
-        if (trace_state_set == False):
-            with open(trace_state_file) as f:
-                for l in f:
-                    entries = l.split(': ')
-                    if (entries[0] == 'trace_mismatch_entry'):
-                        trace_mismatch_entry = entries[1]
-                    elif (entries[0] == 'trace_mismatch_exit'):
-                        trace_mismatch_exit = entries[1]
-                trace_state_set = True
-
+        return config_tables(self.config)
+
+    def execute_query(self, out):
+        trace_id = self.trace_id() if self.args.trace_id else None
+        generation = None if self.args.no_cache else queries.generation(self.cursor)
+        incomplete = queries.trace_incomplete(self.cursor)
+        tables = self.table_list_from_config()
+        checked = False
         for q in self.args.query:
             if q <= 0 or q > len(self.queries):
-                print("Invalid query number {}".format(q))
+                out.notice("Invalid query number {}".format(q))
                 continue
 
             query = self.queries[q - 1]
-            if 'query' not in query:
-                print("Query not implemented")
+            kind = query.get('kind', 'sql')
+            if kind == 'sql' and 'query' not in query:
+                out.notice("Query not implemented")
                 continue
 
             # print disclaimer if trace is incomplete
-            if (trace_mismatch_entry or trace_mismatch_exit):
-                if ("disclaimer" in query):
-                  print(query["disclaimer"])
+            if incomplete and "disclaimer" in query:
+                out.notice(query["disclaimer"])
 
+            qargs = []
             if "args" in query and len(query['args']) > 0:
                 if not self.args.qargs:
-                    print("query '{}' requires {} argument(s)".format(
+                    self.fail("query '{}' requires {} argument(s)".format(
                         query["name"], len(query["args"])))
-                    exit(1)
-                qstr = query['query'].format(*self.args.qargs)
-            else:
-                qstr = query['query']
+                qargs = self.args.qargs
 
-            tables = self.table_list_from_config();
-            self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'");
+            if not checked:
+                self.check_generated()
+                checked = True
 
-            r = self.cursor.fetchall()
-            db_tables = []
-            for t in r:
-                db_tables.append(t[0])
+            # the rows are fetched as they are written, the time is that
+            # of the query up to its first row
+            start = time.time()
+            try:
+                col_names, rows, cache = queries.iter_query(self.cursor, self.args.dbfile,
+                                                            query, qargs, trace_id, tables,
+                                                            generation)
+                if cache is not None:
+                    sys.stderr.write("query '{}': cache {}, {:.1f} ms\n".format(
+                        query['name'], cache, (time.time() - start) * 1000))
+                out.write(col_names, rows)
+            except QueryError as e:
+                self.fail(e)
 
-            if not set(db_tables).intersection(set(tables)):
-                print('Please generate the database from ftrace before querying')
-                exit(1)
+        return
 
-            self.cursor.execute(qstr)
-            r = self.cursor.fetchall()
-            col_names = list(map(lambda x: x[0], self.cursor.description))
-            display_results(col_names, r)
+    def check_generated(self):
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'");
+
+        r = self.cursor.fetchall()
+        db_tables = []
+        for t in r:
+            db_tables.append(t[0])
+
+        if not set(db_tables).intersection(set(self.table_list_from_config())):
+            self.fail('Please generate the database from ftrace before querying')
+
+    def explain_queries(self, out):
+        # the plan of every query, planned on the trace of --trace-id as
+        # the query would be
+        self.check_generated()
+        if self.args.trace_id:
+            self.restrict_to_trace(self.trace_id())
+        try:
+            rows = explain.explain(self.cursor, self.queries, self.args.qargs)
+        finally:
+            self.restrict_to_trace(None)
+        out.write(['query', 'name', 'plan', 'problems', 'suggested index'], iter(rows))
+
+    def trace_id(self):
+        # the trace --trace-id names, by its trace_id or its host
+        t = self.args.trace_id
+        r = queries.find_trace(self.cursor, t, os.path.abspath(t))
+        if r is None:
+            self.fail("--trace-id needs a database built with -T")
+        if not r:
+            self.fail("No trace {} in {}".format(t, self.args.dbfile))
+        if len(r) > 1:
+            print("Several traces of host {}, pick one by its trace_id:".format(t))
+            display_results(['trace_id', 'host', 'file'], r)
+            exit(1)
+        return r[0][0]
 
-        return
+    def restrict_to_trace(self, trace_id):
+        if self.args.trace_id is None:
+            return
+        queries.restrict_to_trace(self.cursor, self.table_list_from_config(), trace_id)
 
     def start(self):
-        if self.args.list or self.args.query:
+        # the opt-in profiling hooks wrap the whole run
+        profiler = None
+        if self.args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if self.args.tracemalloc:
+            try:
+                import tracemalloc
+            except ImportError:
+                self.fail("--tracemalloc needs Python 3")
+            tracemalloc.start()
+
+        try:
+            self.run()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            if self.args.tracemalloc:
+                top = tracemalloc.take_snapshot().statistics('lineno')[:self.args.tracemalloc]
+                tracemalloc.stop()
+                self.stats.allocations = [
+                    {'where': '{}:{}'.format(t.traceback[0].filename, t.traceback[0].lineno),
+                     'size': t.size, 'count': t.count} for t in top]
+            if profiler is not None:
+                profiler.dump_stats(self.args.profile)
+
+        if self.args.stats or self.args.tracemalloc:
+            self.stats.write(self.handlers, self.args.stats_format)
+
+    def run(self):
+        if self.args.list or self.args.query or self.args.explain:
             if not self.queries or len(self.queries) == 0:
-                print("No queries defined")
-                exit(1)
+                self.fail("No queries defined")
 
         if self.args.list:
             self.list_queries()
 
+        if output.missing_module(self.args.output):
+            self.fail("--output {} needs the {} module".format(
+                self.args.output, output.missing_module(self.args.output)))
+        if self.args.output == 'arrow' and (len(self.args.query or []) + bool(self.args.sql)
+                                            + self.args.explain > 1):
+            self.fail("--output arrow writes a single result, run one query at a time")
+
+        if self.args.serve:
+            self.serve()
+            return
+
+        if self.args.summarize:
+            self.summarize()
+            return
+
+        if self.args.traces and not self.args.generate:
+            self.fail("-T needs -g")
+
         self.initdb()
 
         if self.args.generate:
             if not self.config or len(self.config) == 0:
-                print("No config defined")
-                exit(1)
-
-            self.create_tables()
+                self.fail("No config defined")
+
+            if self.filter is not None and self.args.append:
+                self.fail("The events left out by the filters would be missed by later -A runs, "
+                          "-A cannot go with them")
+
+            if self.args.traces or self.args.tracefile and os.path.isdir(self.args.tracefile):
+                for opt, given in (('-F', self.args.follow), ('-m', self.args.memory_limit)):
+                    if given:
+                        self.fail("Several traces are read whole, {} cannot go with "
+                                  "them".format(opt))
+                self.traces = self.trace_paths()
+                self.streaming = False
+
+            if self.args.export and columnar.missing_module(self.args.export_format):
+                self.fail("--export-format {} needs the {} module".format(
+                    self.args.export_format, columnar.missing_module(self.args.export_format)))
+
+            self.check_indexes()
+            with self.stats.stage('create_tables'):
+                self.create_tables()
             self.collectall()
 
-        if self.args.query:
-            self.execute_query()
+        if self.args.query or self.args.sql or self.args.explain:
+            try:
+                with ResultWriter(self.args.output, self.args.output_file) as out:
+                    if self.args.query:
+                        self.execute_query(out)
+                    if self.args.sql:
+                        self.execute_sql(out)
+                    if self.args.explain:
+                        self.explain_queries(out)
+            except OutputError as e:
+                self.fail("Cannot write the results: {}".format(e))
+            except (IOError, OSError) as e:
+                self.fail("Cannot write the results to {}: {}".format(
+                    self.args.output_file or 'stdout', e))
+
+    def summarize(self):
+        # Nothing is written anywhere, not even the trace state
+        for opt, given in (('-g', self.args.generate), ('-T', self.args.traces),
+                           ('-e', self.args.events),
+                           ('-x', self.args.export), ('-I', self.args.intervals),
+                           ('-A', self.args.append),
+                           ('-m', self.args.memory_limit), ('-q', self.args.query),
+                           ('-s', self.args.sql), ('--explain', self.args.explain)):
+            if given:
+                self.fail("--summarize does not use the database, {} cannot go with it".format(opt))
+        if not self.args.tracefile and not self.args.merge:
+            self.fail("Cannot summarize without a tracefile or --merge")
+        if self.args.tracefile and os.path.isdir(self.args.tracefile):
+            self.fail("Cannot summarize a directory, summarize each trace and --merge them")
+
+        if self.args.tracefile:
+            with self.stats.stage('process_trace'):
+                self.process_trace()
+
+        for path in self.args.merge or []:
+            try:
+                with open(path) as f:
+                    self.summary.merge(Summary.from_json(json.load(f)))
+            except (IOError, OSError, ValueError, KeyError) as e:
+                self.fail("Cannot merge summary {}: {}".format(path, e))
+
+        if self.args.summary_format == 'json':
+            print(json.dumps(self.summary.to_json(), sort_keys=True))
+            return
+
+        if self.summary.incomplete:
+            print('Incomplete trace: some durations and counts may be missing')
+        for title, col_names, rows in self.summary.results():
+            print('\n' + title)
+            display_results(col_names, rows)
+
+    def serve(self):
+        # Queries come in over the socket, an ingestion into the database
+        # is left to another traceworks -g
+        for opt, given in (('-g', self.args.generate), ('-T', self.args.traces),
+                           ('-S', self.args.summarize), ('-q', self.args.query),
+                           ('-s', self.args.sql), ('--explain', self.args.explain),
+                           ('--trace-id', self.args.trace_id)):
+            if given:
+                self.fail("--serve answers queries as they come in, {} cannot go "
+                          "with it".format(opt))
+        if not self.queries:
+            self.fail("No queries defined")
+        if not os.path.isfile(self.args.dbfile):
+            self.fail("No database {}, generate it with -g first".format(self.args.dbfile))
+
+        # the HTTP server modules are only imported here
+        try:
+            from .server import QueryServer
+        except (ImportError, ValueError):
+            from server import QueryServer
+
+        # one connection per CPU unless -j asks for a number of them
+        connections = self.args.jobs if self.args.jobs > 1 else multiprocessing.cpu_count()
+        server = QueryServer(os.path.abspath(self.args.dbfile), self.queries,
+                             self.table_list_from_config(), connections)
+        try:
+            server.serve(self.args.serve)
+        except (OSError, IOError) as e:
+            self.fail("Cannot serve on {}: {}".format(self.args.serve, e))
+
+    def execute_sql(self, out):
+        # ad-hoc queries, mostly for the events table
+        if self.args.trace_id:
+            self.restrict_to_trace(self.trace_id())
+        try:
+            self.cursor.execute(self.args.sql)
+            col_names = list(map(lambda x: x[0], self.cursor.description or []))
+            out.write(col_names, output.fetched(self.cursor))
+        except sqlite3.Error as e:
+            self.fail("SQL error: {}".format(e))
+        finally:
+            self.restrict_to_trace(None)
 
     def collectall(self):
-        global trace_mismatch_entry
-        global trace_mismatch_exit
-
-        self.process_trace()
-
-        # Remove existing file to capture trace state if any
-        if os.path.isfile(trace_state_file):
-            os.remove(trace_state_file)
-        # Persist the state of trace data which is required while executing query
-        with open(trace_state_file, "w") as f:
-            f.write('trace_mismatch_entry: {}\n'.format(trace_mismatch_entry))
-            f.write('trace_mismatch_exit: {}\n'.format(trace_mismatch_exit))
-
-        for i in range(len(self.config)):
-            c = self.config[i]
-            logging.info('Saving data for pattern \'' + c['name'] + '\' into table '
-                         + c['table_name'])
-            d = self.flatten_data(c)
-            if d:
-                self.save_data(c, d)
+        with self.stats.stage('process_trace'):
+            if self.traces is not None:
+                self.process_traces()
+            else:
+                self.process_trace()
+                if self.events is not None:
+                    self.events.flush()
+                if self.intervals is not None:
+                    self.intervals.close()
+
+        if self.streaming:
+            with self.stats.stage('flush_data'):
+                self.flush_data(final=True)
+        elif self.traces is None:
+            # the traces of -T are saved as they come in
+            with self.stats.stage('save_data'):
+                for h in self.handlers:
+                    logging.info('Saving data for pattern \'' + h.name + '\' into table '
+                                 + h.table)
+                    self.save_data(h.cfg, h.rows())
+                self.cursor.execute('BEGIN')
+                self.save_position()
+                self.cursor.execute('COMMIT')
+
+        with self.stats.stage('summary_tables'):
+            self.build_summary_tables()
+
+        with self.stats.stage('create_indexes'):
+            self.create_indexes()
+
+        if self.args.export:
+            tables = self.table_list_from_config()
+            if self.events is not None:
+                tables.append('events')
+            if self.intervals is not None:
+                tables.append('sched_intervals')
+            logging.info('Exporting %s as %s columns', ', '.join(tables),
+                         self.args.export_format)
+            with self.stats.stage('export'):
+                columnar.export(self.cursor, self.args.dbfile, tables,
+                                self.args.export_format)
+
+        # the state of the trace the queries go by goes with the tables
+        self.cursor.execute('BEGIN')
+        queries.save_mismatches(self.cursor, self.mismatch_entry, self.mismatch_exit)
+        queries.new_generation(self.cursor, False)
+        self.cursor.execute('COMMIT')
 
     def finish(self):
-        self.conn.commit()
-        self.conn.close()
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
         logging.shutdown()
         return
 
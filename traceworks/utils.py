@@ -1,13 +1,15 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import fnmatch
 import re
-import datetime
-from tabulate import tabulate
-from collections import Mapping
-from operator import add
-import logging
+import resource
+from collections import namedtuple
 
 def display_results(col_names, table):
+    # tabulate is only imported by what prints tables, importing the
+    # package stays cheap
+    from tabulate import tabulate
+
     data = []
     data.append(col_names)
     data.extend([list(x) for x in table])
@@ -15,35 +17,147 @@ def display_results(col_names, table):
     print('================================')
     print(tabulate(data, headers='firstrow'))
 
-def parseline(line, return_type="list"):
-    try:
-        # Expect the timestamp to be x(1+).yyyyyy. One or more digits before the decimal
-        # and 6 after (Assuming the timestamp will never be less than 1 second!).
-        m = re.search(r'[ ]*(.*?)-(\d*?)\s*?\[(\d*)\]\s?(.*?)(\d{1,}.\d{6}):\s?(.*)', line)
-    except Exception as e: print(e)
-
-    if m is not None:
-        logging.debug(m.groups())
-        l = re.split('\W', m.group(6))
-        g = m.group
-        if return_type == "dict":
-            d = {}
-            # 'process name' is the same as 'comm'
-            d['process_name'] = g(1)
-            d['pid'] = int(g(2))
-            d['cpu'] = int(g(3))
-            d['flags'] = g(4)
-            d['timestamp'] = datetime.datetime.fromtimestamp(float(g(5)))
-            d['name'] = l[0]
-            d['buf'] = m.group(6)
-            return d
-
-        return g(1), int(g(2)), int(g(3)), g(4), datetime.datetime.fromtimestamp(float(g(5))), l[0], m.group(6)
-
-    if return_type == "dict":
+# Expect the timestamp to be x(1+).yyyyyy. One or more digits before the decimal
+# and 6 after (Assuming the timestamp will never be less than 1 second!).
+# The event name is the leading word of the event buffer, it is captured in the
+# same match so that no second split is required.
+_line_pattern = r'[ ]*(.*?)-(\d+)\s*?\[(\d+)\]\s?(.*?)\s*(\d+)\.(\d{6}):\s?((\w*).*)'
+_line_re = re.compile(_line_pattern)
+_line_re_bytes = re.compile(_line_pattern.encode('ascii'))
+
+# 'process name' is the same as 'comm'. The timestamp is kept as an integer
+# number of microseconds all the way to the database.
+TraceEvent = namedtuple('TraceEvent', ['process_name', 'pid', 'cpu', 'flags',
+                                       'timestamp', 'name', 'buf'])
+
+def parseline(line, match=_line_re.match):
+    m = match(line)
+    if m is None:
+        return None
+
+    comm, pid, cpu, flags, sec, usec, buf, name = m.groups()
+    return TraceEvent(comm, int(pid), int(cpu), flags,
+                      int(sec) * 1000000 + int(usec), name, buf)
+
+def parsebytes(data, start, end, match=_line_re_bytes.match):
+    # parseline() for the line at data[start:end], where data is a bytes
+    # like object such as an mmap. The line is not copied out, only the
+    # text fields get decoded. The event name is ASCII (\w on bytes), so it
+    # is the same length at the start of the decoded buffer.
+    m = match(data, start, end)
+    if m is None:
         return None
 
-    return None, None, None, None, None, None, None
+    comm, pid, cpu, flags, sec, usec, buf, name = m.groups()
+    buf = buf.decode('utf-8', 'replace')
+    return TraceEvent(comm.decode('utf-8', 'replace'), int(pid), int(cpu),
+                      flags.decode('ascii', 'replace'), int(sec) * 1000000 + int(usec),
+                      buf[:len(name)], buf)
+
+class EventFilter(object):
+    # The --pid, --cpu, --comm, --from/--to and --allow/deny-events filters
+    # of an ingestion. The pids, cpus and comms are looked for at the start
+    # of the raw line by a regex, which is a lot cheaper than parsing it, so
+    # the lines of other tasks and CPUs are dropped unparsed. The time
+    # window is checked on the parsed event, readers of a regular file
+    # bisect it to the lines in the window as well (see
+    # TraceReader.find_time()). Event names are allowed and denied by
+    # EventDispatch, once per name.
+    def __init__(self, pids=None, cpus=None, comms=None, start=None, end=None,
+                 allow=None, deny=None):
+        self.start = start
+        self.end = end
+        self.allow = allow
+        self.deny = deny
+        self.line = None
+        self.text = None
+        # for events which are not read from text lines (trace.dat)
+        self.pids = set(pids) if pids else None
+        self.cpus = set(cpus) if cpus else None
+        self.comms = set(comms) if comms else None
+        if pids or cpus or comms:
+            # The same layout as the line pattern. A '[ ]*' in front of '.*?'
+            # would be retried for each leading space, '.*?' covers them.
+            head = r'{}-{}\s*?\[0*{}\]'.format(
+                '[ ]*(?:{})'.format('|'.join(re.escape(c) for c in comms)) if comms else '.*?',
+                '(?:{})'.format('|'.join(str(p) for p in pids)) if pids else r'\d+',
+                '(?:{})'.format('|'.join(str(c) for c in cpus)) if cpus else r'\d+')
+            # the patterns, not their bound match, which Python 2 cannot
+            # pickle for the workers of a pool
+            self.line = re.compile(head.encode('utf-8'))
+            self.text = re.compile(head)
+        self.timed = start is not None or end is not None
+
+    def raw(self, line):
+        # the bytes line is of one of the tasks and CPUs
+        return self.line is None or self.line.match(line) is not None
+
+    def raw_text(self, line):
+        return self.text is None or self.text.match(line) is not None
+
+    def task(self, pid, cpu, comm):
+        return ((self.pids is None or pid in self.pids)
+                and (self.cpus is None or cpu in self.cpus)
+                and (self.comms is None or comm in self.comms))
+
+    def window(self, parsed):
+        return self.window_ts(parsed.timestamp)
+
+    def window_ts(self, ts):
+        return ((self.start is None or ts >= self.start)
+                and (self.end is None or ts <= self.end))
+
+    def allows(self, name):
+        if self.allow and not any(fnmatch.fnmatchcase(name, p) for p in self.allow):
+            return False
+        return not (self.deny and any(fnmatch.fnmatchcase(name, p) for p in self.deny))
+
+class EventDispatch(object):
+    # Index of the compiled config entries (handlers) by event name. An
+    # entry applies to an event when its 'name' is a substring of the event
+    # name, so the entries are matched once per distinct event name and the
+    # result is cached.
+    #
+    # The names are also compiled into a single pattern to reject raw lines
+    # that cannot match any entry before they get parsed. Every event name
+    # is part of its line, so a line without any of the names is of no use.
+    # When an EventFilter allows a list of plain event names, the pattern is
+    # made of those of them some entry applies to instead.
+    def __init__(self, handlers, filter=None):
+        self.entries = handlers
+        self.filter = filter
+        self.cache = {}
+
+        names = set(h.name for h in self.entries)
+        allow = filter.allow if filter is not None else None
+        if allow and not any(c in n for n in allow for c in '*?['):
+            names = set(n for n in allow if any(e in n for e in names))
+        if '' in names:
+            self.text_pattern = None
+            self.pattern = None
+        elif not names:
+            # none of the allowed events is of any use
+            self.text_pattern = re.compile('(?!)')
+            self.pattern = re.compile(b'(?!)')
+        else:
+            names = sorted(names, key=len, reverse=True)
+            self.text_pattern = re.compile('|'.join(re.escape(n) for n in names))
+            # the same for the bytes level reader
+            self.pattern = re.compile(b'|'.join(re.escape(n.encode('utf-8'))
+                                                for n in names))
+
+    def wanted(self, line):
+        return self.text_pattern is None or self.text_pattern.search(line) is not None
+
+    def lookup(self, name):
+        try:
+            return self.cache[name]
+        except KeyError:
+            m = tuple(h for h in self.entries if h.name in name)
+            if self.filter is not None and not self.filter.allows(name):
+                m = ()
+            self.cache[name] = m
+            return m
 
 def parse_sched_details(buf):
     sched_details = {}
@@ -60,28 +174,10 @@ def parse_sched_details(buf):
     return sched_details
 
 
-# from stackoverflow, Added the mapping part
-def flattenMap(d, key_list=None, value_index=0, join=add, lift=lambda x:x, filter=None):
-    _FLAG_FIRST = object()
-    results = []
-    def visit(subdict, results, partialKey):
-        for k,v in subdict.items():
-            if filter:
-                if str(k) in filter:
-                    continue
-            newKey = lift(k) if partialKey==_FLAG_FIRST else join(partialKey,lift(k))
-            if isinstance(v,Mapping):
-                visit(v, results, newKey)
-            else:
-                results.append((newKey,v))
-    visit(d, results, _FLAG_FIRST)
-    if key_list is None:
-        return results
-
-    flat = []
-    for k, v in dict(results).items():
-        pairs = dict(zip(key_list, k))
-        pairs[key_list[value_index - 1]] = v
-        flat.append(pairs)
-
-    return flat
+def current_rss():
+    # resident set size in bytes, the peak one where /proc is not around
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024